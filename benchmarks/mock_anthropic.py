@@ -0,0 +1,241 @@
+"""
+ベンチマーク用の Anthropic API のスタブサーバー（標準ライブラリのみ）。
+Messages API（ストリーミング / 非ストリーミング）、トークン数カウント API、Models API に応答する。
+初回トークンまでの待ち時間と出力速度を指定でき、ネットワークの揺らぎなしにアプリ自体の
+オーバーヘッドを測れる。
+
+単体でも起動できる:
+    python benchmarks/mock_anthropic.py --port 8765 --latency 0.2 --tokens-per-second 200
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 streamlit run streamlit_sample/claude_simple.py
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODELS = [
+    ("claude-sonnet-4-20250514", "Claude Sonnet 4", "2025-05-22T00:00:00Z"),
+    ("claude-opus-4-20250514", "Claude Opus 4", "2025-05-22T00:00:00Z"),
+    ("claude-3-5-haiku-20241022", "Claude Haiku 3.5", "2024-10-22T00:00:00Z"),
+]
+
+# 応答の 1 トークン分のテキスト
+TOKEN_TEXT = "lorem "
+
+
+def estimate_tokens(payload) -> int:
+    """リクエストの入力トークン数の概算（4 文字 = 1 トークン）。"""
+    text = json.dumps(payload.get("messages", []), ensure_ascii=False)
+    text += json.dumps(payload.get("system") or "", ensure_ascii=False)
+    return max(len(text) // 4, 1)
+
+
+class MockSettings:
+    """スタブの応答の設定。latency は初回トークンまでの秒数。"""
+
+    def __init__(self, latency=0.05, tokens_per_second=500.0, reply_tokens=50):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive を有効にして、アプリのコネクションプールをそのまま使わせる
+    protocol_version = "HTTP/1.1"
+    settings: MockSettings = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("request-id", f"req_{uuid.uuid4().hex}")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path != "/v1/models":
+            self._send_json({"type": "error", "error": {"type": "not_found_error"}}, 404)
+            return
+        data = [
+            {"type": "model", "id": i, "display_name": n, "created_at": c}
+            for i, n, c in MODELS
+        ]
+        self._send_json(
+            {
+                "data": data,
+                "has_more": False,
+                "first_id": data[0]["id"],
+                "last_id": data[-1]["id"],
+            }
+        )
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        payload = self._read_json()
+        if path == "/v1/messages/count_tokens":
+            self._send_json({"input_tokens": estimate_tokens(payload)})
+        elif path == "/v1/messages":
+            if payload.get("stream"):
+                self._stream_message(payload)
+            else:
+                self._send_message(payload)
+        else:
+            self._send_json({"type": "error", "error": {"type": "not_found_error"}}, 404)
+
+    def _reply_tokens(self, payload) -> int:
+        return min(self.settings.reply_tokens, payload.get("max_tokens", 1024))
+
+    def _message(self, payload, text, output_tokens, stop_reason):
+        return {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": payload.get("model"),
+            "content": [{"type": "text", "text": text}] if text is not None else [],
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": estimate_tokens(payload),
+                "output_tokens": output_tokens,
+                "cache_read_input_tokens": 0,
+                "cache_creation_input_tokens": 0,
+            },
+        }
+
+    def _stop_reason(self, payload):
+        if self.settings.reply_tokens > payload.get("max_tokens", 1024):
+            return "max_tokens"
+        return "end_turn"
+
+    def _send_message(self, payload):
+        time.sleep(self.settings.latency)
+        n = self._reply_tokens(payload)
+        time.sleep(n / self.settings.tokens_per_second)
+        self._send_json(
+            self._message(payload, TOKEN_TEXT * n, n, self._stop_reason(payload))
+        )
+
+    def _stream_message(self, payload):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("request-id", f"req_{uuid.uuid4().hex}")
+        self.end_headers()
+
+        def event(name, data):
+            body = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(body):x}\r\n".encode("ascii") + body + b"\r\n")
+            self.wfile.flush()
+
+        n = self._reply_tokens(payload)
+        start = self._message(payload, None, 1, None)
+        event("message_start", {"type": "message_start", "message": start})
+        event(
+            "content_block_start",
+            {
+                "type": "content_block_start",
+                "index": 0,
+                "content_block": {"type": "text", "text": ""},
+            },
+        )
+        time.sleep(self.settings.latency)
+        interval = 1.0 / self.settings.tokens_per_second
+        for _ in range(n):
+            event(
+                "content_block_delta",
+                {
+                    "type": "content_block_delta",
+                    "index": 0,
+                    "delta": {"type": "text_delta", "text": TOKEN_TEXT},
+                },
+            )
+            time.sleep(interval)
+        event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        event(
+            "message_delta",
+            {
+                "type": "message_delta",
+                "delta": {"stop_reason": self._stop_reason(payload), "stop_sequence": None},
+                "usage": {"output_tokens": n},
+            },
+        )
+        event("message_stop", {"type": "message_stop"})
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class MockAnthropicServer:
+    """
+    スタブサーバーをバックグラウンドのスレッドで起動する。
+    `with MockAnthropicServer(settings) as server:` の中で server.base_url を
+    ANTHROPIC_BASE_URL に設定して使う。
+    """
+
+    def __init__(self, settings=None, host="127.0.0.1", port=0):
+        self.settings = settings or MockSettings()
+        handler = type("Handler", (_Handler,), {"settings": self.settings})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="mock-anthropic", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """現在のスレッドで応答し続ける（Ctrl+C で終了）。"""
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Anthropic API のスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="初回トークンまでの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--reply-tokens", type=int, default=50)
+    args = parser.parse_args()
+
+    settings = MockSettings(args.latency, args.tokens_per_second, args.reply_tokens)
+    server = MockAnthropicServer(settings, args.host, args.port)
+    print(f"Mock Anthropic API: {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,509 @@
+"""
+アプリのオーバーヘッドをネットワークなしで測るベンチマーク。
+Anthropic API のスタブ（mock_anthropic.py）を起動し、ANTHROPIC_BASE_URL をそこへ向けて
+3 つのアプリを Streamlit の AppTest で実行する。
+
+測定項目:
+- startup: 新しいプロセスで各アプリを最初に表示するまでの時間（Pod の再起動直後を想定）
+- rerun: 履歴の長さごとの再実行時間（アプリごと）
+- memory: 1 セッションあたりのメモリ（tracemalloc で計測した増分）
+- export: JSON / Markdown の保存用データの作成時間
+- import: 大きな JSON / Markdown の読み込み時間
+- search: 会話ストアの全文検索の時間（一致が多い語・少ない語・短い語）
+- attachments: 添付のある履歴から API のメッセージを作る時間（最初のターン / 以降のターン）
+- ttft: 初回トークンまでの時間（スタブの待ち時間を引いた分がアプリ側のオーバーヘッド）
+- turn: 入力してから応答が履歴に入るまでの時間（AppTest 経由）
+
+使い方:
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --output new.json --compare bench.json
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+APP_DIR = ROOT / "streamlit_sample"
+APPS = ["claude_simple.py", "claude_selectable_save.py", "claude_selectable_save_import.py"]
+STEP_NAMES = [
+    "startup", "rerun", "memory", "export", "import", "search", "attachments", "ttft", "turn"
+]
+
+sys.path.insert(0, str(APP_DIR))
+
+from chat_message import Message  # noqa: E402
+from mock_anthropic import MockAnthropicServer, MockSettings  # noqa: E402
+
+# 結果を再現できるよう、生成する履歴の内容は固定にする
+SAMPLE_TEXT = (
+    "Streamlit のチャット履歴のベンチマーク用メッセージです。"
+    "`code` や **強調**、改行\nを含みます。"
+)
+
+
+def make_history(n: int) -> list:
+    """user / assistant が交互に並ぶ n 件のメッセージ（先頭は assistant の挨拶）。"""
+    messages = []
+    for i in range(n):
+        role = "assistant" if i % 2 == 0 else "user"
+        msg = {
+            "role": role,
+            "content": f"{i}: {SAMPLE_TEXT * (1 + i % 5)}",
+            "timestamp": f"2025/01/01 00:{i // 60 % 60:02d}:{i % 60:02d}",
+        }
+        if role == "assistant":
+            msg.update(
+                model="claude-sonnet-4-20250514",
+                latency=1.234,
+                time_to_first_token=0.321,
+                input_tokens=100 + i,
+                output_tokens=50,
+            )
+        messages.append(Message.from_dict(msg))
+    return messages
+
+
+def _stats(times) -> dict:
+    ordered = sorted(times)
+    return {
+        "median_s": round(statistics.median(ordered), 6),
+        "min_s": round(ordered[0], 6),
+        "p95_s": round(ordered[max(math.ceil(len(ordered) * 0.95), 1) - 1], 6),
+    }
+
+
+def _timeit(func, repeat) -> dict:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return _stats(times)
+
+
+def _app_test(script, messages=None):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(str(APP_DIR / script), default_timeout=60)
+    if messages is not None:
+        at.session_state["messages"] = messages
+    return at
+
+
+def _check(at, label):
+    if at.exception:
+        raise RuntimeError(f"{label}: {at.exception[0].message}")
+
+
+# 新しいプロセスで実行し、(streamlit の import, アプリの最初の実行) の秒数を JSON で出力する
+_STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+at = AppTest.from_file(sys.argv[1], default_timeout=60)
+at.run()
+finished = time.perf_counter()
+print(json.dumps({
+    "import_streamlit_s": imported - started,
+    "first_run_s": finished - imported,
+    "chat_input": len(at.chat_input),
+    "exception": at.exception[0].message if at.exception else None,
+}))
+"""
+
+_IMPORT_SCRIPT = """
+import time
+started = time.perf_counter()
+import anthropic
+print(time.perf_counter() - started)
+"""
+
+
+def _run_python(script, *args, env=None) -> str:
+    return subprocess.run(
+        [sys.executable, "-c", script, *args],
+        cwd=APP_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip().splitlines()[-1]
+
+
+def bench_startup(repeat) -> list:
+    results = []
+    for script in APPS:
+        imports, first_runs = [], []
+        for _ in range(repeat):
+            # 毎回空のデータディレクトリで起動する（モデル一覧のキャッシュも無い状態）
+            data_dir = tempfile.mkdtemp(dir=os.environ["CHAT_DATA_DIR"])
+            env = dict(os.environ, CHAT_DATA_DIR=data_dir)
+            row = json.loads(_run_python(_STARTUP_SCRIPT, str(APP_DIR / script), env=env))
+            if row["exception"] or not row["chat_input"]:
+                raise RuntimeError(f"{script}: 入力欄が表示されませんでした（{row['exception']}）")
+            imports.append(row["import_streamlit_s"])
+            first_runs.append(row["first_run_s"])
+        results.append(
+            {
+                "app": script,
+                "import_streamlit": _stats(imports),
+                "first_run": _stats(first_runs),
+            }
+        )
+    # 参考: 最初の画面から外した anthropic の import にかかる時間
+    anthropic_imports = [float(_run_python(_IMPORT_SCRIPT)) for _ in range(repeat)]
+    results.append({"app": "import anthropic", **_stats(anthropic_imports)})
+    return results
+
+
+def bench_rerun(history_sizes, repeat) -> list:
+    results = []
+    for script in APPS:
+        for n in history_sizes:
+            at = _app_test(script, make_history(n))
+            at.run()
+            _check(at, f"{script} ({n} messages)")
+            results.append(
+                {"app": script, "history": n, **_timeit(at.run, repeat)}
+            )
+    return results
+
+
+def bench_memory(history_size, sessions) -> list:
+    results = []
+    for script in APPS:
+        # キャッシュ（st.cache_resource など）の初期化分を除くため、先に 1 回実行する
+        _app_test(script, make_history(history_size)).run()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        apps = []
+        for _ in range(sessions):
+            at = _app_test(script, make_history(history_size))
+            at.run()
+            apps.append(at)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results.append(
+            {
+                "app": script,
+                "history": history_size,
+                "bytes_per_session": (after - before) // sessions,
+            }
+        )
+    return results
+
+
+def _export_encoders():
+    """保存形式ごとの、メッセージのリストを保存用の bytes にする関数。"""
+    from chat_archive import encode_archive
+    from chat_export import encode_chunks, iter_chat_json_chunks, iter_chat_markdown_chunks
+
+    return (
+        ("json", lambda messages: encode_chunks(iter_chat_json_chunks(messages))),
+        ("md", lambda messages: encode_chunks(iter_chat_markdown_chunks(messages))),
+        ("chatarc", encode_archive),
+    )
+
+
+def bench_export(history_sizes, repeat) -> list:
+    results = []
+    for n in history_sizes:
+        messages = make_history(n)
+        for fmt, encode in _export_encoders():
+            size = len(encode(messages))
+            results.append(
+                {
+                    "format": fmt,
+                    "history": n,
+                    "bytes": size,
+                    **_timeit(lambda: encode(messages), repeat),
+                }
+            )
+    return results
+
+
+def bench_import(history_size, repeat) -> list:
+    from chat_import import import_chat
+
+    messages = make_history(history_size)
+    results = []
+    for fmt, encode in _export_encoders():
+        data = encode(messages)
+
+        def run():
+            loaded = import_chat(io.BytesIO(data), name=f"chat.{fmt}", size=len(data))
+            assert len(loaded) == history_size
+
+        results.append(
+            {"format": fmt, "history": history_size, "bytes": len(data), **_timeit(run, repeat)}
+        )
+    return results
+
+
+def bench_search(message_count, repeat) -> list:
+    from conversation_store import ConversationStore
+
+    store = ConversationStore(Path(os.environ["CHAT_DATA_DIR"]) / "search_bench.sqlite3")
+    history = make_history(100)
+    for _ in range(max(message_count // len(history), 1)):
+        store.create_conversation(history)
+    results = []
+    # 全メッセージに一致する語 / 1 件だけに一致する語 / トライグラムで探せない短い語
+    for label, query in (("common", "ベンチマーク"), ("rare", "99: Streamlit"), ("short", "強調")):
+        results.append(
+            {
+                "query": label,
+                "history": message_count,
+                **_timeit(lambda: store.search_messages(query), repeat),
+            }
+        )
+    return results
+
+
+def bench_attachments(size_mb, repeat) -> list:
+    import attachment_store
+    from attachment_store import AttachmentStore
+
+    root = Path(os.environ["CHAT_DATA_DIR"]) / "attachments_bench"
+    store = AttachmentStore(root)
+    data = b"%PDF-1.4\n" + os.urandom(int(size_mb * 1024 * 1024))
+    ref = store.put(data, "bench.pdf")
+    history = make_history(100)
+    history[1] = Message("user", history[1].content, meta={"attachments": [ref]})
+
+    def first_turn():
+        # 変換済みのブロックが無い新しいストアで、ファイルを読み込んで変換する
+        attachment_store.get_attachment_store = lambda: AttachmentStore(root)
+        attachment_store.api_messages(history)
+
+    def next_turn():
+        attachment_store.get_attachment_store = lambda: store
+        attachment_store.api_messages(history)
+
+    original = attachment_store.get_attachment_store
+    try:
+        next_turn()
+        return [
+            {"case": case, "bytes": len(data), **_timeit(func, repeat)}
+            for case, func in (("first_turn", first_turn), ("next_turn", next_turn))
+        ]
+    finally:
+        attachment_store.get_attachment_store = original
+
+
+def bench_ttft(settings, repeat) -> dict:
+    from claude_client import get_client
+    from claude_streaming import run_stream
+    from request_builder import build_messages_request
+
+    client = get_client()
+    request = build_messages_request(
+        "claude-sonnet-4-20250514", 1000, [m.to_api() for m in make_history(20)[1:]]
+    )
+    ttfts, latencies = [], []
+    for _ in range(repeat):
+        _, metrics, _ = run_stream(client, request)
+        ttfts.append(metrics["time_to_first_token"])
+        latencies.append(metrics["latency"])
+    return {
+        "configured_latency_s": settings.latency,
+        "ttft": _stats(ttfts),
+        "ttft_overhead_median_s": round(statistics.median(ttfts) - settings.latency, 6),
+        "latency": _stats(latencies),
+    }
+
+
+def _submit_chat_input(at, text):
+    """
+    入力欄に text を入れて送信する。AppTest の ChatInput は文字列の値（string_trigger_value）
+    しか送らないので、ファイルを受け付ける入力欄（accept_file）には chat_input_value で送る。
+    """
+    from streamlit.proto.ChatInput_pb2 import ChatInput as ChatInputProto
+    from streamlit.proto.WidgetStates_pb2 import WidgetState
+    from streamlit.testing.v1.element_tree import ChatInput
+
+    class FileChatInput(ChatInput):
+        @property
+        def _widget_state(self) -> WidgetState:
+            ws = WidgetState()
+            ws.id = self.id
+            if self._value is not None:
+                ws.chat_input_value.data = self._value
+            return ws
+
+    widget = at.chat_input[0]
+    if widget.proto.accept_file != ChatInputProto.AcceptFile.NONE:
+        widget.__class__ = FileChatInput
+    return widget.set_value(text).run()
+
+
+def bench_turn(repeat, timeout=30.0) -> list:
+    results = []
+    for script in APPS:
+        times = []
+        for _ in range(repeat):
+            at = _app_test(script)
+            at.run()
+            count = len(at.session_state["messages"])
+            started = time.perf_counter()
+            _submit_chat_input(at, "ベンチマーク")
+            # 生成はバックグラウンドで進むので、応答が履歴に入るまで再実行する
+            while len(at.session_state["messages"]) < count + 2:
+                if time.perf_counter() - started > timeout:
+                    raise RuntimeError(f"{script}: 応答がタイムアウトしました")
+                time.sleep(0.01)
+                at.run()
+            _check(at, script)
+            times.append(time.perf_counter() - started)
+        results.append({"app": script, **_stats(times)})
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _version(module):
+    try:
+        return __import__(module).__version__
+    except (ImportError, AttributeError):
+        return None
+
+
+def _flatten(results) -> dict:
+    """比較用に、結果を {"rerun/claude_simple.py/1000/median_s": 値} の形にする。"""
+    flat = {}
+    for section, rows in results.items():
+        if isinstance(rows, dict):
+            rows = [rows]
+        for row in rows:
+            labels = [
+                str(v)
+                for k, v in row.items()
+                if k in ("app", "format", "query", "case", "history")
+            ]
+            for key, value in row.items():
+                if isinstance(value, dict):
+                    for sub, v in value.items():
+                        flat["/".join([section, *labels, key, sub])] = v
+                elif key.endswith("_s") or key.startswith("bytes"):
+                    flat["/".join([section, *labels, key])] = value
+    return flat
+
+
+def print_comparison(old, new):
+    """2 回分の結果の差を表示する（ratio は new / old）。"""
+    old_flat, new_flat = _flatten(old["results"]), _flatten(new["results"])
+    print(f"{'metric':70} {'old':>12} {'new':>12} {'ratio':>7}")
+    for key in sorted(new_flat):
+        if key not in old_flat:
+            continue
+        a, b = old_flat[key], new_flat[key]
+        ratio = f"{b / a:.2f}" if a else "-"
+        print(f"{key:70} {a:>12} {b:>12} {ratio:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--output", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--compare", help="比較する以前の結果の JSON ファイル")
+    parser.add_argument("--quick", action="store_true", help="小さいサイズで短時間に実行する")
+    parser.add_argument("--repeat", type=int, default=None)
+    parser.add_argument("--latency", type=float, default=0.05, help="スタブの初回トークンまでの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--reply-tokens", type=int, default=50)
+    parser.add_argument(
+        "--only",
+        nargs="*",
+        choices=STEP_NAMES,
+        help="実行する測定項目（既定はすべて）",
+    )
+    args = parser.parse_args()
+
+    if args.quick:
+        config = {"history_sizes": [10, 100], "import_size": 1000, "sessions": 3, "repeat": 3}
+        config["attachment_mb"] = 1
+    else:
+        config = {
+            "history_sizes": [10, 100, 1000, 5000],
+            "import_size": 20000,
+            "sessions": 10,
+            "repeat": 10,
+            "attachment_mb": 10,
+        }
+    if args.repeat:
+        config["repeat"] = args.repeat
+    settings = MockSettings(args.latency, args.tokens_per_second, args.reply_tokens)
+    selected = set(args.only or STEP_NAMES)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir, MockAnthropicServer(settings) as server:
+        # アプリのデータ（会話ストア・モデル一覧など）は一時ディレクトリに置く
+        os.environ["CHAT_DATA_DIR"] = data_dir
+        os.environ["ANTHROPIC_BASE_URL"] = server.base_url
+        os.environ["ANTHROPIC_API_KEY"] = "benchmark"
+        os.environ["ANTHROPIC_MAX_RETRIES"] = "0"
+        os.environ["ANTHROPIC_RATE_LIMIT_RETRIES"] = "0"
+
+        repeat = config["repeat"]
+        steps = [
+            ("startup", lambda: bench_startup(repeat)),
+            ("rerun", lambda: bench_rerun(config["history_sizes"], repeat)),
+            ("memory", lambda: bench_memory(config["history_sizes"][-1], config["sessions"])),
+            ("export", lambda: bench_export(config["history_sizes"], repeat)),
+            ("import", lambda: bench_import(config["import_size"], repeat)),
+            ("search", lambda: bench_search(config["import_size"], repeat)),
+            ("attachments", lambda: bench_attachments(config["attachment_mb"], repeat)),
+            ("ttft", lambda: bench_ttft(settings, repeat)),
+            ("turn", lambda: bench_turn(max(repeat // 3, 1))),
+        ]
+        for name, step in steps:
+            if name in selected:
+                print(f"running {name}...", file=sys.stderr)
+                results[name] = step()
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "streamlit": _version("streamlit"),
+            "anthropic": _version("anthropic"),
+            "config": config,
+            "mock": vars(settings),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        print_comparison(old, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+添付ファイル（画像・PDF・テキスト文書）のコンテンツアドレス型ストア。
+ファイルは内容の SHA-256 を名前にして 1 回だけ保存し、メッセージには
+{"sha256", "name", "media_type", "size"} の参照だけを持たせる（保存ファイルにも参照だけが入る）。
+中身は API に送るときに初めて読み込み、base64 などに変換したコンテンツブロックは
+メモリに保持して、以降のターンや別の会話でも変換し直さずに使い回す。
+ディスクの上限を超えたら、最後に使われたのが古いファイルから削除する。
+"""
+import base64
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional
+
+import streamlit as st
+
+from chat_message import Message
+from storage_paths import env_float, get_data_dir
+
+# 1 ファイルの上限（バイト）
+MAX_ATTACHMENT_BYTES = int(env_float("ATTACHMENT_MAX_MB", 20) * 1024 * 1024)
+# ディスク上の上限（バイト）。超えたら最後に使われたのが古いものから削除する
+MAX_STORE_BYTES = int(env_float("ATTACHMENT_STORE_MAX_MB", 1024) * 1024 * 1024)
+# 変換済みのコンテンツブロックをメモリに保持する量の上限（バイト）
+MAX_MEMORY_BYTES = int(env_float("ATTACHMENT_MEMORY_MB", 64) * 1024 * 1024)
+
+# 拡張子ごとのメディアタイプ（テキストはテキストの文書として送る）
+MEDIA_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".pdf": "application/pdf",
+    ".txt": "text/plain",
+    ".md": "text/markdown",
+    ".csv": "text/csv",
+    ".json": "application/json",
+}
+ATTACHMENT_FILE_TYPES = [ext.lstrip(".") for ext in MEDIA_TYPES]
+TEXT_MEDIA_TYPES = ("text/plain", "text/markdown", "text/csv", "application/json")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS attachments (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_attachments_last_used ON attachments (last_used);
+"""
+
+
+class AttachmentError(Exception):
+    """添付できないファイル（対応していない形式・大きすぎる・テキストとして読めない）。"""
+
+
+def media_type_for(name: str) -> str:
+    """ファイル名の拡張子からメディアタイプを決める。対応していなければ AttachmentError。"""
+    media_type = MEDIA_TYPES.get(Path(name).suffix.lower())
+    if media_type is None:
+        raise AttachmentError(f"{name}: 添付できない形式です。")
+    return media_type
+
+
+def _encode(data: bytes, media_type: str) -> dict:
+    """ファイルの中身を API のコンテンツブロック（title 以外）に変換する。"""
+    if media_type in TEXT_MEDIA_TYPES:
+        source = {
+            "type": "text",
+            "media_type": "text/plain",
+            "data": data.decode("utf-8-sig"),
+        }
+        return {"type": "document", "source": source}
+    source = {
+        "type": "base64",
+        "media_type": media_type,
+        "data": base64.b64encode(data).decode("ascii"),
+    }
+    return {"type": "image" if media_type.startswith("image/") else "document", "source": source}
+
+
+class AttachmentStore:
+    """
+    添付ファイルのストア（root/objects/<先頭 2 文字>/<SHA-256>）と、その使用状況の索引。
+    Streamlit のセッション（スレッド）とバッチ実行の間で 1 つを共有する。
+    """
+
+    def __init__(
+        self, root, max_bytes=MAX_STORE_BYTES, memory_bytes=MAX_MEMORY_BYTES
+    ):
+        self._root = Path(root)
+        (self._root / "objects").mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._memory_bytes = memory_bytes
+        # SHA-256 -> (変換済みのブロック, 大きさ)。最近使ったものを後ろに置く
+        self._blocks = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            str(self._root / "index.sqlite3"), timeout=30, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._transaction() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock, self._conn:
+            yield self._conn
+
+    def _path(self, sha256: str) -> Path:
+        return self._root / "objects" / sha256[:2] / sha256
+
+    def put(self, data: bytes, name: str) -> dict:
+        """
+        ファイルを保存し、メッセージに持たせる参照を返す。
+        同じ内容のファイルは（名前が違っても）1 つだけ保存する。
+        """
+        media_type = media_type_for(name)
+        if len(data) > MAX_ATTACHMENT_BYTES:
+            limit_mb = MAX_ATTACHMENT_BYTES // 1024 // 1024
+            raise AttachmentError(f"{name}: ファイルが大きすぎます（上限 {limit_mb} MB）。")
+        if media_type in TEXT_MEDIA_TYPES:
+            try:
+                data.decode("utf-8-sig")
+            except UnicodeDecodeError:
+                raise AttachmentError(f"{name}: UTF-8 のテキストとして読み込めません。")
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self._path(sha256)
+        now = time.time()
+        with self._transaction() as conn:
+            if not path.exists():
+                path.parent.mkdir(exist_ok=True)
+                # 書きかけのファイルを読まれないよう、一時ファイルから置き換える
+                fd, tmp = tempfile.mkstemp(dir=path.parent)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            conn.execute(
+                "INSERT OR REPLACE INTO attachments VALUES (?, ?,"
+                " COALESCE((SELECT created_at FROM attachments WHERE sha256 = ?), ?), ?)",
+                (sha256, len(data), sha256, now, now),
+            )
+            self._evict(conn, keep=sha256)
+        return {"sha256": sha256, "name": name, "media_type": media_type, "size": len(data)}
+
+    def load(self, sha256: str) -> Optional[bytes]:
+        """ファイルの中身。削除済み（または別の環境の参照）なら None。"""
+        try:
+            data = self._path(sha256).read_bytes()
+        except FileNotFoundError:
+            return None
+        self._touch(sha256)
+        return data
+
+    def _touch(self, sha256: str):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE attachments SET last_used = ? WHERE sha256 = ?", (time.time(), sha256)
+            )
+
+    def content_block(self, ref: dict) -> dict:
+        """
+        参照を API のコンテンツブロックにする。変換はファイルごとに 1 回だけで、
+        結果のブロック（base64 の文字列）は以降のリクエストでもそのまま共有する。
+        ファイルが無ければ、添付が失われたことを伝えるテキストにする。
+        """
+        sha256 = ref["sha256"]
+        with self._lock:
+            entry = self._blocks.get(sha256)
+            if entry is not None:
+                self._blocks.move_to_end(sha256)
+                # メモリにあっても、使っているファイルがディスクから削除されないようにする
+                self._touch(sha256)
+        if entry is None:
+            data = self.load(sha256)
+            if data is None:
+                return {
+                    "type": "text",
+                    "text": f"[添付ファイル {ref.get('name', '')} は削除されたため送信できません]",
+                }
+            entry = (_encode(data, ref["media_type"]), len(data))
+            self._remember(sha256, entry)
+        block, _ = entry
+        if block["type"] == "document" and ref.get("name"):
+            return {**block, "title": ref["name"]}
+        return block
+
+    def _remember(self, sha256, entry):
+        with self._lock:
+            if sha256 in self._blocks:
+                return
+            self._blocks[sha256] = entry
+            self._memory_used += entry[1]
+            while self._memory_used > self._memory_bytes and len(self._blocks) > 1:
+                _, (_, size) = self._blocks.popitem(last=False)
+                self._memory_used -= size
+
+    def _evict(self, conn, keep: str):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM attachments").fetchone()[0]
+        if total <= self._max_bytes:
+            return
+        # 上限の 9 割まで、最後に使われたのが古い順に削除する（今保存したものは残す）
+        target = total - int(self._max_bytes * 0.9)
+        freed = 0
+        evicted = []
+        for sha256, size in conn.execute(
+            "SELECT sha256, size FROM attachments WHERE sha256 != ? ORDER BY last_used",
+            (keep,),
+        ):
+            if freed >= target:
+                break
+            evicted.append((sha256,))
+            freed += size
+        conn.executemany("DELETE FROM attachments WHERE sha256 = ?", evicted)
+        for (sha256,) in evicted:
+            self._path(sha256).unlink(missing_ok=True)
+            with self._lock:
+                entry = self._blocks.pop(sha256, None)
+                if entry is not None:
+                    self._memory_used -= entry[1]
+
+    def usage(self):
+        """(ファイル数, ディスク上の合計バイト数, メモリ上の変換済みブロックのバイト数)。"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM attachments"
+            ).fetchall()
+        return rows[0][0], rows[0][1], self._memory_used
+
+
+@st.cache_resource(show_spinner=False)
+def get_attachment_store() -> AttachmentStore:
+    """プロセス共有の添付ファイルのストアを返す。"""
+    return AttachmentStore(get_data_dir() / "attachments")
+
+
+def api_messages(messages: List[Message]) -> List[dict]:
+    """
+    Message のリストを Messages API に送るメッセージにする。
+    添付のあるメッセージは、添付のブロックを本文の前に並べたコンテンツブロックにする。
+    """
+    result = []
+    for msg in messages:
+        refs = msg.get("attachments")
+        if not refs:
+            result.append(msg.to_api())
+            continue
+        store = get_attachment_store()
+        blocks = [store.content_block(ref) for ref in refs]
+        if msg.content:
+            blocks.append({"type": "text", "text": msg.content})
+        result.append({"role": msg.role, "content": blocks})
+    return result
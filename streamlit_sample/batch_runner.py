@@ -0,0 +1,488 @@
+"""
+プロンプトのまとめての実行（オフラインの評価など）。
+入力はプロンプトの JSONL / CSV、または保存したチャットファイル（JSON / JSONL / Markdown / アーカイブ、
+`claude_selectable_save_import.py` で復元できるもの）で、会話ごとに 1 回 API を呼ぶ。
+
+Message Batches API（料金が半額）で送り、使えない場合（API が 404 を返すなど）は
+レート制限付きのスレッドプールで並列に送る。実行の設定・入力・進捗は実行ディレクトリに
+保存するので、中断しても同じディレクトリで再開すれば終わっていない会話だけを送る。
+結果は会話ごとに 1 つの JSON（チャットの保存と同じ形式）として output/ に書き出す。
+
+コマンドラインからも実行できる:
+    python streamlit_sample/batch_runner.py run prompts.jsonl --model claude-sonnet-4-20250514 \\
+        --output-dir runs/eval1
+    python streamlit_sample/batch_runner.py resume runs/eval1
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import streamlit as st
+
+from attachment_store import api_messages
+from chat_export import write_chat_export
+from chat_import import ChatImportError, import_chat
+from chat_message import JST, TIMESTAMP_FORMAT, Message, active_path
+from model_catalog import estimate_cost
+from rate_limiter import estimate_input_tokens
+from request_builder import build_messages_request
+from storage_paths import get_data_dir
+
+# 実行方法: auto は Message Batches API を試し、使えなければ並列実行に切り替える
+RUN_MODES = ("auto", "batches", "workers")
+# 並列実行で同時に送る数（レート制限の同時実行数の上限も別にかかる）
+DEFAULT_CONCURRENCY = 4
+# Message Batches API の状態を確認する間隔（秒）
+BATCH_POLL_SECONDS = 30
+# 1 つのバッチに入れられるリクエスト数の上限
+MAX_BATCH_REQUESTS = 100_000
+# Message Batches API の料金は通常の半額
+BATCH_PRICE_RATIO = 0.5
+
+# Message Batches API の custom_id に使える文字と長さ
+_CUSTOM_ID_INVALID = re.compile(r"[^A-Za-z0-9_-]")
+CUSTOM_ID_LENGTH = 64
+
+
+class BatchInputError(ValueError):
+    """バッチの入力ファイルが読み込めない。"""
+
+
+def _now_str() -> str:
+    return datetime.now(JST).strftime(TIMESTAMP_FORMAT)
+
+
+def _custom_id(name: str, used: set) -> str:
+    """会話の ID（出力ファイル名にもなる）。使えない文字を置き換え、重複には連番を付ける。"""
+    base = _CUSTOM_ID_INVALID.sub("_", name)[:CUSTOM_ID_LENGTH - 6] or "item"
+    custom_id, n = base, 1
+    while custom_id in used:
+        n += 1
+        custom_id = f"{base}_{n}"
+    used.add(custom_id)
+    return custom_id
+
+
+def _prompt_items(rows, name, used) -> List[Tuple[str, List[Message]]]:
+    stem = Path(name).stem
+    items = []
+    for i, row in enumerate(rows):
+        prompt = row.get("prompt")
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise BatchInputError(f"{name}: {i + 1}件目に 'prompt' がありません。")
+        item_id = row.get("id") or f"{stem}_{i + 1:05d}"
+        items.append((_custom_id(str(item_id), used), [Message("user", prompt)]))
+    return items
+
+
+def load_batch_items(
+    name: str, data: bytes, used: Optional[set] = None
+) -> List[Tuple[str, List[Message]]]:
+    """
+    入力ファイルを (会話 ID, メッセージのリスト) のリストにする。
+    複数のファイルを読む場合は、同じ used（使用済みの会話 ID の set）を渡すと ID が重複しない。
+    CSV / JSONL の "prompt" 列（任意で "id" 列）はそれぞれ 1 つの会話になり、
+    それ以外（保存したチャットファイル）はファイル全体で 1 つの会話になる。
+    保存したチャットの末尾の assistant の応答は除き、最後の user メッセージへの応答を
+    改めて生成する（保存時と別のモデル・設定で評価し直せるように）。
+    分岐した会話のファイルは、最後のメッセージまでの分岐だけを使う。
+    """
+    used = set() if used is None else used
+    lower = name.lower()
+    try:
+        if lower.endswith(".csv"):
+            rows = csv.DictReader(io.StringIO(data.decode("utf-8-sig")))
+            if "prompt" not in (rows.fieldnames or ()):
+                raise BatchInputError(f"{name}: 'prompt' 列がありません。")
+            return _prompt_items(rows, name, used)
+        if lower.endswith(".jsonl"):
+            lines = [line for line in data.decode("utf-8-sig").splitlines() if line.strip()]
+            first = json.loads(lines[0]) if lines else None
+            if isinstance(first, dict) and "prompt" in first:
+                return _prompt_items(map(json.loads, lines), name, used)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise BatchInputError(f"{name}: 読み込めません（{e}）。")
+
+    try:
+        messages = import_chat(io.BytesIO(data), name=name, size=len(data))
+    except ChatImportError as e:
+        raise BatchInputError(f"{name}: {e}")
+    messages = active_path(messages)
+    for msg in messages:
+        msg.id = msg.parent = None
+    while messages and messages[-1].role != "user":
+        messages.pop()
+    if not messages:
+        raise BatchInputError(f"{name}: user のメッセージがありません。")
+    return [(_custom_id(Path(name).stem, used), messages)]
+
+
+def _message_metrics(message) -> dict:
+    """Message Batches API の結果（Message）から、run_stream() と同じ項目の metrics を作る。"""
+    usage = message.usage
+    return {
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "cache_read_input_tokens": usage.cache_read_input_tokens or 0,
+        "cache_creation_input_tokens": usage.cache_creation_input_tokens or 0,
+        "stop_reason": message.stop_reason,
+    }
+
+
+def _batches_unavailable(error) -> bool:
+    # Message Batches API に対応していないエンドポイント（プロキシ・互換サーバーなど）
+    return getattr(error, "status_code", None) in (404, 405, 501)
+
+
+def _write_json(path: Path, data):
+    # 書き込み途中で中断されても壊れたファイルが残らないよう、一時ファイルから置き換える
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+class BatchRun:
+    """
+    1 回分のバッチ実行。run_dir に次のファイルを置く。
+
+    - batch.json: モデル・max_tokens・実行方法
+    - input.jsonl: 会話ごとの {"id", "messages"}
+    - state.json: 送信中のバッチの ID と、失敗した会話のエラー
+    - output/<会話 ID>.json: 結果（このファイルがある会話は完了とみなす）
+    """
+
+    def __init__(self, run_dir):
+        self.run_dir = Path(run_dir)
+        self.output_dir = self.run_dir / "output"
+        settings = json.loads((self.run_dir / "batch.json").read_text(encoding="utf-8"))
+        self.model = settings["model"]
+        self.max_tokens = settings["max_tokens"]
+        self.mode = settings["mode"]
+        self._items = None
+        self._lock = threading.Lock()
+        state_path = self.run_dir / "state.json"
+        if state_path.exists():
+            self.state = json.loads(state_path.read_text(encoding="utf-8"))
+        else:
+            self.state = {"batch_id": None, "errors": {}}
+
+    @classmethod
+    def create(cls, run_dir, items, model, max_tokens=1000, mode="auto") -> "BatchRun":
+        """実行ディレクトリを作って入力と設定を保存する。"""
+        if mode not in RUN_MODES:
+            raise ValueError(f"mode は {RUN_MODES} のいずれかです: {mode!r}")
+        if not items:
+            raise BatchInputError("実行する会話がありません。")
+        ids = [item_id for item_id, _ in items]
+        if len(set(ids)) != len(ids):
+            raise BatchInputError("会話 ID が重複しています。")
+        run_dir = Path(run_dir)
+        (run_dir / "output").mkdir(parents=True, exist_ok=True)
+        with open(run_dir / "input.jsonl", "w", encoding="utf-8") as f:
+            for item_id, messages in items:
+                record = {"id": item_id, "messages": [m.to_dict() for m in messages]}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        _write_json(
+            run_dir / "batch.json",
+            {"model": model, "max_tokens": max_tokens, "mode": mode, "created_at": time.time()},
+        )
+        return cls(run_dir)
+
+    @property
+    def items(self) -> Dict[str, List[Message]]:
+        if self._items is None:
+            with open(self.run_dir / "input.jsonl", encoding="utf-8") as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            self._items = {
+                r["id"]: [Message.from_dict(m) for m in r["messages"]] for r in records
+            }
+        return self._items
+
+    def is_done(self, item_id) -> bool:
+        return (self.output_dir / f"{item_id}.json").exists()
+
+    def pending(self) -> List[str]:
+        return [item_id for item_id in self.items if not self.is_done(item_id)]
+
+    def progress(self) -> Tuple[int, int, int]:
+        """(完了した会話数, 全体の会話数, エラーになった会話数)。"""
+        total = len(self.items)
+        return total - len(self.pending()), total, len(self.state["errors"])
+
+    def _save_state(self):
+        with self._lock:
+            _write_json(self.run_dir / "state.json", self.state)
+
+    def _record_error(self, item_id, message):
+        with self._lock:
+            self.state["errors"][item_id] = message
+        self._save_state()
+
+    def _write_output(self, item_id, reply, metrics, meta=None):
+        """入力の会話に応答を付けて、チャットの保存と同じ形式の JSON で書き出す。"""
+        cost = estimate_cost(self.model, metrics)
+        if cost is not None and meta and meta.get("batch_id"):
+            cost = round(cost * BATCH_PRICE_RATIO, 6)
+        answer = Message(
+            "assistant",
+            reply,
+            timestamp=_now_str(),
+            model=self.model,
+            meta={**metrics, "cost_usd": cost, **(meta or {})},
+        )
+        path = self.output_dir / f"{item_id}.json"
+        tmp = path.with_suffix(".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            write_chat_export(self.items[item_id] + [answer], f, "json")
+        os.replace(tmp, path)
+        with self._lock:
+            self.state["errors"].pop(item_id, None)
+
+    def _request(self, item_id) -> dict:
+        return build_messages_request(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            messages=api_messages(self.items[item_id]),
+        )
+
+    def run(
+        self,
+        client,
+        rate_limiter,
+        concurrency=DEFAULT_CONCURRENCY,
+        on_progress: Optional[Callable[[str], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> str:
+        """
+        終わっていない会話を送り、実際に使った実行方法（batches / workers）を返す。
+        should_stop() が True を返したら、送信中のものを待って（バッチは ID を保存して）終わる。
+        エラーになった会話は state.json に記録し、次の実行で送り直す。
+        """
+        on_progress = on_progress or (lambda text: None)
+        should_stop = should_stop or (lambda: False)
+        if self.mode != "workers":
+            try:
+                self._run_batches(client, on_progress, should_stop)
+                return "batches"
+            except Exception as e:
+                if self.mode == "batches" or not _batches_unavailable(e):
+                    raise
+                on_progress("Message Batches API が使えないため、並列実行に切り替えます。")
+        self._run_workers(client, rate_limiter, concurrency, on_progress, should_stop)
+        return "workers"
+
+    def _run_batches(self, client, on_progress, should_stop):
+        batches = client.messages.batches
+        if self.state["batch_id"] is None:
+            pending = self.pending()
+            if not pending:
+                return
+            if len(pending) > MAX_BATCH_REQUESTS:
+                pending = pending[:MAX_BATCH_REQUESTS]
+            batch = batches.create(
+                requests=[{"custom_id": i, "params": self._request(i)} for i in pending]
+            )
+            # 送信したバッチの ID を保存しておけば、中断しても結果を取りに戻れる
+            self.state["batch_id"] = batch.id
+            self._save_state()
+        batch_id = self.state["batch_id"]
+
+        while True:
+            batch = batches.retrieve(batch_id)
+            counts = batch.request_counts
+            on_progress(
+                f"バッチ {batch_id}: 処理中 {counts.processing} / 成功 {counts.succeeded}"
+                f" / エラー {counts.errored + counts.canceled + counts.expired}"
+            )
+            if batch.processing_status == "ended":
+                break
+            if should_stop():
+                return
+            time.sleep(BATCH_POLL_SECONDS)
+
+        sent = set()
+        for entry in batches.results(batch_id):
+            item_id, result = entry.custom_id, entry.result
+            sent.add(item_id)
+            if item_id not in self.items or self.is_done(item_id):
+                continue
+            if result.type == "succeeded":
+                message = result.message
+                reply = "".join(b.text for b in message.content if b.type == "text")
+                self._write_output(
+                    item_id, reply, _message_metrics(message), {"batch_id": batch_id}
+                )
+            else:
+                error = getattr(result, "error", None)
+                self.state["errors"][item_id] = str(error) if error else result.type
+        self.state["batch_id"] = None
+        self._save_state()
+        # バッチの上限を超えて送らなかった分は、次のバッチで送る
+        # （エラーになった分は送り直さず、次の実行に任せる）
+        remaining = [i for i in self.pending() if i not in sent]
+        if remaining and not should_stop():
+            self._run_batches(client, on_progress, should_stop)
+
+    def _run_workers(self, client, rate_limiter, concurrency, on_progress, should_stop):
+        from claude_streaming import run_stream
+
+        pending = self.pending()
+        total = len(self.items)
+        finished = [total - len(pending)]
+
+        def run_one(item_id):
+            if should_stop():
+                return
+            request = self._request(item_id)
+            outcome = {}
+
+            def send():
+                # リトライは rate_limiter で行うので SDK のリトライは無効にする
+                outcome["reply"], metrics, _ = run_stream(
+                    client.with_options(max_retries=0), request
+                )
+                return metrics
+
+            try:
+                metrics, retries = rate_limiter.call(
+                    send,
+                    input_tokens=estimate_input_tokens(request["messages"]),
+                    output_tokens=self.max_tokens,
+                    should_stop=should_stop,
+                )
+                metrics["retries"] = retries
+                reply = outcome["reply"]
+                self._write_output(item_id, reply, metrics)
+                self._save_state()
+            except Exception as e:
+                self._record_error(item_id, str(e))
+            with self._lock:
+                finished[0] += 1
+                done = finished[0]
+            on_progress(f"{done} / {total} 件")
+
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="claude-batch")
+        try:
+            list(executor.map(run_one, pending))
+        finally:
+            # 中断（Ctrl+C）されたら、まだ始まっていない会話は送らない
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+class BatchManager:
+    """画面から開始したバッチ実行のスレッド（再実行やセッションをまたいで続行する）。"""
+
+    def __init__(self):
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def start(self, run: BatchRun, client, rate_limiter, concurrency=DEFAULT_CONCURRENCY):
+        key = str(run.run_dir)
+        with self._lock:
+            if self.is_running(key):
+                return
+            stop = threading.Event()
+            status = {"text": "開始しています...", "error": None}
+
+            def target():
+                try:
+                    run.run(
+                        client,
+                        rate_limiter,
+                        concurrency,
+                        on_progress=lambda text: status.update(text=text),
+                        should_stop=stop.is_set,
+                    )
+                    status["text"] = "停止しました" if stop.is_set() else "完了しました"
+                except Exception as e:
+                    status["error"] = str(e)
+
+            thread = threading.Thread(target=target, name="claude-batch-run", daemon=True)
+            self._runs[key] = (thread, stop, status)
+            thread.start()
+
+    def is_running(self, key) -> bool:
+        entry = self._runs.get(str(key))
+        return entry is not None and entry[0].is_alive()
+
+    def status(self, key) -> Optional[dict]:
+        entry = self._runs.get(str(key))
+        return entry[2] if entry else None
+
+    def stop(self, key):
+        entry = self._runs.get(str(key))
+        if entry:
+            entry[1].set()
+
+
+@st.cache_resource(show_spinner=False)
+def get_batch_manager() -> BatchManager:
+    """プロセス共有のバッチ実行の管理を返す。"""
+    return BatchManager()
+
+
+def batch_runs_dir() -> Path:
+    """画面から作成したバッチ実行を置くディレクトリ（無ければ作成する）。"""
+    runs_dir = get_data_dir() / "batches"
+    runs_dir.mkdir(exist_ok=True)
+    return runs_dir
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="プロンプトをまとめて Claude に送る")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="入力ファイルから新しく実行する")
+    run_parser.add_argument("inputs", nargs="+", type=Path)
+    run_parser.add_argument("--model", required=True)
+    run_parser.add_argument("--max-tokens", type=int, default=1000)
+    run_parser.add_argument("--output-dir", type=Path, required=True)
+    run_parser.add_argument("--mode", choices=RUN_MODES, default="auto")
+    resume_parser = commands.add_parser("resume", help="中断した実行を続ける")
+    resume_parser.add_argument("output_dir", type=Path)
+    for p in (run_parser, resume_parser):
+        p.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    args = parser.parse_args(argv)
+
+    from claude_client import get_client
+    from rate_limiter import get_rate_limiter
+
+    if args.command == "run":
+        if (args.output_dir / "batch.json").exists():
+            parser.error(f"{args.output_dir} には既に実行があります（resume で再開できます）")
+        items, used = [], set()
+        for path in args.inputs:
+            items += load_batch_items(path.name, path.read_bytes(), used)
+        run = BatchRun.create(args.output_dir, items, args.model, args.max_tokens, args.mode)
+    else:
+        run = BatchRun(args.output_dir)
+
+    stop = threading.Event()
+    try:
+        mode = run.run(
+            get_client(),
+            get_rate_limiter(),
+            args.concurrency,
+            on_progress=lambda text: print(text, file=sys.stderr),
+            should_stop=stop.is_set,
+        )
+    except KeyboardInterrupt:
+        stop.set()
+        print("中断しました（resume で再開できます）", file=sys.stderr)
+        return 130
+    done, total, errors = run.progress()
+    print(f"{mode}: {done} / {total} 件完了、エラー {errors}件（{run.output_dir}）")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,421 @@
+"""
+チャットアプリの画面の共通部分。
+各アプリ（`claude_*.py`）はここの関数を並べるだけの薄いエントリポイントにする。
+"""
+from datetime import datetime, timezone, timedelta
+from typing import List, Optional
+
+import streamlit as st
+
+from attachment_store import (
+    ATTACHMENT_FILE_TYPES,
+    AttachmentError,
+    api_messages,
+    get_attachment_store,
+)
+from chat_export import render_export_buttons
+from chat_history_view import render_chat_history, render_message
+from chat_ingest import render_ingest_panel
+from chat_import import ChatImportError, import_chat
+from chat_message import Message, active_path
+from claude_client import preload_in_background
+from context_policy import POLICY_CHOICES
+from conversation_store import (
+    append_message,
+    bump_history_version,
+    export_history,
+    get_conversation_store,
+    load_older_messages,
+    render_conversation_sidebar,
+    session_history,
+    set_active_message,
+)
+from generation_worker import (
+    GenerationJob,
+    active_generation,
+    collect_generation,
+    generation_finished,
+    render_generation_progress,
+    start_generation,
+)
+from model_catalog import get_available_models, get_model_catalog
+from response_cache import render_response_cache_controls
+from session_memory import enforce_memory_budget, render_session_memory_status, track_session
+from telemetry import render_telemetry_panel
+
+DEFAULT_MODEL = "claude-sonnet-4-20250514"
+GREETING = "こんにちは！何かお手伝いできますか？"
+# モデル一覧の取得が終わったかを確認する間隔（秒）
+CATALOG_POLL_SECONDS = 1.0
+
+
+def get_jst_now_str() -> str:
+    """日本時間 (JST) の現在時刻を yyyy/mm/dd hh:mm:ss 形式で返す。"""
+    jst = timezone(timedelta(hours=9))
+    return datetime.now(jst).strftime("%Y/%m/%d %H:%M:%S")
+
+
+def make_greeting() -> Message:
+    """新しい会話の最初の assistant メッセージ。"""
+    return Message("assistant", GREETING, timestamp=get_jst_now_str())
+
+
+def render_page_header():
+    st.set_page_config(page_title="Claude Chat Sample", page_icon=":robot:")
+    st.title("Claude Chat Sample")
+
+
+def init_session(default_model: str = DEFAULT_MODEL):
+    """セッション状態（モデル・履歴・会話 ID）を初期化する。"""
+    if "model" not in st.session_state:
+        # デフォルトモデル
+        st.session_state["model"] = default_model
+
+    # session state for chat history
+    if "messages" not in st.session_state:
+        st.session_state["messages"] = [make_greeting()]
+
+    # 会話ストア上の会話 ID（最初のユーザー発言で作成される）
+    if "conversation_id" not in st.session_state:
+        st.session_state["conversation_id"] = None
+
+
+def chat_started() -> bool:
+    """チャットが開始されたかどうか（ユーザーメッセージがあるか）。"""
+    if st.session_state.get("history_offset", 0):
+        # 会話ストアに退避済みの分があるなら、最初のユーザー発言はもう済んでいる
+        return True
+    return any(m.role == "user" for m in st.session_state["messages"])
+
+
+def render_model_selector(available_models: List[str]):
+    """モデル選択 UI（チャット開始後は変更不可）。"""
+    started = chat_started()
+
+    # 現在のモデルが一覧にない場合は先頭を選ぶ
+    if st.session_state["model"] not in available_models:
+        st.session_state["model"] = available_models[0]
+
+    selected_model = st.selectbox(
+        "使用する Claude モデルを選択してください（API から取得）",
+        options=available_models,
+        index=available_models.index(st.session_state["model"]),
+        disabled=started,
+        help="チャット開始前にモデルを選択してください（開始後は変更できません）。",
+    )
+    if not started:
+        st.session_state["model"] = selected_model
+
+    # 起動直後は保存済み（または固定）の一覧で表示し、API から取得できたら表示し直す
+    if get_model_catalog().is_refreshing:
+        _wait_for_model_catalog()
+
+
+@st.fragment(run_every=CATALOG_POLL_SECONDS)
+def _wait_for_model_catalog():
+    """モデル一覧の取得が終わったら、アプリ全体を再実行して選択肢を更新する。"""
+    if get_model_catalog().is_refreshing:
+        st.caption("モデル一覧を取得中...")
+    else:
+        st.rerun()
+
+
+def render_chat_settings(available_models: List[str]):
+    """サイドバーの生成の設定（コンテキスト管理・比較モード・応答キャッシュ）。"""
+    # 送信する履歴の絞り込み方法（「自動」はモデルごとに既定のポリシーを選ぶ）
+    st.sidebar.selectbox(
+        "コンテキスト管理",
+        options=POLICY_CHOICES,
+        key="context_policy_choice",
+        help="API に送る会話履歴の絞り込み方法です。長い会話の入力トークンを削減します。",
+    )
+
+    # 比較モード: 同じ履歴を選択したモデルにも同時に送り、応答を並べて比較する
+    st.sidebar.multiselect(
+        "比較するモデル（比較モード）",
+        options=available_models,
+        key="compare_models",
+        max_selections=3,
+        help=(
+            "選択したモデルにも同じ会話を同時に送り、応答・レイテンシ・トークン数・料金を比較します。"
+            "会話は上で選択したモデルの応答で続きます。"
+        ),
+    )
+
+    # 応答キャッシュの設定とヒット・ミスの回数
+    render_response_cache_controls()
+
+
+def collect_finished_generation() -> Optional[GenerationJob]:
+    """
+    生成が終わっていれば結果を履歴に追加する（生成中はバックグラウンドで続行）。
+    まだ生成中のジョブがあればそれを返す。
+    """
+    job = active_generation()
+    if job is None or not generation_finished(job):
+        return job
+    fields = collect_generation(job)
+    content = fields.pop("content")
+    if content:
+        # AI レスポンスのメタ情報（比較モードの結果は "comparisons" に入る）
+        append_message(
+            Message(
+                "assistant",
+                content,
+                timestamp=get_jst_now_str(),
+                model=job.model,
+                meta=fields,
+            ),
+            conversation_id=job.conversation_id,
+            parent=job.parent_id,
+        )
+    return None
+
+
+def start_reply(use_response_cache: bool = True):
+    """表示中の履歴（最後は user メッセージ）への応答の生成を開始し、画面を再実行する。"""
+    # Claude API call（バックグラウンドで生成し、画面は再実行して進捗を表示する）
+    start_generation(
+        st.session_state["model"],
+        # 添付は参照からコンテンツブロックにする（変換済みのブロックは使い回される）
+        api_messages(session_history()),
+        policy_choice=st.session_state["context_policy_choice"],
+        conversation_id=st.session_state["conversation_id"],
+        compare_models=st.session_state["compare_models"],
+        parent_id=st.session_state["messages"][-1].id,
+        use_response_cache=use_response_cache,
+    )
+    st.rerun()
+
+
+def message_actions(disabled: bool):
+    """
+    履歴の各メッセージの操作（user は編集、assistant は再生成、分岐があれば切り替え）を
+    描画する関数を返す。会話がまだ保存されていなければ None。
+    編集・再生成は元のメッセージを残したまま、親メッセージから新しい分岐を作る。
+    """
+    conversation_id = st.session_state.get("conversation_id")
+    store = get_conversation_store()
+    conversation = store.get_conversation(conversation_id) if conversation_id else None
+    if conversation is None:
+        return None
+
+    def render_actions(msg: Message):
+        if msg.id is None or msg.parent is None:
+            return
+        if st.session_state.get("editing_message") == msg.id:
+            _render_edit_form(msg, disabled)
+            return
+        # 分岐していない会話では兄弟は無いので、ストアに問い合わせない
+        siblings = store.siblings(conversation_id, msg.parent) if conversation["branched"] else []
+        cols = st.columns([1, 1, 1, 2, 5], vertical_alignment="center")
+        if len(siblings) > 1:
+            index = siblings.index(msg.id)
+            if cols[0].button("◀", key=f"branch_prev_{msg.id}", disabled=disabled or index == 0):
+                set_active_message(siblings[index - 1], latest_leaf=True)
+                st.rerun()
+            cols[1].caption(f"{index + 1} / {len(siblings)}")
+            if cols[2].button(
+                "▶", key=f"branch_next_{msg.id}", disabled=disabled or index == len(siblings) - 1
+            ):
+                set_active_message(siblings[index + 1], latest_leaf=True)
+                st.rerun()
+        if msg.role == "user":
+            if cols[3].button("編集", key=f"edit_{msg.id}", disabled=disabled):
+                st.session_state["editing_message"] = msg.id
+                st.rerun()
+        elif cols[3].button("再生成", key=f"regenerate_{msg.id}", disabled=disabled):
+            # 同じ履歴を送り直すので、先頭部分はプロンプトキャッシュから読まれる
+            set_active_message(msg.parent)
+            start_reply(use_response_cache=False)
+
+    return render_actions
+
+
+def _render_edit_form(msg: Message, disabled: bool):
+    """user メッセージの編集欄。送信すると、編集した発言と応答を新しい分岐として追加する。"""
+    text = st.text_area("メッセージを編集", value=msg.content, key=f"edit_text_{msg.id}")
+    col1, col2 = st.columns(2)
+    if col1.button(
+        "送信", type="primary", key=f"edit_submit_{msg.id}", disabled=disabled or not text.strip()
+    ):
+        st.session_state["editing_message"] = None
+        set_active_message(msg.parent)
+        # 添付はそのまま引き継ぐ（ストアの参照なので、ファイルは複製しない）
+        attachments = msg.get("attachments")
+        append_message(
+            Message(
+                "user",
+                text,
+                timestamp=get_jst_now_str(),
+                meta={"attachments": attachments} if attachments else None,
+            )
+        )
+        start_reply()
+    if col2.button("キャンセル", key=f"edit_cancel_{msg.id}"):
+        st.session_state["editing_message"] = None
+        st.rerun()
+
+
+def render_chat(job: Optional[GenerationJob]):
+    """履歴・計測パネル・生成中の部分応答・入力欄を表示し、入力があれば生成を開始する。"""
+    # display chat history（会話ストアに退避した古いメッセージは展開時に読み込む）
+    render_chat_history(
+        st.session_state.messages,
+        offset=st.session_state.get("history_offset", 0),
+        load_older=load_older_messages,
+        focus=st.session_state.get("history_focus"),
+        message_actions=message_actions(disabled=job is not None),
+        # 検索で開いた別の分岐のメッセージは、ボタンを押したときだけその分岐に切り替える
+        show_branch=lambda seq: set_active_message(seq, latest_leaf=True),
+    )
+
+    # サイドバー: レイテンシ・トークン数の計測結果
+    render_telemetry_panel()
+
+    # 生成中の部分応答と停止ボタン
+    if job is not None:
+        render_generation_progress()
+
+    # user input（生成中は次の入力を受け付けない。画像・PDF・テキストを添付できる）
+    prompt = st.chat_input(
+        "メッセージを入力してください",
+        disabled=job is not None,
+        accept_file="multiple",
+        file_type=ATTACHMENT_FILE_TYPES,
+    )
+    if prompt and (prompt.text or prompt.files):
+        # 添付はストアに保存し、メッセージには参照だけを持たせる
+        try:
+            attachments = [
+                get_attachment_store().put(f.getvalue(), f.name) for f in prompt.files
+            ]
+        except AttachmentError as e:
+            st.error(f"❌ {e}")
+            return
+        # ユーザー投稿を保存（JST 時刻付き）
+        user_msg = Message(
+            "user",
+            prompt.text,
+            timestamp=get_jst_now_str(),
+            meta={"attachments": attachments} if attachments else None,
+        )
+        append_message(user_msg)
+        render_message(user_msg)
+        start_reply()
+
+
+def run_chat_page():
+    """モデル選択・会話履歴・生成設定・チャット本体をまとめて表示する。"""
+    render_page_header()
+    # anthropic の import は画面の表示と並行して済ませる（最初の送信を待たせない）
+    preload_in_background()
+    # セッション状態を読む前に、このセッションを登録して退避済みの履歴を読み戻す
+    track_session()
+    init_session()
+
+    # サイドバー: 保存済みの会話の一覧・検索・読み込みと、保存ファイルの一括取り込み
+    render_conversation_sidebar(make_greeting)
+    render_ingest_panel()
+
+    # 利用可能なモデル一覧を取得
+    available_models = get_available_models()
+    render_model_selector(available_models)
+    render_chat_settings(available_models)
+
+    job = collect_finished_generation()
+    # メモリ上の履歴を上限までに抑え、サーバー全体の状況を表示する
+    enforce_memory_budget()
+    render_session_memory_status()
+
+    render_chat(job)
+
+
+def render_save_area():
+    """チャットの保存ボタン。"""
+    if st.session_state.messages:
+        # 保存用データはボタンが押されたときにだけ（退避した分も含めて）作成する
+        render_export_buttons(export_history)
+    else:
+        st.info("保存できるチャット履歴がまだありません。")
+
+
+def render_restore_area():
+    """保存したファイル（JSON / JSONL / Markdown / アーカイブ）からチャットを復元する。"""
+    uploaded_file = st.file_uploader(
+        "保存したファイルをアップロードしてチャットを復元",
+        type=["json", "jsonl", "md", "chatarc"],
+        help="以前保存したチャット履歴のファイル（JSON / JSONL / Markdown / アーカイブ）を選択してください。",
+    )
+
+    # 最後に処理したファイルIDを追跡（同じファイルの再処理を防ぐ）
+    if "last_processed_file_id" not in st.session_state:
+        st.session_state["last_processed_file_id"] = None
+
+    if uploaded_file is None:
+        # ファイルがクリアされたら、処理済みフラグもクリア
+        st.session_state["last_processed_file_id"] = None
+        return
+
+    # ファイルIDを取得（Streamlitのファイルアップローダーはfile_id属性を持っている）
+    current_file_id = getattr(uploaded_file, "file_id", None)
+    if current_file_id is None:
+        # file_idがない場合は、ファイル名とサイズの組み合わせで識別
+        current_file_id = f"{uploaded_file.name}_{uploaded_file.size}"
+
+    # 既に処理済みのファイルの場合はスキップ（何も表示しない）
+    if st.session_state["last_processed_file_id"] == current_file_id:
+        return
+
+    # 読み込んだバイト数に応じて進捗を表示する（1% 刻みで更新）
+    progress_bar = st.progress(0.0, text="チャット履歴を読み込み中...")
+    last_progress = [0.0]
+
+    def show_progress(fraction):
+        if fraction - last_progress[0] >= 0.01 or fraction == 1.0:
+            last_progress[0] = fraction
+            progress_bar.progress(fraction, text="チャット履歴を読み込み中...")
+
+    try:
+        # メッセージ単位で解析しながら検証する（JSON / JSONL / Markdown）
+        loaded_messages = import_chat(
+            uploaded_file,
+            name=uploaded_file.name,
+            size=uploaded_file.size,
+            progress=show_progress,
+        )
+    except ChatImportError as e:
+        progress_bar.empty()
+        st.error(f"❌ {e}")
+        return
+    except Exception as e:
+        progress_bar.empty()
+        st.error(f"❌ エラーが発生しました: {e}")
+        return
+
+    # 復元実行
+    st.session_state["history_offset"] = 0
+    st.session_state["history_focus"] = None
+    bump_history_version()
+    # 以前の会話の要約は使えないので破棄する
+    st.session_state.pop("context_summary", None)
+
+    # モデル情報を復元（最初のassistantメッセージから取得）
+    for msg in loaded_messages:
+        if msg.role == "assistant" and msg.model:
+            st.session_state["model"] = msg.model
+            break
+
+    # 会話ストアに新しい会話として保存（以降はサイドバーから読み込める）
+    store = get_conversation_store()
+    st.session_state["conversation_id"] = store.create_conversation(
+        loaded_messages, model=st.session_state["model"]
+    )
+    # 分岐した会話は、最後のメッセージまでの分岐を表示する
+    st.session_state["messages"] = active_path(loaded_messages)
+
+    # 処理済みファイルIDを記録
+    st.session_state["last_processed_file_id"] = current_file_id
+
+    st.success(f"✅ チャット履歴を復元しました（{len(loaded_messages)}件のメッセージ）。")
+    st.rerun()  # 画面を再描画して復元された履歴を表示
@@ -0,0 +1,369 @@
+"""
+チャット履歴のコンパクトなアーカイブ形式（.chatarc）。
+JSON / Markdown の保存形式と相互に変換でき、メッセージは失われない。
+
+メッセージは 1 行 1 件の短いキーの JSONL にし、FRAME_MESSAGES 件ずつ独立に圧縮した
+フレームとして追記する（zstandard があれば zstd、無ければ gzip）。
+投稿時刻は UNIX 時刻の整数、モデル名は索引のモデル表の番号で持つ。
+ファイルの末尾には索引（各フレームの位置と件数、モデル表）とその位置を置くので、
+1 件のメッセージを読むのにその件を含むフレームだけを展開すればよい。
+
+    [ヘッダー][フレーム]...[フレーム][索引 JSON][索引の位置 8 バイト][フッター]
+
+追記では最後のフレームが埋まっていなければそのフレームだけを作り直し、
+それより前のフレームは展開せずにそのまま写す。追記は一時ファイルに書いてから置き換えるので、
+途中で中断しても元のアーカイブは壊れない。
+"""
+import argparse
+import bisect
+import calendar
+import gzip
+import io
+import json
+import os
+import re
+import struct
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+
+from chat_message import TIMESTAMP_FORMAT, Message
+from storage_paths import env_str
+
+ARCHIVE_MAGIC = b"CHATARC1\n"
+FOOTER_MAGIC = b"CHATIDX1"
+FORMAT_VERSION = 1
+# 1 フレームに入れるメッセージ数（1 件を読むときに展開する量の上限）
+FRAME_MESSAGES = 64
+# 追記のときに既存のフレームを写す単位（バイト）
+COPY_CHUNK_SIZE = 1024 * 1024
+# 投稿時刻の JST のずれ（秒）
+JST_OFFSET_SECONDS = 9 * 60 * 60
+
+# 保存形式のロールと短い記号
+ROLE_CODES = {"user": "u", "assistant": "a"}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+_TIMESTAMP = re.compile(r"^(\d{4})/(\d{2})/(\d{2}) (\d{2}):(\d{2}):(\d{2})$")
+
+
+class ArchiveError(ValueError):
+    """アーカイブとして読めない（壊れている・対応していない圧縮形式）。"""
+
+
+def _codecs() -> dict:
+    """使える圧縮形式の {名前: (圧縮, 展開)}。zstd は zstandard がある場合だけ。"""
+    codecs = {
+        "gzip": (lambda data: gzip.compress(data, compresslevel=6, mtime=0), gzip.decompress),
+    }
+    try:
+        import zstandard
+    except ImportError:
+        return codecs
+    codecs["zstd"] = (
+        lambda data: zstandard.ZstdCompressor(level=10).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+    return codecs
+
+
+CODECS = _codecs()
+DEFAULT_CODEC = env_str("CHAT_ARCHIVE_CODEC", "zstd" if "zstd" in CODECS else "gzip")
+if DEFAULT_CODEC not in CODECS:
+    # zstd を指定していても zstandard が無い場合などは、どこでも読める gzip にする
+    DEFAULT_CODEC = "gzip"
+
+
+def _to_epoch(timestamp: str) -> Optional[int]:
+    """JST の "yyyy/mm/dd hh:mm:ss" を UNIX 時刻にする。この形式でなければ None。"""
+    match = _TIMESTAMP.match(timestamp)
+    if match is None:
+        return None
+    try:
+        # 存在しない日時（2 月 30 日など）は文字列のまま残す
+        parts = datetime(*map(int, match.groups())).timetuple()
+    except ValueError:
+        return None
+    return calendar.timegm(parts) - JST_OFFSET_SECONDS
+
+
+def _from_epoch(epoch: int) -> str:
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(epoch + JST_OFFSET_SECONDS))
+
+
+def _encode_record(data: dict, models: dict) -> bytes:
+    """
+    保存形式の dict（Message.to_dict()）を 1 行にする。models はモデル名 -> 番号で、
+    新しいモデル名はここで番号を振って追加する。
+    """
+    data = dict(data)
+    record = {"r": ROLE_CODES[data.pop("role")], "c": data.pop("content")}
+    timestamp = data.pop("timestamp", None)
+    if timestamp is not None:
+        epoch = _to_epoch(timestamp)
+        if epoch is None:
+            record["T"] = timestamp
+        else:
+            record["t"] = epoch
+    # assistant の model: None は復元時に to_dict() が補うので、名前があるときだけ持つ
+    model = data.pop("model", None)
+    if model is not None:
+        record["m"] = models.setdefault(model, len(models))
+    if "id" in data:
+        record["i"] = data.pop("id")
+        record["p"] = data.pop("parent", None)
+    if data:
+        record["x"] = data
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def _decode_record(line: bytes, models: List[str]) -> dict:
+    """1 行を保存形式の dict（Message.from_dict() に渡せる形）に戻す。"""
+    try:
+        return _decode_fields(json.loads(line), models)
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        raise ArchiveError(f"メッセージを読み込めません（{e!r}）。")
+
+
+def _decode_fields(record: dict, models: List[str]) -> dict:
+    data = {"role": ROLE_NAMES[record["r"]], "content": record["c"]}
+    if "t" in record:
+        data["timestamp"] = _from_epoch(record["t"])
+    elif "T" in record:
+        data["timestamp"] = record["T"]
+    if "m" in record:
+        data["model"] = models[record["m"]]
+    if "i" in record:
+        data["id"] = record["i"]
+        data["parent"] = record["p"]
+    data.update(record.get("x") or {})
+    return data
+
+
+class ChatArchive:
+    """
+    アーカイブの読み出し。fp はシーク可能なバイナリのファイルオブジェクト。
+    開いたときに読むのは末尾の索引だけで、メッセージは読むときにフレーム単位で展開する。
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+        self.index = _read_index(fp)
+        self.models = self.index["models"]
+        codec = self.index["codec"]
+        if codec not in CODECS:
+            raise ArchiveError(f"圧縮形式 {codec} に対応していません（zstandard が必要です）。")
+        self._decompress = CODECS[codec][1]
+        self._firsts = [frame[2] for frame in self.index["frames"]]
+        # 直前に展開したフレーム（続けて読む場合に展開し直さない）
+        self._cached = (None, None)
+
+    def __len__(self) -> int:
+        return self.index["count"]
+
+    def _frame_lines(self, number: int) -> List[bytes]:
+        if self._cached[0] == number:
+            return self._cached[1]
+        offset, length, _, _ = self.index["frames"][number]
+        self._fp.seek(offset)
+        try:
+            lines = self._decompress(self._fp.read(length)).splitlines()
+        except Exception as e:
+            # 圧縮形式ごとに例外の型が違うので、まとめてアーカイブの破損として扱う
+            raise ArchiveError(f"フレーム {number} を展開できません（{e}）。")
+        self._cached = (number, lines)
+        return lines
+
+    def read_dict(self, position: int) -> dict:
+        """position 番目（0 始まり）のメッセージを保存形式の dict で返す。"""
+        if not 0 <= position < len(self):
+            raise IndexError(f"{position} 番目のメッセージはありません（全 {len(self)} 件）。")
+        number = bisect.bisect_right(self._firsts, position) - 1
+        first = self._firsts[number]
+        return _decode_record(self._frame_lines(number)[position - first], self.models)
+
+    def read(self, position: int) -> Message:
+        """position 番目（0 始まり）のメッセージ。その件を含むフレームだけを展開する。"""
+        return Message.from_dict(self.read_dict(position))
+
+    def iter_dicts(self, on_frame=None) -> Iterator[dict]:
+        """
+        全メッセージを保存形式の dict で順に返す。
+        on_frame(読み終えたバイト位置) を指定すると、フレームを展開するたびに呼ぶ。
+        """
+        for number, (offset, length, _, _) in enumerate(self.index["frames"]):
+            lines = self._frame_lines(number)
+            if on_frame:
+                on_frame(offset + length)
+            for line in lines:
+                yield _decode_record(line, self.models)
+
+    def __iter__(self) -> Iterator[Message]:
+        return (Message.from_dict(data) for data in self.iter_dicts())
+
+
+def _read_index(fp) -> dict:
+    fp.seek(0)
+    if fp.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+        raise ArchiveError("アーカイブのヘッダーがありません。")
+    footer_size = 8 + len(FOOTER_MAGIC)
+    end = fp.seek(0, io.SEEK_END)
+    if end < len(ARCHIVE_MAGIC) + footer_size:
+        raise ArchiveError("アーカイブが途中で終わっています。")
+    fp.seek(end - footer_size)
+    footer = fp.read(footer_size)
+    if footer[8:] != FOOTER_MAGIC:
+        raise ArchiveError("アーカイブの索引がありません（書き込みが途中で終わっています）。")
+    (index_offset,) = struct.unpack("<Q", footer[:8])
+    fp.seek(index_offset)
+    try:
+        index = json.loads(fp.read(end - footer_size - index_offset))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ArchiveError("アーカイブの索引を読み込めません。")
+    if index.get("version") != FORMAT_VERSION:
+        raise ArchiveError(f"対応していないアーカイブのバージョンです（{index.get('version')}）。")
+    index["offset"] = index_offset
+    return index
+
+
+def _write_frames(fp, lines: List[bytes], index: dict, models: dict, compress):
+    """lines を FRAME_MESSAGES 件ずつ圧縮して fp の現在位置から書き、索引に追加する。"""
+    offset = fp.tell()
+    for start in range(0, len(lines), FRAME_MESSAGES):
+        chunk = lines[start:start + FRAME_MESSAGES]
+        data = compress(b"".join(chunk))
+        fp.write(data)
+        index["frames"].append([offset, len(data), index["count"], len(chunk)])
+        index["count"] += len(chunk)
+        offset += len(data)
+    index["models"] = sorted(models, key=models.get)
+    body = {k: v for k, v in index.items() if k != "offset"}
+    fp.write(json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    fp.write(struct.pack("<Q", offset) + FOOTER_MAGIC)
+
+
+def write_archive(messages: Iterable[Message], fp, codec: str = DEFAULT_CODEC):
+    """メッセージを新しいアーカイブとして fp（バイナリ、書き込み位置は先頭）に書く。"""
+    if codec not in CODECS:
+        raise ArchiveError(f"圧縮形式 {codec} に対応していません。")
+    models = {}
+    lines = [_encode_record(msg.to_dict(), models) for msg in messages]
+    fp.write(ARCHIVE_MAGIC)
+    index = {"version": FORMAT_VERSION, "codec": codec, "models": [], "frames": [], "count": 0}
+    _write_frames(fp, lines, index, models, CODECS[codec][0])
+
+
+def encode_archive(messages: Iterable[Message], codec: str = DEFAULT_CODEC) -> bytes:
+    """write_archive() の結果を bytes で返す（ダウンロード用）。"""
+    buffer = io.BytesIO()
+    write_archive(messages, buffer, codec)
+    return buffer.getvalue()
+
+
+def append_to_archive(path, messages: Iterable[Message], codec: str = DEFAULT_CODEC):
+    """
+    path のアーカイブにメッセージを追記する（無ければ作る）。
+    埋まっていない最後のフレームだけを作り直し、それより前のフレームはそのまま写す。
+    一時ファイルに書いてから置き換えるので、途中で失敗しても元のファイルは残る。
+    """
+    path = Path(path)
+    tmp_path = f"{path}.tmp"
+    try:
+        if not path.exists():
+            with open(tmp_path, "wb") as dst:
+                write_archive(messages, dst, codec)
+                _sync(dst)
+        else:
+            with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+                _append_frames(src, dst, messages)
+                _sync(dst)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _append_frames(src, dst, messages: Iterable[Message]):
+    """src のアーカイブに messages を足したアーカイブを dst に書く。"""
+    archive = ChatArchive(src)
+    index = archive.index
+    models = {name: i for i, name in enumerate(archive.models)}
+    compress = CODECS[index["codec"]][0]
+    lines = []
+    keep = index.pop("offset")
+    if index["frames"] and index["frames"][-1][3] < FRAME_MESSAGES:
+        lines = archive._frame_lines(len(index["frames"]) - 1)
+        lines = [line + b"\n" for line in lines]
+        offset, _, first, _ = index["frames"].pop()
+        index["count"] = first
+        keep = offset
+    lines += [_encode_record(msg.to_dict(), models) for msg in messages]
+    # 埋まっているフレームまで（ヘッダーを含む）は展開せずにそのまま写す
+    src.seek(0)
+    remaining = keep
+    while remaining:
+        chunk = src.read(min(remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise ArchiveError("アーカイブが途中で終わっています。")
+        dst.write(chunk)
+        remaining -= len(chunk)
+    _write_frames(dst, lines, index, models, compress)
+
+
+def _sync(fp):
+    # 置き換える前にディスクへ書き出す（置き換えた後に中身が失われないように）
+    fp.flush()
+    os.fsync(fp.fileno())
+
+
+def is_archive(head: bytes) -> bool:
+    return head.startswith(ARCHIVE_MAGIC)
+
+
+def main(argv=None):
+    from chat_export import write_chat_export
+    from chat_import import ChatImportError, import_chat
+
+    parser = argparse.ArgumentParser(description="チャット履歴のアーカイブ（.chatarc）の変換")
+    commands = parser.add_subparsers(dest="command", required=True)
+    pack = commands.add_parser("pack", help="JSON / JSONL / Markdown をアーカイブにする")
+    pack.add_argument("source", type=Path)
+    pack.add_argument("-o", "--output", type=Path, required=True)
+    pack.add_argument("--append", action="store_true", help="既存のアーカイブに追記する")
+    pack.add_argument("--codec", choices=sorted(CODECS), default=DEFAULT_CODEC)
+    unpack = commands.add_parser("unpack", help="アーカイブを JSON / Markdown に戻す")
+    unpack.add_argument("source", type=Path)
+    unpack.add_argument("-o", "--output", type=Path, required=True)
+    show = commands.add_parser("show", help="アーカイブの 1 件のメッセージを表示する")
+    show.add_argument("source", type=Path)
+    show.add_argument("position", type=int, help="0 始まりの位置")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "pack":
+            data = args.source.read_bytes()
+            messages = import_chat(io.BytesIO(data), name=args.source.name, size=len(data))
+            if args.append:
+                append_to_archive(args.output, messages, args.codec)
+            else:
+                args.output.write_bytes(encode_archive(messages, args.codec))
+            size = args.output.stat().st_size
+            print(f"{len(messages)} messages -> {args.output} ({size} bytes)")
+        elif args.command == "unpack":
+            fmt = "md" if args.output.suffix.lower() in (".md", ".markdown") else "json"
+            with open(args.source, "rb") as src, open(args.output, "w", encoding="utf-8") as dst:
+                write_chat_export(iter(ChatArchive(src)), dst, fmt)
+        else:
+            with open(args.source, "rb") as src:
+                data = ChatArchive(src).read_dict(args.position)
+            print(json.dumps(data, ensure_ascii=False, indent=2))
+    except (ArchiveError, ChatImportError, IndexError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
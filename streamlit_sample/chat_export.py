@@ -0,0 +1,151 @@
+"""
+チャット履歴のエクスポート（JSON / Markdown / アーカイブ）。
+保存用データはボタンが押されたときに選んだ形式の分だけ作成し、履歴のバージョン番号に対して
+メモ化する。大きな履歴でも中間の巨大な文字列を作らないよう、メッセージ単位のチャンクで組み立てる。
+"""
+import io
+import json
+from datetime import datetime
+from typing import Callable, Iterable, Iterator
+
+import streamlit as st
+
+from chat_archive import encode_archive
+from chat_message import Message
+from telemetry import span
+
+# 保存形式: キー -> (表示名, 拡張子, MIME タイプ)
+EXPORT_FORMATS = {
+    "json": ("JSON", ".json", "application/json"),
+    "md": ("Markdown", ".md", "text/markdown"),
+    "archive": ("アーカイブ（圧縮）", ".chatarc", "application/octet-stream"),
+}
+
+# Markdown の各見出しの次に置くメタ情報のコメント（インポート時に元のメッセージを復元する）
+MARKDOWN_META_PREFIX = "<!-- chat-message "
+MARKDOWN_META_SUFFIX = " -->"
+
+
+def format_chat_as_markdown(messages: Iterable[Message]) -> str:
+    """チャット履歴を Markdown 文字列に整形する。"""
+    return "".join(iter_chat_markdown_chunks(messages))
+
+
+def iter_chat_markdown_chunks(messages: Iterable[Message]) -> Iterator[str]:
+    """
+    format_chat_as_markdown() と同じ内容をメッセージ単位のチャンクで返す。
+    見出しの次の行には、本文の文字数と本文以外のキーを HTML コメントで埋め込む
+    （表示には影響せず、インポート時にロスレスで復元するために使う）。
+    """
+    yield "# Chat Transcript\n"
+    for msg in messages:
+        role = msg.role
+        content = msg.content
+        timestamp = msg.timestamp or ""
+        model_name = msg.model
+
+        if role == "user":
+            header = f"## User ({timestamp})"
+        else:
+            if model_name:
+                header = f"## Assistant - {model_name} ({timestamp})"
+            else:
+                header = f"## Assistant ({timestamp})"
+
+        meta = {
+            "length": len(content),
+            "message": {k: v for k, v in msg.to_dict().items() if k != "content"},
+        }
+        meta_line = (
+            MARKDOWN_META_PREFIX
+            + json.dumps(meta, ensure_ascii=False)
+            + MARKDOWN_META_SUFFIX
+        )
+        yield f"\n{header}\n{meta_line}\n\n{content}\n"
+
+
+def iter_chat_json_chunks(messages: Iterable[Message]) -> Iterator[str]:
+    """
+    `json.dumps([m.to_dict() for m in messages], ensure_ascii=False, indent=2)` と
+    同じ内容をメッセージ単位のチャンクで返す。
+    """
+    first = True
+    for msg in messages:
+        body = json.dumps(msg.to_dict(), ensure_ascii=False, indent=2).replace("\n", "\n  ")
+        yield ("[\n  " if first else ",\n  ") + body
+        first = False
+    yield "[]" if first else "\n]"
+
+
+def encode_chunks(chunks: Iterable[str]) -> bytes:
+    """
+    チャンクを UTF-8 でエンコードしながら 1 つのバッファに書き込む
+    （全体の文字列や、エンコードしたチャンクのリストを作らない）。
+    """
+    buffer = io.BytesIO()
+    for chunk in chunks:
+        buffer.write(chunk.encode("utf-8"))
+    return buffer.getvalue()
+
+
+def write_chat_export(messages, fp, fmt: str = "json"):
+    """テキストファイル fp にエクスポートをチャンク単位で書き込む（fmt は json / md）。"""
+    if fmt == "json":
+        chunks = iter_chat_json_chunks(messages)
+    else:
+        chunks = iter_chat_markdown_chunks(messages)
+    for chunk in chunks:
+        fp.write(chunk)
+
+
+def encode_export(messages: Iterable[Message], fmt: str) -> bytes:
+    """保存用ファイルの内容（fmt は EXPORT_FORMATS のキー）。"""
+    if fmt == "archive":
+        return encode_archive(messages)
+    if fmt == "md":
+        return encode_chunks(iter_chat_markdown_chunks(messages))
+    return encode_chunks(iter_chat_json_chunks(messages))
+
+
+def render_export_buttons(load_messages: Callable[[], Iterable[Message]]):
+    """
+    保存ボタンを表示する。
+    保存用データは「保存用ファイルを作成」を押したときに、選んだ形式の分だけ
+    load_messages() で履歴を取得して作り、履歴のバージョン（`history_version`）と形式が
+    変わるまでセッションに保持する（session_memory のメモリ上限に数え、超えれば破棄される）。
+    """
+    fmt = st.radio(
+        "保存形式",
+        list(EXPORT_FORMATS),
+        format_func=lambda key: EXPORT_FORMATS[key][0],
+        horizontal=True,
+        key="chat_export_format",
+    )
+    version = st.session_state.get("history_version", 0)
+    export = st.session_state.get("chat_export")
+
+    if export is None or export["version"] != version or export["format"] != fmt:
+        st.session_state.pop("chat_export", None)
+        if not st.button(
+            "保存用ファイルを作成",
+            help="現在のチャット履歴から、選んだ形式の保存用ファイルを作成します。",
+        ):
+            return
+        with st.spinner("保存用ファイルを作成中..."), span("export_build"):
+            export = {
+                "version": version,
+                "format": fmt,
+                "file_stem": f"chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                "data": encode_export(load_messages(), fmt),
+            }
+        st.session_state["chat_export"] = export
+
+    label, suffix, mime = EXPORT_FORMATS[fmt]
+    st.download_button(
+        label=f"このチャットを {label} で保存",
+        data=export["data"],
+        file_name=f"{export['file_stem']}{suffix}",
+        mime=mime,
+        # ダウンロードで再実行しない（再実行でメモリ上限を超えた保存用データが破棄されないように）
+        on_click="ignore",
+    )
@@ -0,0 +1,180 @@
+"""
+チャット履歴の描画レイヤー。
+直近のメッセージだけを常に描画し、それより古いメッセージは折りたたんで
+ユーザーが展開したときにページ単位で描画する。
+"""
+import streamlit as st
+
+from chat_message import Message
+from claude_streaming import format_cache_usage, format_latency
+from telemetry import span
+
+# 常に描画する直近メッセージ数
+RECENT_MESSAGE_COUNT = 30
+# 古いメッセージを展開したときに 1 ページで描画する件数
+OLDER_PAGE_SIZE = 50
+# 検索結果から開いたメッセージと一緒に表示する前後の件数
+FOCUS_CONTEXT = 1
+
+
+def build_caption(msg: Message) -> str:
+    """メッセージからキャプション文字列を返す（メタ情報が無ければ空文字）。"""
+    caption_parts = []
+    if msg.get("stopped", False):
+        caption_parts.append("生成を途中で停止")
+    if msg.get("cached", False):
+        caption_parts.append("キャッシュから応答")
+    continuations = msg.get("continuations")
+    if continuations:
+        caption_parts.append(f"上限に達したため続きを自動生成（{continuations} 回）")
+    if msg.role != "user" and msg.model:
+        caption_parts.append(f"モデル: {msg.model}")
+    if msg.timestamp:
+        caption_parts.append(f"投稿時刻 (JST): {msg.timestamp}")
+    latency_str = format_latency(
+        {"latency": msg.get("latency"), "time_to_first_token": msg.get("time_to_first_token")}
+    )
+    if latency_str:
+        caption_parts.append(latency_str)
+    cache_str = format_cache_usage(
+        {
+            "cache_read_input_tokens": msg.get("cache_read_input_tokens"),
+            "cache_creation_input_tokens": msg.get("cache_creation_input_tokens"),
+        }
+    )
+    if cache_str:
+        caption_parts.append(cache_str)
+    cost_usd = msg.get("cost_usd")
+    if cost_usd is not None:
+        caption_parts.append(f"料金: ${cost_usd:.4f}")
+    context_policy = msg.get("context_policy")
+    if context_policy:
+        tokens_saved = msg.get("tokens_saved")
+        if tokens_saved:
+            caption_parts.append(
+                f"コンテキスト: {context_policy}（{tokens_saved:,} トークン削減）"
+            )
+        else:
+            caption_parts.append(f"コンテキスト: {context_policy}")
+    return " / ".join(caption_parts)
+
+
+def render_message(msg: Message, actions=None):
+    """
+    1 メッセージを chat_message コンテナに描画する。
+    actions(msg) を指定すると、本文の下に編集・再生成などの操作を描画する。
+    """
+    caption = build_caption(msg)
+    role = "user" if msg.role == "user" else "assistant"
+    with st.chat_message(role):
+        st.markdown(msg.content)
+        if caption:
+            st.caption(caption)
+        if msg.get("attachments"):
+            # 中身は読み込まず、参照の名前と大きさだけを表示する
+            names = (f"📎 {a['name']}（{a['size'] / 1024:,.0f} KB）" for a in msg.meta["attachments"])
+            st.caption("添付: " + "、".join(names))
+        if msg.get("comparisons"):
+            _render_comparisons(msg)
+        if actions is not None:
+            actions(msg)
+
+
+def _render_comparisons(msg: Message):
+    """比較モードで得た他のモデルの応答を、選択中のモデルの応答と並べて表示する。"""
+    comparisons = msg.meta["comparisons"]
+    with st.expander(f"モデル比較（{len(comparisons) + 1}モデル）"):
+        entries = [msg.to_dict()] + comparisons
+        for column, entry in zip(st.columns(len(entries)), entries):
+            with column:
+                st.caption(f"モデル: {entry['model']}")
+                if entry.get("error"):
+                    st.error(entry["error"])
+                    continue
+                entry_msg = Message.from_dict(
+                    {**entry, "role": "assistant", "model": None, "timestamp": None}
+                )
+                caption = build_caption(entry_msg)
+                st.markdown(entry_msg.content)
+                tokens = (
+                    f"入力 {entry.get('input_tokens', 0):,}"
+                    f" / 出力 {entry.get('output_tokens', 0):,} トークン"
+                )
+                st.caption(" / ".join(part for part in (caption, tokens) if part))
+
+
+@span("history_render")
+def render_chat_history(
+    messages,
+    recent_count=RECENT_MESSAGE_COUNT,
+    page_size=OLDER_PAGE_SIZE,
+    offset=0,
+    load_older=None,
+    focus=None,
+    message_actions=None,
+    show_branch=None,
+):
+    """
+    チャット履歴を描画する。
+    直近 recent_count 件は常に描画し、それより古いものは
+    「過去のメッセージを表示」トグルが有効なときだけ page_size 件ずつ描画する。
+    先頭の offset 件がメモリに無い（会話ストアに退避済みの）場合は、
+    load_older(start, end) でその範囲のメッセージを読み込んで描画する。
+    focus（検索で開いたメッセージの {"seq", "position", "messages", "on_active_branch"}）を
+    指定すると、そのメッセージと前後を先頭に表示する。表示中の分岐に無いメッセージなら
+    show_branch(seq) でその分岐に切り替えるボタンを置く。
+    message_actions(msg) は各メッセージの操作（編集・再生成・分岐の切り替え）を描画する。
+    """
+    if focus is not None:
+        _render_focus(focus, show_branch)
+
+    older_count = max(offset + len(messages) - recent_count, 0)
+
+    if older_count:
+        if "history_older_pages" not in st.session_state:
+            st.session_state["history_older_pages"] = 1
+
+        show_older = st.toggle(
+            f"過去のメッセージを表示（{older_count}件）",
+            key="history_show_older",
+        )
+        if show_older:
+            shown = min(st.session_state["history_older_pages"] * page_size, older_count)
+            if shown < older_count:
+                if st.button(f"さらに表示（残り {older_count - shown}件）"):
+                    st.session_state["history_older_pages"] += 1
+                    st.rerun()
+            start = older_count - shown
+            if start < offset:
+                for msg in load_older(start, min(older_count, offset)):
+                    render_message(msg, message_actions)
+            for msg in messages[max(start - offset, 0):max(older_count - offset, 0)]:
+                render_message(msg, message_actions)
+            st.divider()
+
+    for msg in messages[max(older_count - offset, 0):]:
+        render_message(msg, message_actions)
+
+
+def _render_focus(focus, show_branch=None):
+    """検索結果から開いたメッセージを、前後のメッセージと一緒に枠で囲んで表示する。"""
+    with st.container(border=True):
+        if focus["on_active_branch"]:
+            st.caption(f"検索で開いたメッセージ（{focus['position'] + 1}件目）")
+        else:
+            st.caption(
+                f"検索で開いたメッセージ（別の分岐の {focus['position'] + 1}件目）"
+            )
+        for msg in focus["messages"]:
+            render_message(msg)
+        col1, col2 = st.columns(2)
+        if col1.button("閉じる", key="history_focus_close"):
+            st.session_state["history_focus"] = None
+            st.rerun()
+        if (
+            show_branch is not None
+            and not focus["on_active_branch"]
+            and col2.button("この分岐を表示", key="history_focus_branch")
+        ):
+            show_branch(focus["seq"])
+            st.rerun()
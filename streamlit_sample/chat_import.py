@@ -0,0 +1,412 @@
+"""
+チャット履歴のインポート（JSON / JSONL / Markdown / アーカイブ）。
+ファイル全体を一度に読み込まず、メッセージ単位で解析しながらスキーマを検証する。
+エラーは何番目のメッセージか、ファイルの何行目・何列目かを付けて報告する。
+"""
+import io
+import json
+import re
+from typing import Callable, Iterator, List, Optional
+
+from attachment_store import MEDIA_TYPES
+from chat_archive import ArchiveError, ChatArchive, is_archive
+from chat_export import MARKDOWN_META_PREFIX, MARKDOWN_META_SUFFIX
+from chat_message import Message
+
+# 1 回に読み込む文字数
+READ_CHUNK_SIZE = 64 * 1024
+
+VALID_ROLES = ("user", "assistant")
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+_MARKDOWN_HEADER = re.compile(
+    r"^## (?:User|Assistant(?: - (?P<model>.+))?) \((?P<timestamp>.*)\)$"
+)
+
+
+class ChatImportError(ValueError):
+    """インポートの失敗。index は 0 始まりのメッセージ番号、line / column は 1 始まり。"""
+
+    def __init__(self, reason, index=None, line=None, column=None):
+        self.reason = reason
+        self.index = index
+        self.line = line
+        self.column = column
+        super().__init__(self.describe())
+
+    def describe(self) -> str:
+        location = []
+        if self.index is not None:
+            location.append(f"{self.index + 1}番目のメッセージ")
+        if self.line is not None:
+            location.append(f"{self.line}行目 {self.column}列")
+        if location:
+            return f"{' / '.join(location)}: {self.reason}"
+        return self.reason
+
+
+def validate_message(msg, index, line=None, column=None) -> dict:
+    """メッセージ 1 件のスキーマを検証し、問題なければそのまま返す。"""
+
+    def fail(reason):
+        raise ChatImportError(reason, index, line, column)
+
+    if not isinstance(msg, dict):
+        fail("メッセージが JSON オブジェクトではありません。")
+    if "role" not in msg or "content" not in msg:
+        fail("'role' または 'content' がありません。")
+    if msg["role"] not in VALID_ROLES:
+        fail(f"'role' が無効です（{msg['role']!r}）。")
+    if not isinstance(msg["content"], str):
+        fail("'content' が文字列ではありません。")
+    if msg.get("timestamp") is not None and not isinstance(msg["timestamp"], str):
+        fail("'timestamp' が文字列ではありません。")
+    if msg.get("model") is not None and not isinstance(msg["model"], str):
+        fail("'model' が文字列ではありません。")
+    for key in ("id", "parent"):
+        value = msg.get(key)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+            fail(f"'{key}' が整数ではありません。")
+    attachments = msg.get("attachments")
+    if attachments is not None:
+        # 添付は中身ではなく、添付ファイルのストアの参照として保存されている
+        if not isinstance(attachments, list):
+            fail("'attachments' がリストではありません。")
+        for ref in attachments:
+            if (
+                not isinstance(ref, dict)
+                or not _SHA256.match(str(ref.get("sha256", "")))
+                or not isinstance(ref.get("name"), str)
+                or ref.get("media_type") not in MEDIA_TYPES.values()
+                or not isinstance(ref.get("size"), int)
+            ):
+                fail("'attachments' の参照が無効です。")
+    return msg
+
+
+def validate_tree(messages: List[Message]):
+    """
+    分岐した会話（id / parent 付き）の構造を検証する。id は全メッセージに必要で重複せず、
+    parent はそれより前のメッセージの id でなければならない。
+    """
+    if all(m.id is None for m in messages):
+        return
+    seen = set()
+    for index, msg in enumerate(messages):
+        if msg.id is None:
+            raise ChatImportError("'id' がありません（分岐した会話のファイル）。", index)
+        if msg.id in seen:
+            raise ChatImportError(f"'id' が重複しています（{msg.id}）。", index)
+        if msg.parent is not None and msg.parent not in seen:
+            raise ChatImportError(
+                f"'parent' がそれより前のメッセージを指していません（{msg.parent}）。", index
+            )
+        seen.add(msg.id)
+
+
+class _Reader:
+    """テキストストリームをチャンク単位で読み、読み終えた位置の行・列を数える。"""
+
+    def __init__(self, stream, on_read=None):
+        self._stream = stream
+        self._on_read = on_read
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self._line = 1
+        self._line_start = 0  # buffer 上で現在の行が始まる位置（負になり得る）
+
+    def fill(self) -> bool:
+        """バッファに追加で読み込む。EOF なら False。"""
+        if self.eof:
+            return False
+        chunk = self._stream.read(READ_CHUNK_SIZE)
+        if self._on_read:
+            self._on_read()
+        if not chunk:
+            self.eof = True
+            return False
+        # 消費済みの部分を捨ててから追加する
+        self._line_start -= self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def skip_whitespace(self) -> str:
+        """空白を読み飛ばし、次の文字を返す（EOF なら空文字）。"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.advance(self.pos + 1)
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def advance(self, new_pos):
+        consumed = self.buffer[self.pos:new_pos]
+        newlines = consumed.count("\n")
+        if newlines:
+            self._line += newlines
+            self._line_start = self.pos + consumed.rindex("\n") + 1
+        self.pos = new_pos
+
+    def location(self, offset=0):
+        """現在位置から offset 文字先の (行, 列)。"""
+        target = self.pos + offset
+        ahead = self.buffer[self.pos:target]
+        newlines = ahead.count("\n")
+        if newlines:
+            return self._line + newlines, target - (self.pos + ahead.rindex("\n"))
+        return self._line, target - self._line_start + 1
+
+
+def iter_json_messages(stream, on_read=None) -> Iterator[dict]:
+    """JSON 配列 `[{...}, {...}]` をメッセージ単位で解析しながら返す。"""
+    decoder = json.JSONDecoder()
+    reader = _Reader(stream, on_read)
+
+    if reader.skip_whitespace() != "[":
+        line, column = reader.location()
+        raise ChatImportError(
+            "無効なJSON形式です。メッセージの配列である必要があります。", None, line, column
+        )
+    reader.advance(reader.pos + 1)
+
+    index = 0
+    while True:
+        ch = reader.skip_whitespace()
+        if ch == "]" and index == 0:
+            reader.advance(reader.pos + 1)
+            break
+        if not ch:
+            line, column = reader.location()
+            raise ChatImportError("JSON が途中で終わっています。", index, line, column)
+
+        while True:
+            try:
+                msg, end = decoder.raw_decode(reader.buffer, reader.pos)
+                break
+            except json.JSONDecodeError as e:
+                # オブジェクトがバッファの途中で切れている場合は追加で読み込んで再試行する
+                if reader.fill():
+                    continue
+                line, column = reader.location(e.pos - reader.pos)
+                raise ChatImportError(
+                    f"JSONの解析に失敗しました: {e.msg}", index, line, column
+                )
+
+        line, column = reader.location()
+        yield validate_message(msg, index, line, column)
+        reader.advance(end)
+        index += 1
+
+        ch = reader.skip_whitespace()
+        if ch == ",":
+            reader.advance(reader.pos + 1)
+        elif ch == "]":
+            reader.advance(reader.pos + 1)
+            break
+        else:
+            line, column = reader.location()
+            raise ChatImportError("',' または ']' が必要です。", index, line, column)
+
+    if reader.skip_whitespace():
+        line, column = reader.location()
+        raise ChatImportError("配列の後に余分なデータがあります。", None, line, column)
+
+
+def iter_jsonl_messages(stream, on_read=None) -> Iterator[dict]:
+    """JSONL（1 行 1 メッセージ）を 1 行ずつ解析しながら返す。"""
+    index = 0
+    for line_no, line in enumerate(stream, start=1):
+        if on_read:
+            on_read()
+        if not line.strip():
+            continue
+        try:
+            msg = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ChatImportError(
+                f"JSONの解析に失敗しました: {e.msg}", index, line_no, e.colno
+            )
+        yield validate_message(msg, index, line_no, 1)
+        index += 1
+
+
+def iter_markdown_messages(stream, on_read=None) -> Iterator[dict]:
+    """
+    `format_chat_as_markdown()` の出力を解析しながら返す。
+    見出しの次にメタ情報のコメント行がある場合は、本文の文字数とメタ情報から
+    元のメッセージをそのまま復元する（ロスレス）。
+    コメントの無い古い形式は、見出しから role / model / timestamp を読み取り、
+    次の見出しまでを本文とみなす。
+    """
+    index = 0
+    line_no = 0
+    lines = iter(stream)
+
+    def next_line():
+        nonlocal line_no
+        line = next(lines, None)
+        if line is not None:
+            line_no += 1
+            if on_read:
+                on_read()
+        return line
+
+    line = next_line()
+    # 先頭のタイトル行と空行を読み飛ばす
+    while line is not None and (
+        not line.strip() or line.startswith("# Chat Transcript")
+    ):
+        line = next_line()
+
+    while line is not None:
+        header = _MARKDOWN_HEADER.match(line.rstrip("\r\n"))
+        if header is None:
+            raise ChatImportError("メッセージの見出しが必要です。", index, line_no, 1)
+        header_line = line_no
+        role = "user" if line.startswith("## User") else "assistant"
+
+        line = next_line()
+        if line is not None and line.startswith(MARKDOWN_META_PREFIX):
+            meta_json = line.rstrip("\r\n")[
+                len(MARKDOWN_META_PREFIX):-len(MARKDOWN_META_SUFFIX)
+            ]
+            try:
+                meta = json.loads(meta_json)
+                length = meta["length"]
+                msg = dict(meta["message"])
+            except (json.JSONDecodeError, KeyError, TypeError):
+                raise ChatImportError("メタ情報を解析できません。", index, line_no, 1)
+
+            line = next_line()  # 見出しと本文の間の空行
+            # 本文は末尾の改行 1 文字を含めて length + 1 文字（必ず行末で終わる）
+            body, body_len = [], 0
+            while body_len < length + 1:
+                line = next_line()
+                if line is None:
+                    raise ChatImportError("本文が途中で終わっています。", index, line_no, 1)
+                body.append(line)
+                body_len += len(line)
+            if body_len != length + 1:
+                raise ChatImportError(
+                    "本文の長さがメタ情報と一致しません。", index, line_no, 1
+                )
+            msg["content"] = "".join(body)[:length]
+            line = next_line()  # 次の見出しの前の空行
+        else:
+            msg = {"role": role, "timestamp": header.group("timestamp")}
+            if role == "assistant":
+                msg["model"] = header.group("model")
+            if line is not None and line.strip():
+                raise ChatImportError("見出しの後に空行が必要です。", index, line_no, 1)
+            body = []
+            line = next_line()
+            while line is not None and not _MARKDOWN_HEADER.match(line.rstrip("\r\n")):
+                body.append(line)
+                line = next_line()
+            # 本文の後ろの改行と、次の見出しの前の空行を除く
+            if line is not None and body and not body[-1].strip():
+                body.pop()
+            msg["content"] = "".join(body)
+            if msg["content"].endswith("\n"):
+                msg["content"] = msg["content"][:-1]
+
+        yield validate_message(msg, index, header_line, 1)
+        index += 1
+        # 次の見出しまでの空行を読み飛ばす
+        while line is not None and not line.strip():
+            line = next_line()
+
+
+def detect_format(name: str, head: bytes) -> str:
+    """ファイル名と先頭のバイト列から形式（json / jsonl / md / archive）を判定する。"""
+    if is_archive(head):
+        return "archive"
+    lower = name.lower()
+    if lower.endswith(".jsonl"):
+        return "jsonl"
+    if lower.endswith(".md") or lower.endswith(".markdown"):
+        return "md"
+    if lower.endswith(".json"):
+        return "json"
+    stripped = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    if stripped.startswith(b"["):
+        return "json"
+    if stripped.startswith(b"{"):
+        return "jsonl"
+    return "md"
+
+
+def _progress_reporter(progress, size):
+    """
+    読み込んだバイト位置を受け取り、progress(割合) を呼ぶ関数。
+    progress か size が無ければ（進捗を出さない場合は）None。
+    """
+    if not (progress and size):
+        return None
+    return lambda position: progress(min(position / size, 1.0))
+
+
+def import_chat(
+    binary_file,
+    name: str = "",
+    size: Optional[int] = None,
+    progress: Optional[Callable[[float], None]] = None,
+) -> List[Message]:
+    """
+    アップロードされたファイル（バイナリのファイルオブジェクト）からメッセージを読み込む。
+    progress を指定すると、読み込んだバイト数の割合（0.0〜1.0）で呼び出す。
+    失敗した場合は ChatImportError を送出する。
+    """
+    binary_file.seek(0)
+    head = binary_file.read(64)
+    binary_file.seek(0)
+    fmt = detect_format(name, head)
+
+    report = _progress_reporter(progress, size)
+    on_read = (lambda: report(binary_file.tell())) if report else None
+
+    if fmt == "archive":
+        messages = _import_archive(binary_file, report)
+    else:
+        messages = _import_text(binary_file, fmt, on_read)
+    if not messages:
+        raise ChatImportError("チャット履歴が空です。")
+    validate_tree(messages)
+    if progress:
+        progress(1.0)
+    return messages
+
+
+def _import_archive(binary_file, on_frame) -> List[Message]:
+    """
+    アーカイブ（.chatarc）を読み込む。on_frame を指定すると、フレームを展開するたびに
+    読み終えたバイト位置で呼ぶ（進捗の更新）。
+    """
+    try:
+        archive = ChatArchive(binary_file)
+        return [
+            Message.from_dict(validate_message(data, index))
+            for index, data in enumerate(archive.iter_dicts(on_frame))
+        ]
+    except ArchiveError as e:
+        raise ChatImportError(str(e))
+
+
+def _import_text(binary_file, fmt, on_read) -> List[Message]:
+    stream = io.TextIOWrapper(binary_file, encoding="utf-8-sig", newline="")
+    try:
+        if fmt == "json":
+            parsed = iter_json_messages(stream, on_read)
+        elif fmt == "jsonl":
+            parsed = iter_jsonl_messages(stream, on_read)
+        else:
+            parsed = iter_markdown_messages(stream, on_read)
+        return [Message.from_dict(m) for m in parsed]
+    except UnicodeDecodeError as e:
+        raise ChatImportError(f"UTF-8 として読み込めません（{e.start} バイト目）。")
+    finally:
+        # アップロードされたファイル自体は閉じない
+        stream.detach()
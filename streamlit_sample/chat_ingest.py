@@ -0,0 +1,133 @@
+"""
+保存したチャットファイル（JSON / JSONL / Markdown / アーカイブ）の一括取り込み。
+取り込んだ会話は会話ストアに保存され、全文検索の対象になる。
+同じ内容のファイルは 2 回取り込まない（ファイルの SHA-256 で判定する）。
+
+コマンドラインからも実行できる:
+    python streamlit_sample/chat_ingest.py ingest chat_*.json
+    python streamlit_sample/chat_ingest.py search キーワード
+"""
+import argparse
+import hashlib
+import io
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import streamlit as st
+
+from chat_import import ChatImportError, import_chat
+from chat_message import JST, TIMESTAMP_FORMAT
+from conversation_store import (
+    STORE_FILE_NAME,
+    ConversationStore,
+    get_conversation_store,
+)
+from storage_paths import get_data_dir
+
+
+def _last_timestamp(messages) -> Optional[float]:
+    """最後のメッセージの投稿時刻（JST の文字列）を UNIX 時刻にする。読めなければ None。"""
+    for msg in reversed(messages):
+        if msg.timestamp:
+            try:
+                parsed = datetime.strptime(msg.timestamp, TIMESTAMP_FORMAT)
+            except ValueError:
+                return None
+            return parsed.replace(tzinfo=JST).timestamp()
+    return None
+
+
+def ingest_file(store: ConversationStore, name: str, data: bytes) -> Tuple[str, str]:
+    """
+    1 ファイルを取り込み、(結果, 詳細) を返す。結果は
+    "imported"（詳細は会話 ID）/ "skipped"（取り込み済み）/ "error"（詳細は理由）のいずれか。
+    """
+    try:
+        messages = import_chat(io.BytesIO(data), name=name, size=len(data))
+    except ChatImportError as e:
+        return "error", str(e)
+    model = next((m.model for m in messages if m.role == "assistant" and m.model), None)
+    conversation_id = store.import_conversation(
+        messages,
+        sha256=hashlib.sha256(data).hexdigest(),
+        name=name,
+        model=model,
+        updated_at=_last_timestamp(messages),
+    )
+    if conversation_id is None:
+        return "skipped", ""
+    return "imported", conversation_id
+
+
+def ingest_files(
+    store: ConversationStore, files: Iterable[Tuple[str, bytes]]
+) -> List[Tuple[str, str, str]]:
+    """(ファイル名, 内容) を順に取り込み、(ファイル名, 結果, 詳細) のリストを返す。"""
+    return [(name, *ingest_file(store, name, data)) for name, data in files]
+
+
+def render_ingest_panel():
+    """サイドバーの一括取り込み。結果の件数と、読み込めなかったファイルの理由を表示する。"""
+    with st.sidebar.expander("保存ファイルの一括取り込み"):
+        uploaded_files = st.file_uploader(
+            "保存したファイル（複数可）",
+            type=["json", "jsonl", "md", "chatarc"],
+            accept_multiple_files=True,
+            key="ingest_files",
+            help=(
+                "取り込んだ会話は「メッセージを検索」で検索できます。"
+                "同じファイルは 1 回だけ取り込まれます。"
+            ),
+        )
+        if not uploaded_files or not st.button("取り込む", use_container_width=True):
+            return
+        store = get_conversation_store()
+        progress_bar = st.progress(0.0, text="取り込み中...")
+        results = []
+        for i, uploaded_file in enumerate(uploaded_files):
+            name = uploaded_file.name
+            results.append((name, *ingest_file(store, name, uploaded_file.getvalue())))
+            progress_bar.progress((i + 1) / len(uploaded_files), text="取り込み中...")
+        progress_bar.empty()
+
+        counts = {
+            kind: sum(r[1] == kind for r in results)
+            for kind in ("imported", "skipped", "error")
+        }
+        st.success(
+            f"{counts['imported']}件を取り込みました"
+            f"（取り込み済み {counts['skipped']}件 / エラー {counts['error']}件）。"
+        )
+        for name, kind, detail in results:
+            if kind == "error":
+                st.error(f"{name}: {detail}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="保存したチャットファイルの取り込みと検索")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser("ingest", help="ファイルを会話ストアに取り込む")
+    ingest.add_argument("paths", nargs="+", type=Path)
+    search = commands.add_parser("search", help="会話ストアのメッセージを検索する")
+    search.add_argument("query", nargs="+")
+    search.add_argument("--role", choices=["user", "assistant"])
+    search.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    store = ConversationStore(get_data_dir() / STORE_FILE_NAME)
+    if args.command == "ingest":
+        results = ingest_files(store, ((p.name, p.read_bytes()) for p in args.paths))
+        for name, kind, detail in results:
+            print(f"{kind:9} {name} {detail}".rstrip())
+        return 1 if any(kind == "error" for _, kind, _ in results) else 0
+
+    for hit in store.search_messages(" ".join(args.query), role=args.role, limit=args.limit):
+        print(f"{hit['conversation_id']}#{hit['seq']} [{hit['role']}] {hit['title']}")
+        print("    " + hit["snippet"].replace("\n", " "))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+チャットのメッセージモデル。
+セッション・会話ストア・エクスポート / インポートはこのクラスでメッセージを受け渡す。
+"""
+from datetime import timedelta, timezone
+from typing import List, Optional
+
+# スロットとして持つ項目（それ以外のキーは meta に入れる）
+MESSAGE_FIELDS = ("role", "content", "timestamp", "model", "id", "parent")
+# 投稿時刻（timestamp）は日本時間のこの形式の文字列
+JST = timezone(timedelta(hours=9))
+TIMESTAMP_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+
+class Message:
+    """
+    チャットの 1 メッセージ。
+    role / content / timestamp / model はスロットに持ち、レイテンシやトークン数などの
+    その他のメタ情報は meta（無ければ None）に持つ。dict よりメモリが小さく、
+    保存形式への変換は to_dict() / from_dict() で行う。
+
+    会話を分岐させた場合のために、会話の中での ID と親メッセージの ID も持つ
+    （会話ストアでは連番、保存ファイルでは分岐がある場合だけ書き出す。無ければ None）。
+    分岐した会話は木になり、各分岐は共通の先頭部分のメッセージを共有する。
+    """
+
+    __slots__ = ("role", "content", "timestamp", "model", "meta", "id", "parent")
+
+    def __init__(
+        self,
+        role: str,
+        content: str,
+        timestamp: Optional[str] = None,
+        model: Optional[str] = None,
+        meta: Optional[dict] = None,
+        id: Optional[int] = None,
+        parent: Optional[int] = None,
+    ):
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+        self.model = model
+        self.meta = meta or None
+        self.id = id
+        self.parent = parent
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Message":
+        """保存形式の dict（JSON の 1 要素）から作る。"""
+        meta = {k: v for k, v in data.items() if k not in MESSAGE_FIELDS}
+        return cls(
+            data["role"],
+            data["content"],
+            data.get("timestamp"),
+            data.get("model"),
+            meta,
+            data.get("id"),
+            data.get("parent"),
+        )
+
+    def to_dict(self) -> dict:
+        """
+        保存形式の dict にする。timestamp は無ければ省き、
+        assistant の model は None でも残す（どのモデルの応答でもないことを示す）。
+        id / parent は id がある場合だけ書き出す。
+        """
+        data = {"role": self.role, "content": self.content}
+        if self.timestamp is not None:
+            data["timestamp"] = self.timestamp
+        if self.model is not None or self.role == "assistant":
+            data["model"] = self.model
+        if self.id is not None:
+            data["id"] = self.id
+            data["parent"] = self.parent
+        if self.meta:
+            data.update(self.meta)
+        return data
+
+    def to_api(self) -> dict:
+        """Messages API に送る {"role", "content"}。"""
+        return {"role": self.role, "content": self.content}
+
+    def get(self, key: str, default=None):
+        """スロットの項目とメタ情報を同じように読み出す。"""
+        if key in MESSAGE_FIELDS:
+            value = getattr(self, key)
+            return default if value is None else value
+        if self.meta is None:
+            return default
+        return self.meta.get(key, default)
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Message({self.to_dict()!r})"
+
+
+def active_path(messages: List[Message]) -> List[Message]:
+    """
+    分岐した会話（id / parent 付きのメッセージのリスト）のうち、最後のメッセージから
+    親をたどった経路（先頭から順）。id が無ければ分岐の無い会話として、そのまま返す。
+    """
+    if not messages or messages[-1].id is None:
+        return list(messages)
+    by_id = {m.id: m for m in messages}
+    path = []
+    node = messages[-1]
+    while node is not None:
+        path.append(node)
+        node = by_id.get(node.parent) if node.parent is not None else None
+    path.reverse()
+    return path
@@ -0,0 +1,143 @@
+"""
+"Claude API" にプロンプトをまとめて送るバッチ実行のページ。
+プロンプトの JSONL / CSV、または保存したチャットファイルをアップロードして実行し、
+結果は会話ごとの JSON（チャットの保存と同じ形式）として保存する。
+実行はバックグラウンドで続くので、画面を閉じても止まらない（中断したものは再開できる）。
+"""
+import io
+import time
+import zipfile
+
+import streamlit as st
+
+from batch_runner import (
+    BatchInputError,
+    BatchRun,
+    batch_runs_dir,
+    get_batch_manager,
+    load_batch_items,
+)
+from chat_app import DEFAULT_MODEL
+from claude_client import get_client
+from model_catalog import get_available_models
+from rate_limiter import get_rate_limiter
+
+MODE_LABELS = {
+    "auto": "自動（Message Batches API、使えなければ並列実行）",
+    "batches": "Message Batches API（料金が半額、結果は最大 24 時間後）",
+    "workers": "並列実行（すぐに結果が出る）",
+}
+# 実行中の一覧の更新間隔（秒）
+REFRESH_SECONDS = 2
+
+
+def start_run(run: BatchRun):
+    get_batch_manager().start(run, get_client(), get_rate_limiter())
+
+
+def render_new_run_form():
+    uploaded_files = st.file_uploader(
+        "プロンプト（JSONL / CSV）または保存したチャット（JSON / JSONL / Markdown / アーカイブ）",
+        type=["jsonl", "csv", "json", "md", "chatarc"],
+        accept_multiple_files=True,
+        help=(
+            "JSONL / CSV は \"prompt\" 列（任意で \"id\" 列）の 1 行が 1 つの会話になります。"
+            "保存したチャットはファイルごとに 1 つの会話で、"
+            "最後の user メッセージへの応答を生成します。"
+        ),
+    )
+    available_models = get_available_models()
+    default_index = (
+        available_models.index(DEFAULT_MODEL) if DEFAULT_MODEL in available_models else 0
+    )
+    model = st.selectbox("モデル", options=available_models, index=default_index)
+    max_tokens = st.number_input("max_tokens", min_value=1, value=1000, step=100)
+    mode = st.radio("実行方法", options=list(MODE_LABELS), format_func=MODE_LABELS.get)
+
+    if not st.button("実行", type="primary", disabled=not uploaded_files):
+        return
+    items, used = [], set()
+    try:
+        for uploaded_file in uploaded_files:
+            items += load_batch_items(uploaded_file.name, uploaded_file.getvalue(), used)
+        run_dir = batch_runs_dir() / time.strftime("batch_%Y%m%d_%H%M%S")
+        run = BatchRun.create(run_dir, items, model, int(max_tokens), mode)
+    except BatchInputError as e:
+        st.error(f"❌ {e}")
+        return
+    start_run(run)
+    st.success(f"✅ {len(items)}件の会話の実行を開始しました。")
+
+
+def _zip_outputs(run: BatchRun) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path in sorted(run.output_dir.glob("*.json")):
+            zf.write(path, path.name)
+    return buffer.getvalue()
+
+
+def render_run(run: BatchRun):
+    manager = get_batch_manager()
+    running = manager.is_running(run.run_dir)
+    done, total, errors = run.progress()
+    with st.container(border=True):
+        st.markdown(f"**{run.run_dir.name}**（{run.model} / max_tokens {run.max_tokens}）")
+        st.progress(done / total if total else 1.0, text=f"{done} / {total} 件完了")
+        status = manager.status(run.run_dir)
+        if status and status["error"]:
+            st.error(status["error"])
+        elif status:
+            st.caption(status["text"])
+        if errors:
+            with st.expander(f"エラー（{errors}件、再開すると送り直します）"):
+                for item_id, message in run.state["errors"].items():
+                    st.text(f"{item_id}: {message}")
+
+        col1, col2 = st.columns(2)
+        with col1:
+            if running:
+                if st.button("停止", key=f"stop_{run.run_dir.name}"):
+                    manager.stop(run.run_dir)
+            elif done < total and st.button("再開", key=f"resume_{run.run_dir.name}"):
+                start_run(run)
+                st.rerun()
+        with col2:
+            # ZIP は押したときにだけ作る（実行中は完了した分だけが入る）。
+            # 一覧は定期的に再描画されるので、作った ZIP はセッションに保持する
+            zip_key = f"batch_zip_{run.run_dir.name}"
+            if done and st.button("結果を ZIP にまとめる", key=f"zip_{run.run_dir.name}"):
+                st.session_state[zip_key] = _zip_outputs(run)
+            if zip_key in st.session_state:
+                st.download_button(
+                    "ZIP をダウンロード",
+                    data=st.session_state[zip_key],
+                    file_name=f"{run.run_dir.name}.zip",
+                    mime="application/zip",
+                    key=f"download_{run.run_dir.name}",
+                )
+        st.caption(f"結果の保存先: {run.output_dir}")
+
+
+@st.fragment(run_every=REFRESH_SECONDS)
+def render_runs():
+    run_dirs = sorted(
+        (p for p in batch_runs_dir().glob("*") if (p / "batch.json").exists()),
+        reverse=True,
+    )
+    if not run_dirs:
+        st.caption("まだ実行はありません。")
+    for run_dir in run_dirs:
+        render_run(BatchRun(run_dir))
+
+
+# Streamlit UI
+st.set_page_config(page_title="Claude Batch Sample", page_icon=":robot:")
+st.title("Claude Batch Sample")
+
+st.subheader("新しい実行")
+render_new_run_form()
+
+st.markdown("---")
+st.subheader("実行の一覧")
+render_runs()
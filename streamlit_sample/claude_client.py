@@ -0,0 +1,76 @@
+"""
+Anthropic クライアントの共有ファクトリ。
+`st.cache_resource` でプロセスに 1 つだけ生成し、全セッション・全再実行で
+同じコネクションプール（HTTP keep-alive / TLS セッション）を使い回す。
+
+接続数・タイムアウト・リトライ回数は環境変数で調整できる。
+
+anthropic（と httpx）の import は重いので、モジュールの import 時には行わない。
+最初に API を呼ぶとき（get_client()）まで遅らせ、起動直後の画面の表示を待たせない。
+preload_in_background() で、画面の表示と並行して import を済ませておける。
+"""
+import os
+import threading
+
+import streamlit as st
+
+from rate_limiter import get_rate_limiter
+from storage_paths import env_float, env_int
+
+_preload_started = threading.Event()
+
+
+def _import_sdk():
+    import anthropic  # noqa: F401
+    import httpx  # noqa: F401
+
+
+def preload_in_background():
+    """anthropic の import をデーモンスレッドで開始する（プロセスで 1 回だけ）。"""
+    if _preload_started.is_set():
+        return
+    _preload_started.set()
+    threading.Thread(target=_import_sdk, name="anthropic-preload", daemon=True).start()
+
+
+@st.cache_resource(show_spinner=False)
+def get_client():
+    """プロセス共有の Anthropic クライアントを返す（初回呼び出し時のみ生成）。"""
+    # import はここまで遅らせる（別スレッドで import 中なら、終わるのを待つ）
+    import httpx
+    from anthropic import Anthropic, DefaultHttpxClient
+
+    # .env は storage_paths の import 時に読み込み済み
+
+    # Setup proxies via environment variables（httpx は HTTP(S)_PROXY を参照する）
+    http_proxy = os.getenv("HTTP_PROXY")
+    https_proxy = os.getenv("HTTPS_PROXY")
+    if http_proxy:
+        os.environ["HTTP_PROXY"] = http_proxy
+    if https_proxy:
+        os.environ["HTTPS_PROXY"] = https_proxy
+
+    limits = httpx.Limits(
+        max_connections=env_int("ANTHROPIC_MAX_CONNECTIONS", 20),
+        max_keepalive_connections=env_int("ANTHROPIC_MAX_KEEPALIVE_CONNECTIONS", 10),
+        keepalive_expiry=env_float("ANTHROPIC_KEEPALIVE_EXPIRY", 60.0),
+    )
+    timeout = httpx.Timeout(
+        env_float("ANTHROPIC_TIMEOUT", 600.0),
+        connect=env_float("ANTHROPIC_CONNECT_TIMEOUT", 5.0),
+    )
+
+    return Anthropic(
+        api_key=os.getenv("ANTHROPIC_API_KEY"),
+        timeout=timeout,
+        # Messages API の呼び出し（応答の生成・要約）は rate_limiter でリトライするので
+        # SDK のリトライを無効にして呼ぶ。別のレート制限を持つトークン数カウント API と
+        # モデル一覧の取得は、ここで設定した SDK の指数バックオフ（ジッター付き）でリトライする
+        max_retries=env_int("ANTHROPIC_MAX_RETRIES", 2),
+        http_client=DefaultHttpxClient(
+            limits=limits,
+            timeout=timeout,
+            # Messages API のレート制限のヘッダーをプロセス共通のレート制限に反映する
+            event_hooks={"response": [get_rate_limiter().observe_response]},
+        ),
+    )
@@ -3,65 +3,55 @@
 "claude-sonnet-4-20250514" を使用。
 """
 import streamlit as st
-from anthropic import Anthropic
-import os
-from dotenv import load_dotenv
 
-# load environment variables
-load_dotenv()
+from chat_app import GREETING, render_page_header
+from chat_history_view import render_chat_history, render_message
+from chat_message import Message
+from claude_client import preload_in_background
+from generation_worker import (
+    active_generation,
+    collect_generation,
+    render_generation_progress,
+    start_generation,
+)
+from telemetry import render_telemetry_panel
 
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-HTTP_PROXY = os.getenv("HTTP_PROXY")
-HTTPS_PROXY = os.getenv("HTTPS_PROXY")
-
-# Setup proxies via environment variables
-if HTTP_PROXY:
-    os.environ["HTTP_PROXY"] = HTTP_PROXY
-if HTTPS_PROXY:
-    os.environ["HTTPS_PROXY"] = HTTPS_PROXY
-
-# Initialize Anthropic client
-client = Anthropic(api_key=ANTHROPIC_API_KEY)
+MODEL = "claude-sonnet-4-20250514"
 
 # Streamlit UI
-st.set_page_config(page_title="Claude Chat Sample", page_icon=":robot:")
-st.title("Claude Chat Sample")
+render_page_header()
+# anthropic の import は画面の表示と並行して済ませる
+preload_in_background()
 
 # session state for chat history
 if "messages" not in st.session_state:
-    st.session_state["messages"] = [
-        {
-            "role": "assistant",
-            "content": "こんにちは！何かお手伝いできますか？"
-        }
-    ]
+    st.session_state["messages"] = [Message("assistant", GREETING)]
+
+# 生成が終わっていれば結果を履歴に追加する（生成中はバックグラウンドで続行）
+job = active_generation()
+if job is not None and job.finished:
+    fields = collect_generation(job)
+    content = fields.pop("content")
+    if content:
+        st.session_state.messages.append(Message("assistant", content, meta=fields))
+    job = None
 
 # display chat history
-for msg in st.session_state.messages:
-    if msg["role"] == "user":
-        st.chat_message("user").write(msg["content"])
-    else:
-        st.chat_message("assistant").write(msg["content"])
+render_chat_history(st.session_state.messages)
+
+# サイドバー: レイテンシ・トークン数の計測結果
+render_telemetry_panel()
 
-# user input
-if prompt := st.chat_input("メッセージを入力してください"):
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    st.chat_message("user").write(prompt)
+# 生成中の部分応答と停止ボタン
+if job is not None:
+    render_generation_progress()
 
-    # Claude API call
-    with st.chat_message("assistant"):
-        with st.spinner("考え中..."):
-            response = client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=1000,
-                messages=[
-                    {"role": m["role"], "content": m["content"]}
-                    for m in st.session_state.messages
-                ],
-            )
-            reply = response.content[0].text
+# user input（生成中は次の入力を受け付けない）
+if prompt := st.chat_input("メッセージを入力してください", disabled=job is not None):
+    user_msg = Message("user", prompt)
+    st.session_state.messages.append(user_msg)
+    render_message(user_msg)
 
-            st.write(reply)
-            st.session_state.messages.append(
-                {"role": "assistant", "content": reply}
-            )
+    # Claude API call（バックグラウンドで生成し、画面は再実行して進捗を表示する）
+    start_generation(MODEL, [m.to_api() for m in st.session_state.messages])
+    st.rerun()
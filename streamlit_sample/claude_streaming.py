@@ -0,0 +1,89 @@
+"""
+Claude API のストリーミング応答を受信するヘルパー。
+バックグラウンドのワーカースレッドから呼び出し、差分はコールバックで受け取る。
+"""
+import time
+
+
+def run_stream(client, request, on_text=None, should_stop=None):
+    """
+    `client.messages.stream()` で応答を受け取り、差分ごとに on_text(text) を呼ぶ。
+    request には `request_builder.build_messages_request()` の戻り値を渡す。
+    should_stop() が True を返した時点で受信を打ち切り、そこまでの部分応答を返す。
+
+    戻り値は (reply, metrics, stopped)。reply は応答テキスト、
+    metrics は最初のトークンまでの時間と全体のレイテンシ（秒）、入出力トークン数、
+    プロンプトキャッシュの読み込み・書き込みトークン数、stop_reason、
+    SDK が行ったリトライ回数を持つ dict。
+    """
+    started = time.perf_counter()
+    first_token_at = None
+    chunks = []
+    stopped = False
+
+    with client.messages.stream(**request) as stream:
+        for text in stream.text_stream:
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            chunks.append(text)
+            if on_text:
+                on_text(text)
+            if should_stop and should_stop():
+                stopped = True
+                break
+
+        if stopped:
+            # 途中で打ち切った場合は、そこまでに受信したスナップショットを使う
+            message = stream.current_message_snapshot
+            reply = "".join(chunks)
+        else:
+            message = stream.get_final_message()
+            reply = stream.get_final_text()
+        # SDK はリトライのたびにリクエストヘッダーの x-stainless-retry-count を増やす
+        retries = stream.response.request.headers.get("x-stainless-retry-count", "0")
+
+    usage = message.usage
+
+    finished = time.perf_counter()
+    metrics = {
+        "time_to_first_token": (
+            round(first_token_at - started, 3) if first_token_at is not None else None
+        ),
+        "latency": round(finished - started, 3),
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "cache_read_input_tokens": usage.cache_read_input_tokens or 0,
+        "cache_creation_input_tokens": usage.cache_creation_input_tokens or 0,
+        "stop_reason": message.stop_reason,
+        "retries": int(retries) if retries.isdigit() else 0,
+    }
+    return reply, metrics, stopped
+
+
+def total_input_tokens(metrics) -> int:
+    """キャッシュ分を含めた入力トークン数（usage.input_tokens はキャッシュ分を含まない）。"""
+    return (
+        metrics["input_tokens"]
+        + metrics.get("cache_read_input_tokens", 0)
+        + metrics.get("cache_creation_input_tokens", 0)
+    )
+
+
+def format_latency(msg) -> str:
+    """メッセージ dict に記録されたレイテンシをキャプション用の文字列にする（無ければ空文字）。"""
+    latency = msg.get("latency")
+    if latency is None:
+        return ""
+    ttft = msg.get("time_to_first_token")
+    if ttft is None:
+        return f"応答時間: {latency:.2f}秒"
+    return f"応答時間: {latency:.2f}秒（初回トークン {ttft:.2f}秒）"
+
+
+def format_cache_usage(msg) -> str:
+    """プロンプトキャッシュの読み込み・書き込みトークン数をキャプション用の文字列にする。"""
+    cache_read = msg.get("cache_read_input_tokens")
+    cache_write = msg.get("cache_creation_input_tokens")
+    if not cache_read and not cache_write:
+        return ""
+    return f"キャッシュ: 読込 {cache_read or 0:,} / 書込 {cache_write or 0:,} トークン"
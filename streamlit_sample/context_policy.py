@@ -0,0 +1,250 @@
+"""
+API 呼び出し前に会話履歴を絞り込む「コンテキストポリシー」。
+全履歴をそのまま送るのではなく、スライディングウィンドウ・トークン上限・
+古いターンの要約のいずれかで送信するメッセージを決める。
+要約の API 呼び出しも、rate_limiter を渡すと応答の生成と同じレート制限を通す。
+トークン数カウント API は Messages API とは別のレート制限なので、レート制限を通さずに
+SDK のリトライに任せる。
+"""
+from dataclasses import dataclass
+from typing import List, Optional
+
+from model_catalog import get_model_catalog
+from rate_limiter import estimate_input_tokens
+from request_builder import content_length, content_text
+
+# 要約メッセージの前置き
+SUMMARY_PREFIX = "（これまでの会話の要約）\n"
+SUMMARY_ACK = "承知しました。要約の内容を踏まえて会話を続けます。"
+
+
+@dataclass
+class ContextResult:
+    """ポリシー適用結果。tokens_saved は削減できたと見積もった入力トークン数。"""
+
+    messages: List[dict]
+    policy: str
+    original_tokens: Optional[int] = None
+    sent_tokens: Optional[int] = None
+
+    @property
+    def tokens_saved(self) -> int:
+        if self.original_tokens is None or self.sent_tokens is None:
+            return 0
+        return max(self.original_tokens - self.sent_tokens, 0)
+
+
+def _call_api(client, rate_limiter, func, input_tokens=0, output_tokens=0):
+    """
+    func(client) で API を 1 回呼ぶ。rate_limiter を指定すると、応答の生成と同じ
+    レート制限の順番待ちとリトライを通す（その場合 SDK のリトライは無効にする）。
+    """
+    if rate_limiter is None:
+        return func(client)
+    client = client.with_options(max_retries=0)
+    return rate_limiter.run(lambda: func(client), input_tokens, output_tokens)
+
+
+def count_tokens(client, model: str, messages: List[dict]) -> Optional[int]:
+    """トークン数カウント API で入力トークン数を数える。失敗時は None。"""
+    try:
+        response = client.messages.count_tokens(model=model, messages=messages)
+    except Exception:
+        return None
+    return response.input_tokens
+
+
+def _starts_with_user(messages: List[dict]) -> List[dict]:
+    """先頭が user メッセージになるように、先頭の assistant メッセージを落とす。"""
+    start = 0
+    while start < len(messages) - 1 and messages[start]["role"] != "user":
+        start += 1
+    return messages[start:]
+
+
+class FullHistoryPolicy:
+    """全履歴をそのまま送る（従来の動作）。"""
+
+    name = "全履歴"
+
+    def apply(self, client, model, messages, state, rate_limiter=None) -> ContextResult:
+        return ContextResult(messages=messages, policy=self.name)
+
+
+class SlidingWindowPolicy:
+    """直近 max_messages 件だけを送る。"""
+
+    name = "スライディングウィンドウ"
+
+    def __init__(self, max_messages: int = 40):
+        self.max_messages = max_messages
+
+    def apply(self, client, model, messages, state, rate_limiter=None) -> ContextResult:
+        if len(messages) <= self.max_messages:
+            return ContextResult(messages=messages, policy=self.name)
+        window = _starts_with_user(messages[-self.max_messages:])
+        return ContextResult(
+            messages=window,
+            policy=self.name,
+            original_tokens=count_tokens(client, model, messages),
+        )
+
+
+class TokenBudgetPolicy:
+    """
+    入力トークン数が budget_tokens 以下になるまで古いメッセージを落とす。
+    トークン数はトークン数カウント API で数え、文字数から削る件数を見積もる。
+    """
+
+    name = "トークン上限"
+
+    def __init__(self, budget_tokens: int, max_rounds: int = 3):
+        self.budget_tokens = budget_tokens
+        self.max_rounds = max_rounds
+
+    def apply(self, client, model, messages, state, rate_limiter=None) -> ContextResult:
+        original = count_tokens(client, model, messages)
+        if original is None or original <= self.budget_tokens:
+            return ContextResult(
+                messages=messages,
+                policy=self.name,
+                original_tokens=original,
+                sent_tokens=original,
+            )
+
+        trimmed, tokens = messages, original
+        for _ in range(self.max_rounds):
+            # 1 文字あたりのトークン数から、落とすべき文字数を見積もる
+            chars = sum(content_length(m["content"]) for m in trimmed) or 1
+            excess_chars = (tokens - self.budget_tokens) * chars / tokens
+            dropped_chars, start = 0, 0
+            while start < len(trimmed) - 1 and dropped_chars < excess_chars:
+                dropped_chars += content_length(trimmed[start]["content"])
+                start += 1
+            trimmed = _starts_with_user(trimmed[start:])
+            tokens = count_tokens(client, model, trimmed)
+            if tokens is None or tokens <= self.budget_tokens or len(trimmed) <= 1:
+                break
+
+        return ContextResult(
+            messages=trimmed,
+            policy=self.name,
+            original_tokens=original,
+            sent_tokens=tokens,
+        )
+
+
+class SummarizingPolicy:
+    """
+    直近 keep_recent 件より古いターンを要約して 1 往復のメッセージに置き換える。
+    要約は summarize_every 件ごとにまとめて更新し、前回の要約に新しく古くなった
+    ターンを足して作り直す（毎ターン要約 API を呼ばないため）。
+    """
+
+    name = "要約"
+
+    def __init__(
+        self, keep_recent: int = 20, summarize_every: int = 10, max_tokens: int = 1000
+    ):
+        self.keep_recent = keep_recent
+        self.summarize_every = summarize_every
+        self.max_tokens = max_tokens
+
+    def apply(self, client, model, messages, state, rate_limiter=None) -> ContextResult:
+        boundary = len(messages) - self.keep_recent
+        # 要約範囲は summarize_every 件単位で進める
+        boundary -= boundary % self.summarize_every
+        if boundary <= 0:
+            return ContextResult(messages=messages, policy=self.name)
+        # 残すメッセージが user から始まるよう、境界の assistant の応答は要約に含める
+        # （残す側から落とすと、要約にも送信するメッセージにも入らなくなる）
+        while boundary < len(messages) - 1 and messages[boundary]["role"] != "user":
+            boundary += 1
+
+        summary = state.get("context_summary") or {"upto": 0, "text": ""}
+        if summary["upto"] > boundary:
+            # 履歴が復元等で差し替えられた場合は作り直す
+            summary = {"upto": 0, "text": ""}
+        if summary["upto"] < boundary:
+            text = self._summarize(
+                client,
+                model,
+                summary["text"],
+                messages[summary["upto"]:boundary],
+                rate_limiter,
+            )
+            if text is None:
+                return ContextResult(messages=messages, policy=self.name)
+            summary = {"upto": boundary, "text": text}
+            state["context_summary"] = summary
+
+        condensed = [
+            {"role": "user", "content": SUMMARY_PREFIX + summary["text"]},
+            {"role": "assistant", "content": SUMMARY_ACK},
+        ] + messages[boundary:]
+        return ContextResult(
+            messages=condensed,
+            policy=self.name,
+            original_tokens=count_tokens(client, model, messages),
+        )
+
+    def _summarize(
+        self, client, model, previous, new_messages, rate_limiter=None
+    ) -> Optional[str]:
+        transcript = "\n\n".join(
+            f"{'User' if m['role'] == 'user' else 'Assistant'}: {content_text(m['content'])}"
+            for m in new_messages
+        )
+        prompt = (
+            "以下は User と Assistant の会話の一部です。"
+            "後で会話を続けられるよう、事実・決定事項・未解決の質問を落とさずに簡潔に要約してください。\n\n"
+        )
+        if previous:
+            prompt += f"これまでの要約:\n{previous}\n\n"
+        prompt += f"続きの会話:\n{transcript}"
+        request = {"role": "user", "content": prompt}
+        try:
+            response = _call_api(
+                client,
+                rate_limiter,
+                lambda c: c.messages.create(
+                    model=model, max_tokens=self.max_tokens, messages=[request]
+                ),
+                input_tokens=estimate_input_tokens([request]),
+                output_tokens=self.max_tokens,
+            )
+            return response.content[0].text
+        except Exception:
+            return None
+
+
+POLICY_CHOICES = [
+    "自動",
+    FullHistoryPolicy.name,
+    SlidingWindowPolicy.name,
+    TokenBudgetPolicy.name,
+    SummarizingPolicy.name,
+]
+
+
+def select_context_policy(model: str, choice: str = "自動"):
+    """
+    モデルと UI の選択からポリシーを決める。
+    「自動」の場合は、安価な Haiku はスライディングウィンドウ、入力単価の高い Opus は要約、
+    それ以外はコンテキストウィンドウの半分を上限とするトークン上限ポリシーを使う。
+    """
+    window = get_model_catalog().get(model).context_window
+    if choice == FullHistoryPolicy.name:
+        return FullHistoryPolicy()
+    if choice == SlidingWindowPolicy.name:
+        return SlidingWindowPolicy()
+    if choice == TokenBudgetPolicy.name:
+        return TokenBudgetPolicy(budget_tokens=window // 2)
+    if choice == SummarizingPolicy.name:
+        return SummarizingPolicy()
+
+    if "haiku" in model:
+        return SlidingWindowPolicy()
+    if "opus" in model:
+        return SummarizingPolicy()
+    return TokenBudgetPolicy(budget_tokens=window // 2)
@@ -0,0 +1,807 @@
+"""
+サーバー側の会話ストア（SQLite, WAL モード）。
+メッセージは作成されるたびに 1 行ずつ追記し、過去の会話は ID を指定して読み込む。
+メッセージの本文・ロール・モデル・投稿時刻は FTS5 の全文検索インデックスにも
+トリガーで追加する（保存と同じトランザクションで更新されるので、作り直しは不要）。
+
+会話は分岐できる（過去のメッセージの編集や応答の再生成）。各メッセージは親の連番を持ち、
+会話は木になる。分岐は共通の先頭部分を行として共有し、追加されるのは新しいメッセージだけ。
+会話の head（表示中の分岐の末尾）から親をたどった経路が、セッションに表示する履歴になる。
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import List, Optional
+
+import streamlit as st
+
+from chat_history_view import FOCUS_CONTEXT, RECENT_MESSAGE_COUNT
+from chat_message import Message
+from storage_paths import get_data_dir
+
+STORE_FILE_NAME = "conversations.sqlite3"
+# 会話タイトルに使う最初のユーザー発言の文字数
+TITLE_LENGTH = 40
+# 全文検索のトライグラムで検索できる最短の語の長さ（これより短い語は LIKE で探す）
+MIN_FTS_TERM_LENGTH = 3
+# 検索結果の抜粋の長さ（トークン数、LIKE の場合は前後の文字数）
+SNIPPET_LENGTH = 16
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL DEFAULT '',
+    model TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    head INTEGER NOT NULL DEFAULT -1,
+    branched INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_updated_at
+    ON conversations (updated_at DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT,
+    model TEXT,
+    extra TEXT,
+    parent INTEGER,
+    PRIMARY KEY (conversation_id, seq)
+);
+CREATE TABLE IF NOT EXISTS imported_files (
+    sha256 TEXT PRIMARY KEY,
+    conversation_id TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    name TEXT,
+    imported_at REAL NOT NULL
+);
+"""
+
+# 分岐の無かった頃のストアの移行（1 列目が無ければ、各文はその列を追加する）。
+# それまでの会話は一本道なので、親は 1 つ前のメッセージ、head は最後のメッセージ
+MIGRATIONS = (
+    (
+        "messages",
+        "parent",
+        (
+            "ALTER TABLE messages ADD COLUMN parent INTEGER",
+            "UPDATE messages SET parent = seq - 1 WHERE seq > 0",
+        ),
+    ),
+    (
+        "conversations",
+        "head",
+        (
+            "ALTER TABLE conversations ADD COLUMN head INTEGER NOT NULL DEFAULT -1",
+            "ALTER TABLE conversations ADD COLUMN branched INTEGER NOT NULL DEFAULT 0",
+            "UPDATE conversations SET head = message_count - 1",
+        ),
+    ),
+)
+
+TREE_SCHEMA = """
+CREATE INDEX IF NOT EXISTS idx_messages_parent ON messages (conversation_id, parent);
+"""
+
+MESSAGE_COLUMNS = "conversation_id, seq, role, content, timestamp, model, extra, parent"
+# head から親をたどる経路（表示中の分岐）。パラメータは (head, 会話 ID)
+PATH_CTE = (
+    "WITH RECURSIVE path (seq) AS (SELECT ? UNION ALL"
+    " SELECT m.parent FROM messages m JOIN path p ON m.seq = p.seq"
+    " WHERE m.conversation_id = ? AND m.parent IS NOT NULL) "
+)
+
+# 日本語は単語が空白で区切られないので、トライグラム（3 文字単位）で索引を作る。
+# 索引の行は messages の rowid に対応させ、トリガーで追加・削除する
+# （会話の削除は ON DELETE CASCADE でメッセージが消え、その削除でもトリガーが動く）
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, role, model, timestamp,
+    conversation_id UNINDEXED, seq UNINDEXED,
+    tokenize = 'trigram'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content, role, model, timestamp, conversation_id, seq)
+    VALUES (new.rowid, new.content, new.role, new.model, new.timestamp,
+            new.conversation_id, new.seq);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    DELETE FROM messages_fts WHERE rowid = old.rowid;
+END;
+"""
+
+
+def _row_values(conversation_id: str, seq: int, msg: Message, parent: Optional[int]):
+    # スロットの項目は列に、それ以外のメタ情報は extra 列に JSON で保存する
+    return (
+        conversation_id,
+        seq,
+        msg.role,
+        msg.content,
+        msg.timestamp,
+        msg.model,
+        json.dumps(msg.meta, ensure_ascii=False) if msg.meta else None,
+        parent,
+    )
+
+
+def _row_to_message(row) -> Message:
+    role, content, timestamp, model, extra, seq, parent = row
+    return Message(
+        role, content, timestamp, model, json.loads(extra) if extra else None, seq, parent
+    )
+
+
+def _tree_parents(messages) -> List[Optional[int]]:
+    """
+    保存する各メッセージの親の連番（連番はリストの位置）。id / parent を持つメッセージ
+    （分岐した会話の保存ファイル）はその木のとおりに、無ければ 1 つ前のメッセージを親にする。
+    """
+    positions = {}
+    parents = []
+    for seq, msg in enumerate(messages):
+        if msg.id is None:
+            parents.append(seq - 1 if seq else None)
+            continue
+        parents.append(positions.get(msg.parent) if msg.parent is not None else None)
+        positions[msg.id] = seq
+    return parents
+
+
+def _title_from(messages) -> str:
+    for msg in messages:
+        if msg.role == "user":
+            return msg.content.strip().replace("\n", " ")[:TITLE_LENGTH]
+    return ""
+
+
+class ConversationStore:
+    """
+    SQLite による会話ストア。
+    Streamlit はセッションごとに別スレッドでスクリプトを実行するので、
+    1 つの接続をロック付きで共有する（WAL モードなので別プロセスの読み込みは書き込みを待たない）。
+    """
+
+    def __init__(self, path):
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        with self._transaction() as conn:
+            conn.executescript(SCHEMA)
+            for table, column, statements in MIGRATIONS:
+                columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+                if column not in columns:
+                    for statement in statements:
+                        conn.execute(statement)
+            conn.executescript(TREE_SCHEMA)
+        self.search_enabled = self._init_search()
+
+    def _init_search(self) -> bool:
+        """
+        全文検索のインデックスを用意する。既存のストアに初めて作る場合は保存済みの
+        メッセージをまとめて登録する。FTS5 の無い SQLite では False（LIKE で検索する）。
+        """
+        try:
+            with self._transaction() as conn:
+                exists = conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+                ).fetchone()
+                conn.executescript(SEARCH_SCHEMA)
+                if not exists:
+                    conn.execute(
+                        "INSERT INTO messages_fts"
+                        " (rowid, content, role, model, timestamp, conversation_id, seq)"
+                        " SELECT rowid, content, role, model, timestamp, conversation_id, seq"
+                        " FROM messages"
+                    )
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+    @contextmanager
+    def _transaction(self):
+        """ロックを取ってトランザクションを実行する（例外時はロールバック）。"""
+        with self._lock, self._conn:
+            yield self._conn
+
+    def _query(self, sql, params=()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def create_conversation(
+        self, messages=(), model: Optional[str] = None, updated_at: Optional[float] = None
+    ) -> str:
+        """
+        会話を作成し、messages があればまとめて保存する。会話 ID を返す。
+        updated_at（UNIX 時刻）を指定すると、会話一覧での並び順をその時刻にする。
+        messages が分岐した会話（id / parent 付き）なら木のまま保存し、最後のメッセージを
+        head にする。保存した各メッセージの id / parent はストアの連番に書き換える。
+        """
+        with self._transaction() as conn:
+            return self._insert_conversation(conn, messages, model, updated_at)
+
+    def _insert_conversation(self, conn, messages, model, updated_at) -> str:
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+        updated_at = updated_at or now
+        parents = _tree_parents(messages)
+        branched = any(p != (seq - 1 if seq else None) for seq, p in enumerate(parents))
+        conn.execute(
+            "INSERT INTO conversations"
+            " (id, title, model, created_at, updated_at, message_count, head, branched)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                conversation_id,
+                _title_from(messages),
+                model,
+                min(now, updated_at),
+                updated_at,
+                len(messages),
+                len(messages) - 1,
+                int(branched),
+            ),
+        )
+        conn.executemany(
+            f"INSERT INTO messages ({MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                _row_values(conversation_id, seq, m, parents[seq])
+                for seq, m in enumerate(messages)
+            ],
+        )
+        for seq, msg in enumerate(messages):
+            msg.id, msg.parent = seq, parents[seq]
+        return conversation_id
+
+    def import_conversation(
+        self,
+        messages,
+        sha256: str,
+        name: Optional[str] = None,
+        model: Optional[str] = None,
+        updated_at: Optional[float] = None,
+    ) -> Optional[str]:
+        """
+        保存ファイルから読み込んだ会話を作成する。sha256 はファイルの内容のハッシュで、
+        同じファイルを取り込み済みなら何もせずに None を返す。
+        """
+        with self._transaction() as conn:
+            if conn.execute(
+                "SELECT 1 FROM imported_files WHERE sha256 = ?", (sha256,)
+            ).fetchone():
+                return None
+            conversation_id = self._insert_conversation(conn, messages, model, updated_at)
+            conn.execute(
+                "INSERT INTO imported_files VALUES (?, ?, ?, ?)",
+                (sha256, conversation_id, name, time.time()),
+            )
+        return conversation_id
+
+    def append_message(
+        self,
+        conversation_id: str,
+        msg: Message,
+        parent: Optional[int] = None,
+        move_head: bool = True,
+    ) -> int:
+        """
+        メッセージを 1 件追記し、その連番（0 始まり）を返す。
+        親は parent（連番）、省略すると head で、追記したメッセージが新しい head になる
+        （move_head が False なら head は変えない）。msg の id / parent も書き換える。
+        """
+        with self._transaction() as conn:
+            seq, title, head, branched = conn.execute(
+                "SELECT message_count, title, head, branched FROM conversations WHERE id = ?",
+                (conversation_id,),
+            ).fetchone()
+            if parent is None and head >= 0:
+                parent = head
+            conn.execute(
+                f"INSERT INTO messages ({MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                _row_values(conversation_id, seq, msg, parent),
+            )
+            conn.execute(
+                "UPDATE conversations SET message_count = ?, updated_at = ?, title = ?,"
+                " model = COALESCE(model, ?), head = ?, branched = ? WHERE id = ?",
+                (
+                    seq + 1,
+                    time.time(),
+                    title or _title_from([msg]),
+                    msg.model,
+                    seq if move_head else head,
+                    int(branched or not move_head or parent != (seq - 1 if seq else None)),
+                    conversation_id,
+                ),
+            )
+        msg.id, msg.parent = seq, parent
+        return seq
+
+    def set_head(self, conversation_id: str, seq: int):
+        """
+        表示する分岐を、連番 seq のメッセージまでの経路に切り替える。
+        最後のメッセージ以外を head にすると、以降は経路を親からたどって読む。
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE conversations SET head = ?,"
+                " branched = branched OR ? != message_count - 1 WHERE id = ?",
+                (seq, seq, conversation_id),
+            )
+
+    def leaf_of(self, conversation_id: str, seq: int) -> int:
+        """seq のメッセージから、いちばん新しい子をたどった末尾のメッセージの連番。"""
+        while True:
+            rows = self._query(
+                "SELECT MAX(seq) FROM messages WHERE conversation_id = ? AND parent = ?",
+                (conversation_id, seq),
+            )
+            if rows[0][0] is None:
+                return seq
+            seq = rows[0][0]
+
+    def siblings(self, conversation_id: str, parent: int) -> List[int]:
+        """parent（連番）の子メッセージの連番を古い順に返す（分岐の切り替え用）。"""
+        rows = self._query(
+            "SELECT seq FROM messages WHERE conversation_id = ? AND parent = ? ORDER BY seq",
+            (conversation_id, parent),
+        )
+        return [row[0] for row in rows]
+
+    def _head(self, conversation_id: str):
+        rows = self._query(
+            "SELECT head, branched FROM conversations WHERE id = ?", (conversation_id,)
+        )
+        return rows[0] if rows else (-1, 0)
+
+    def path_length(self, conversation_id: str) -> int:
+        """表示中の分岐（head までの経路）のメッセージ数。"""
+        head, branched = self._head(conversation_id)
+        if not branched or head < 0:
+            return head + 1
+        rows = self._query(
+            PATH_CTE + "SELECT COUNT(*) FROM path", (head, conversation_id)
+        )
+        return rows[0][0]
+
+    def path_position(self, conversation_id: str, seq: int) -> int:
+        """seq のメッセージが、そこまでの経路の何番目（0 始まり）か。"""
+        rows = self._query(
+            PATH_CTE + "SELECT COUNT(*) - 1 FROM path", (seq, conversation_id)
+        )
+        return rows[0][0]
+
+    def load_messages(
+        self,
+        conversation_id: str,
+        start: int = 0,
+        end: Optional[int] = None,
+        head: Optional[int] = None,
+    ) -> List[Message]:
+        """
+        表示中の分岐（head までの経路）のメッセージを順番どおりに返す。
+        start / end で経路の中の位置の範囲 [start, end) を指定できる。
+        分岐していない会話は、経路の位置がそのまま連番になる。
+        head（連番）を指定すると、保存されている head は変えずにその経路を読む。
+        """
+        if head is None:
+            head, branched = self._head(conversation_id)
+        else:
+            branched = True
+        end = head + 1 if end is None else min(end, head + 1)
+        if end <= start:
+            return []
+        columns = "role, content, timestamp, model, extra, seq, parent"
+        if not branched:
+            rows = self._query(
+                f"SELECT {columns} FROM messages"
+                " WHERE conversation_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (conversation_id, start, end),
+            )
+        else:
+            # 親の連番は子より小さいので、経路を連番の順に並べると会話の順になる
+            rows = self._query(
+                PATH_CTE + f"SELECT {columns} FROM messages WHERE conversation_id = ?"
+                " AND seq IN (SELECT seq FROM path ORDER BY seq LIMIT ? OFFSET ?)"
+                " ORDER BY seq",
+                (head, conversation_id, conversation_id, end - start, start),
+            )
+        return [_row_to_message(row) for row in rows]
+
+    def load_tree(self, conversation_id: str) -> List[Message]:
+        """
+        会話の全メッセージを保存用に返す。分岐していなければ表示中の経路（id は None）。
+        分岐していれば木の全体を、親が子より前に来る順で返し、id / parent はリストの
+        位置に振り直す。表示中の分岐は各メッセージの最後の子としてたどるので、
+        head が最後の要素になる（読み込むとその分岐が表示される）。
+        """
+        head, branched = self._head(conversation_id)
+        if not branched:
+            messages = self.load_messages(conversation_id)
+            for msg in messages:
+                msg.id = msg.parent = None
+            return messages
+        rows = self._query(
+            "SELECT role, content, timestamp, model, extra, seq, parent FROM messages"
+            " WHERE conversation_id = ? ORDER BY seq",
+            (conversation_id,),
+        )
+        nodes = [_row_to_message(row) for row in rows]
+        children = {}
+        for msg in nodes:
+            children.setdefault(msg.parent, []).append(msg)
+        on_path = {m.id for m in self.load_messages(conversation_id)}
+        ordered = []
+        stack = []
+
+        def push_children(parent):
+            # スタックなので、最後にたどりたい経路上の子を先に、他の子は新しい順に積む
+            kids = children.get(parent, [])
+            stack.extend([m for m in kids if m.id in on_path])
+            stack.extend([m for m in reversed(kids) if m.id not in on_path])
+
+        push_children(None)
+        while stack:
+            msg = stack.pop()
+            ordered.append(msg)
+            push_children(msg.id)
+        positions = {msg.id: i for i, msg in enumerate(ordered)}
+        for msg in ordered:
+            msg.id, msg.parent = positions[msg.id], positions.get(msg.parent)
+        return ordered
+
+    def get_conversation(self, conversation_id: str) -> Optional[dict]:
+        rows = self._query(
+            "SELECT id, title, model, created_at, updated_at, message_count, head, branched"
+            " FROM conversations WHERE id = ?",
+            (conversation_id,),
+        )
+        return _conversation_dict(rows[0]) if rows else None
+
+    def list_conversations(self, query: str = "", limit: int = 20) -> List[dict]:
+        """
+        会話を新しい順に返す。query を指定した場合は、タイトルかメッセージ本文に
+        その文字列を含む会話だけを返す。
+        """
+        sql = (
+            "SELECT id, title, model, created_at, updated_at, message_count, head, branched"
+            " FROM conversations"
+        )
+        params = []
+        if query:
+            pattern = f"%{query}%"
+            sql += (
+                " WHERE title LIKE ? OR id IN"
+                " (SELECT conversation_id FROM messages WHERE content LIKE ?)"
+            )
+            params = [pattern, pattern]
+        sql += " ORDER BY updated_at DESC LIMIT ?"
+        params.append(limit)
+        return [_conversation_dict(row) for row in self._query(sql, params)]
+
+    def search_messages(
+        self, query: str, role: Optional[str] = None, limit: int = 20
+    ) -> List[dict]:
+        """
+        本文・ロール・モデル・投稿時刻に query の語をすべて含むメッセージを、
+        保存が新しい順に返す（空白で区切った語の AND、大文字・小文字は区別しない）。
+        新しい順なら一致した件数が多くても先頭の limit 件で打ち切れるので、
+        関連度（bm25）で並べ替えるより大幅に速い。
+        role を指定するとそのロールのメッセージに絞り込む。各要素は conversation_id /
+        seq / role / model / timestamp / title / snippet（一致箇所を ** で囲んだ抜粋）。
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        if self.search_enabled and min(map(len, terms)) >= MIN_FTS_TERM_LENGTH:
+            # 各語をフレーズとして引用し、FTS5 の演算子として解釈されないようにする
+            match = " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+            sql = (
+                "SELECT f.conversation_id, f.seq, f.role, f.model, f.timestamp, c.title,"
+                f" snippet(messages_fts, 0, '**', '**', '…', {SNIPPET_LENGTH})"
+                " FROM messages_fts f JOIN conversations c ON c.id = f.conversation_id"
+                " WHERE messages_fts MATCH ?"
+            )
+            params = [match]
+            if role:
+                sql += " AND f.role = ?"
+                params.append(role)
+            sql += " ORDER BY f.rowid DESC LIMIT ?"
+            rows = self._query(sql, params + [limit])
+        else:
+            rows = self._search_like(terms, role, limit)
+        keys = ("conversation_id", "seq", "role", "model", "timestamp", "title", "snippet")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def _search_like(self, terms, role, limit) -> list:
+        # トライグラムで探せない短い語（日本語の 1〜2 文字など）は本文を順に調べる
+        columns = "(m.content || ' ' || m.role || ' ' || IFNULL(m.model, '') || ' '"
+        columns += " || IFNULL(m.timestamp, ''))"
+        sql = (
+            "SELECT m.conversation_id, m.seq, m.role, m.model, m.timestamp, c.title,"
+            " m.content FROM messages m JOIN conversations c ON c.id = m.conversation_id"
+            " WHERE " + " AND ".join(f"{columns} LIKE ? ESCAPE '\\'" for _ in terms)
+        )
+        params = ["%" + _escape_like(t) + "%" for t in terms]
+        if role:
+            sql += " AND m.role = ?"
+            params.append(role)
+        sql += " ORDER BY m.rowid DESC LIMIT ?"
+        rows = self._query(sql, params + [limit])
+        return [row[:6] + (_like_snippet(row[6], terms[0]),) for row in rows]
+
+    def delete_conversation(self, conversation_id: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+
+def _escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _like_snippet(content: str, term: str) -> str:
+    """LIKE で見つけたメッセージの、最初の一致箇所の前後の抜粋。"""
+    pos = content.lower().find(term.lower())
+    if pos < 0:
+        return content[: SNIPPET_LENGTH * 2] + ("…" if len(content) > SNIPPET_LENGTH * 2 else "")
+    start = max(pos - SNIPPET_LENGTH, 0)
+    end = pos + len(term)
+    return (
+        ("…" if start else "")
+        + content[start:pos]
+        + "**"
+        + content[pos:end]
+        + "**"
+        + content[end : end + SNIPPET_LENGTH]
+        + ("…" if end + SNIPPET_LENGTH < len(content) else "")
+    )
+
+
+def _conversation_dict(row) -> dict:
+    keys = (
+        "id", "title", "model", "created_at", "updated_at", "message_count", "head", "branched"
+    )
+    return dict(zip(keys, row))
+
+
+@st.cache_resource(show_spinner=False)
+def get_conversation_store() -> ConversationStore:
+    """プロセス共有の会話ストアを返す。"""
+    return ConversationStore(get_data_dir() / STORE_FILE_NAME)
+
+
+def bump_history_version():
+    """
+    セッションの履歴が変わったことを記録する。
+    エクスポートなど、履歴から作るデータはこのバージョン番号に対してメモ化する。
+    """
+    st.session_state["history_version"] = st.session_state.get("history_version", 0) + 1
+
+
+def append_message(
+    msg: Message, conversation_id: Optional[str] = None, parent: Optional[int] = None
+):
+    """
+    現在のセッションの会話にメッセージを追加し、ストアへ 1 行追記する。
+    会話はユーザーが最初に発言したときに作成する（それまでの挨拶なども一緒に保存する）。
+    conversation_id を指定し、それが現在の会話でない場合はストアにだけ追記する。
+    parent（親メッセージの連番）が表示中の分岐の末尾でない場合
+    （生成中に別の分岐へ切り替えた場合）も、ストアにだけその親の子として追記する。
+    ストアには常にこのセッションが表示している分岐の末尾を親として渡す（ストアの head は
+    他のタブの分岐の切り替えや投稿でも動くので、それには頼らない）。
+    """
+    store = get_conversation_store()
+    current_id = st.session_state.get("conversation_id")
+    messages = st.session_state["messages"]
+    if conversation_id is not None and conversation_id != current_id:
+        store.append_message(conversation_id, msg, parent)
+        return
+    if parent is not None and current_id is not None and parent != messages[-1].id:
+        store.append_message(current_id, msg, parent, move_head=False)
+        return
+
+    tail = messages[-1].id
+    messages.append(msg)
+    bump_history_version()
+    conversation_id = st.session_state.get("conversation_id")
+    if conversation_id is None:
+        if msg.role != "user":
+            return
+        st.session_state["conversation_id"] = store.create_conversation(
+            st.session_state["messages"], model=st.session_state.get("model")
+        )
+    else:
+        store.append_message(conversation_id, msg, parent=tail)
+
+
+def session_history() -> List[Message]:
+    """
+    現在の会話の全メッセージ。メモリの上限のため先頭の history_offset 件を
+    会話ストアに退避している場合は、その分をストアから読み込んで前に付ける。
+    """
+    messages = st.session_state["messages"]
+    offset = st.session_state.get("history_offset", 0)
+    if not offset:
+        return messages
+    return load_older_messages(0, offset) + messages
+
+
+def load_older_messages(start: int, end: int) -> List[Message]:
+    """現在の会話のうち、会話ストアに退避した範囲 [start, end) のメッセージ。"""
+    store = get_conversation_store()
+    return store.load_messages(st.session_state["conversation_id"], start, end)
+
+
+def load_conversation(conversation_id: str, focus_seq: Optional[int] = None) -> bool:
+    """
+    保存済みの会話を現在のセッションに読み込む。見つからなければ False。
+    メモリに読み込むのは直近 RECENT_MESSAGE_COUNT 件だけで、それより古い分は
+    表示するときに会話ストアから読む（長い会話でもすぐに開ける）。
+    focus_seq を指定すると、そのメッセージを前後と一緒に履歴の先頭に表示する
+    （検索結果から開く場合）。そのメッセージが別の分岐にあっても表示する分岐は変えず、
+    切り替えるのはユーザーが「この分岐を表示」を押したときだけにする
+    （見ただけで、他のセッションを含めて以降の読み込みの分岐が変わらないように）。
+    """
+    store = get_conversation_store()
+    conversation = store.get_conversation(conversation_id)
+    if conversation is None:
+        return False
+    messages = _load_active_path(store, conversation_id)
+    st.session_state["conversation_id"] = conversation_id
+    st.session_state["history_focus"] = (
+        None if focus_seq is None else _load_focus(store, conversation_id, focus_seq)
+    )
+    model = conversation["model"] or next(
+        (m.model for m in messages if m.role == "assistant" and m.model),
+        None,
+    )
+    if model:
+        st.session_state["model"] = model
+    # 以前の会話の要約は使えないので破棄する
+    st.session_state.pop("context_summary", None)
+    return True
+
+
+def _load_focus(store: ConversationStore, conversation_id: str, seq: int) -> dict:
+    """
+    検索で開いたメッセージと前後のメッセージ。そのメッセージまでの経路に、最新の子を
+    たどった続きを付けた分岐から読む（保存されている head は変えない）。
+    """
+    position = store.path_position(conversation_id, seq)
+    messages = store.load_messages(
+        conversation_id,
+        max(position - FOCUS_CONTEXT, 0),
+        position + FOCUS_CONTEXT + 1,
+        head=store.leaf_of(conversation_id, seq),
+    )
+    on_path = [m.id for m in store.load_messages(conversation_id, position, position + 1)]
+    return {
+        "seq": seq,
+        "position": position,
+        "messages": messages,
+        "on_active_branch": on_path == [seq],
+    }
+
+
+def _load_active_path(store: ConversationStore, conversation_id: str) -> List[Message]:
+    """表示中の分岐の直近 RECENT_MESSAGE_COUNT 件をセッションに読み込む。"""
+    start = max(store.path_length(conversation_id) - RECENT_MESSAGE_COUNT, 0)
+    messages = store.load_messages(conversation_id, start)
+    st.session_state["messages"] = messages
+    st.session_state["history_offset"] = start
+    bump_history_version()
+    return messages
+
+
+def set_active_message(seq: int, latest_leaf: bool = False):
+    """
+    現在の会話で、連番 seq のメッセージまでの経路を表示する分岐にする
+    （編集・再生成の前に親メッセージまで戻す場合や、分岐を切り替える場合）。
+    latest_leaf が True なら、seq から最新の子をたどった末尾までを表示する。
+    """
+    store = get_conversation_store()
+    conversation_id = st.session_state["conversation_id"]
+    if latest_leaf:
+        seq = store.leaf_of(conversation_id, seq)
+    store.set_head(conversation_id, seq)
+    _load_active_path(store, conversation_id)
+    st.session_state["history_focus"] = None
+    # 要約は切り替える前の分岐の内容なので破棄する
+    st.session_state.pop("context_summary", None)
+
+
+def export_history() -> List[Message]:
+    """
+    保存用の履歴。分岐した会話は全分岐を id / parent 付きで返す（読み込むと、
+    表示中の分岐が表示される）。分岐していなければ表示中の履歴と同じ。
+    """
+    conversation_id = st.session_state.get("conversation_id")
+    if conversation_id is None:
+        return session_history()
+    return get_conversation_store().load_tree(conversation_id)
+
+
+def start_new_conversation(greeting: Message):
+    """現在のセッションを新しい会話に切り替える。"""
+    st.session_state["messages"] = [greeting]
+    st.session_state["history_offset"] = 0
+    st.session_state["conversation_id"] = None
+    st.session_state["history_focus"] = None
+    bump_history_version()
+    st.session_state.pop("context_summary", None)
+
+
+def render_conversation_sidebar(greeting_factory):
+    """
+    サイドバーに会話一覧（検索付き）を表示する。
+    greeting_factory は新しい会話の最初の assistant メッセージを返す関数。
+    """
+    store = get_conversation_store()
+    with st.sidebar:
+        st.subheader("会話履歴")
+        if st.button("＋ 新しい会話", use_container_width=True):
+            start_new_conversation(greeting_factory())
+            st.rerun()
+
+        query = st.text_input(
+            "メッセージを検索",
+            placeholder="キーワード（空白区切りで AND）",
+            help="保存済みの全会話のメッセージ本文・モデル・投稿時刻を検索します。",
+        )
+        if query.strip():
+            _render_search_results(store, query)
+            return
+
+        current_id = st.session_state.get("conversation_id")
+        conversations = store.list_conversations()
+        if not conversations:
+            st.caption("保存された会話はありません。")
+        for conv in conversations:
+            label = conv["title"] or "（無題）"
+            updated = time.strftime("%m/%d %H:%M", time.localtime(conv["updated_at"]))
+            if st.button(
+                f"{label}（{updated}）",
+                key=f"conversation_{conv['id']}",
+                help=f"{conv['message_count']}件のメッセージ",
+                disabled=conv["id"] == current_id,
+                use_container_width=True,
+            ):
+                load_conversation(conv["id"])
+                st.rerun()
+
+
+def _render_search_results(store: ConversationStore, query: str):
+    """検索に一致したメッセージの一覧。選ぶとその会話を開き、メッセージを先頭に表示する。"""
+    role = st.radio(
+        "ロール",
+        options=[None, "user", "assistant"],
+        format_func=lambda r: {None: "すべて", "user": "ユーザー", "assistant": "アシスタント"}[r],
+        horizontal=True,
+        key="search_role",
+    )
+    results = store.search_messages(query, role=role)
+    if not results:
+        st.caption("一致するメッセージはありません。")
+    for hit in results:
+        label = hit["title"] or "（無題）"
+        with st.container(border=True):
+            st.markdown(hit["snippet"])
+            st.caption(
+                " / ".join(
+                    part
+                    for part in (label, hit["role"], hit["model"], hit["timestamp"])
+                    if part
+                )
+            )
+            if st.button(
+                "この会話を開く",
+                key=f"search_hit_{hit['conversation_id']}_{hit['seq']}",
+                use_container_width=True,
+            ):
+                load_conversation(hit["conversation_id"], focus_seq=hit["seq"])
+                st.rerun()
@@ -0,0 +1,475 @@
+"""
+Claude の応答生成をバックグラウンドで実行するワーカー。
+生成はスクリプトのスレッドではなくプロセス共有のスレッドプールで行うので、
+生成中に画面を操作（再実行）しても、リクエストが中断・重複することはない。
+画面側は `st.fragment` で定期的に部分応答をポーリングして表示し、停止ボタンで中断できる。
+比較モードでは同じ履歴を複数のモデルに同時に送り、応答を列ごとに表示する。
+max_tokens は出力バジェット（output_budget）がモデルごとに決め、上限で打ち切られた応答は
+それまでの応答を assistant の先頭（プレフィル）にして続きを生成し、1 つの応答につなげる。
+"""
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import streamlit as st
+
+from claude_client import get_client
+from claude_streaming import run_stream, total_input_tokens
+from context_policy import select_context_policy
+from model_catalog import estimate_cost
+from output_budget import MAX_CONTINUATIONS, get_output_budget
+from rate_limiter import RateLimitCancelled, estimate_input_tokens, get_rate_limiter
+from request_builder import build_messages_request
+from response_cache import make_cache_key, response_cache_for_turn
+from telemetry import record_generation
+
+# 同時に生成できるリクエスト数（プロセス全体）
+MAX_WORKERS = 8
+# 取り出されずに残った生成ジョブを破棄するまでの時間（秒）
+JOB_RETENTION_SECONDS = 60 * 60
+# 生成中の画面の更新間隔（秒）
+POLL_INTERVAL_SECONDS = 0.5
+# 応答キャッシュのキーで、max_tokens を出力バジェットで決めることを表す値
+BUDGET_AUTO = "auto"
+# 続きを生成したときに足し合わせる run_stream() の metrics のキー
+SUMMED_METRICS = (
+    "latency",
+    "input_tokens",
+    "output_tokens",
+    "cache_read_input_tokens",
+    "cache_creation_input_tokens",
+    "retries",
+)
+
+
+def merge_metrics(first: dict, continuation: dict) -> dict:
+    """
+    続きを生成した API 呼び出しの metrics を元の metrics に足し合わせる。
+    初回トークンまでの時間は最初の呼び出しのもの、stop_reason は最後の呼び出しのもの。
+    """
+    merged = dict(first)
+    for key in SUMMED_METRICS:
+        merged[key] = (first.get(key) or 0) + (continuation.get(key) or 0)
+    merged["latency"] = round(merged["latency"], 3)
+    merged["stop_reason"] = continuation.get("stop_reason")
+    return merged
+
+
+class GenerationJob:
+    """
+    1 回分の応答生成。status は queued / running / done / stopped / error のいずれか。
+    text は受信済みの部分応答で、生成中も読み出せる。
+    max_tokens が None なら出力バジェットで決める。
+    """
+
+    def __init__(
+        self,
+        model,
+        messages,
+        policy_choice,
+        max_tokens,
+        state,
+        conversation_id=None,
+        response_cache=None,
+        parent_id=None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.model = model
+        self.messages = messages
+        self.policy_choice = policy_choice
+        self.max_tokens = max_tokens
+        # コンテキストポリシーが使う状態（要約など）。セッション状態のコピー
+        self.state = state
+        # 結果を保存する会話（生成中に別の会話へ切り替えられても元の会話に保存する）
+        self.conversation_id = conversation_id
+        # 応答の親になるメッセージの連番（生成中に別の分岐へ切り替えられても、その子にする）
+        self.parent_id = parent_id
+        # 応答キャッシュ（None なら使わない）。ヒットした場合は API を呼ばない
+        self.response_cache = response_cache
+        self.cached = False
+        self.status = "queued"
+        # レート制限の順番待ちでの位置（1 始まり、待っていなければ None）
+        self.queue_position = None
+        self.context = None
+        self.metrics = {}
+        self.error: Optional[Exception] = None
+        self.created_at = time.time()
+        self._chunks = []
+        self._cancel = threading.Event()
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "stopped", "error")
+
+    def cancel(self):
+        """生成の停止を要求する（受信済みの部分応答は残る）。"""
+        self._cancel.set()
+
+    def run(self, client, rate_limiter, output_budget):
+        if self._cancel.is_set():
+            # スレッドプールの空きを待っている間に停止された
+            self.status = "stopped"
+            return
+        self.status = "running"
+        started = time.perf_counter()
+        try:
+            max_tokens = self.max_tokens or output_budget.max_tokens_for(self.model)
+            cache_key = None
+            if self.response_cache is not None:
+                # 出力バジェットで決める max_tokens は応答のたびに変わるので、キーには
+                # 設定（固定値か "auto"）を使う。上限で打ち切られた応答はキャッシュしないので、
+                # max_tokens の違いで短い応答が返ることはない
+                cache_key = make_cache_key(
+                    self.model, self.max_tokens or BUDGET_AUTO, self.messages
+                )
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    self._chunks.append(cached["content"])
+                    elapsed = time.perf_counter() - started
+                    self.metrics = {"time_to_first_token": elapsed, "latency": elapsed}
+                    self.cached = True
+                    self.status = "done"
+                    return
+
+            # 送信する履歴をコンテキストポリシーで絞り込む
+            policy = select_context_policy(self.model, self.policy_choice)
+            self.context = policy.apply(
+                client, self.model, self.messages, self.state, rate_limiter
+            )
+            if self._cancel.is_set():
+                self.status = "stopped"
+                return
+
+            # 会話の先頭部分はプロンプトキャッシュに載せる
+            request = build_messages_request(
+                model=self.model,
+                max_tokens=max_tokens,
+                messages=self.context.messages,
+            )
+            self.metrics, stopped = self._send(
+                client,
+                rate_limiter,
+                request,
+                self.context.sent_tokens or estimate_input_tokens(self.context.messages),
+            )
+            if self.context.sent_tokens is None:
+                self.context.sent_tokens = total_input_tokens(self.metrics)
+            if not stopped:
+                stopped = self._continue(client, rate_limiter, output_budget, request)
+            self.status = "stopped" if stopped else "done"
+            if not stopped:
+                output_budget.record(self.model, self.metrics.get("output_tokens"))
+            # 最後まで生成した応答だけをキャッシュする（停止・上限での打ち切りは除く）
+            if (
+                cache_key is not None
+                and self.metrics.get("stop_reason") == "end_turn"
+                and self.text
+            ):
+                self.response_cache.put(cache_key, {"content": self.text})
+        except RateLimitCancelled:
+            self.queue_position = None
+            self.status = "stopped"
+        except Exception as e:
+            self.error = e
+            self.status = "error"
+
+    def _send(self, client, rate_limiter, request, input_tokens, prefix=""):
+        """
+        レート制限の順番を待って request を送信する（429 / 529 はバックオフしてリトライ）。
+        リトライは rate_limiter で行うので SDK のリトライは無効にする。
+        prefix は続きを生成するときのそれまでの応答で、受信した差分はその後ろにつなげる。
+        戻り値は (metrics, 停止されたか)。
+        """
+        outcome = {}
+
+        def send():
+            self.queue_position = None
+            # リトライの前に、失敗した送信の部分応答を捨てる
+            self._chunks[:] = [prefix] if prefix else []
+            _, metrics, outcome["stopped"] = run_stream(
+                client.with_options(max_retries=0),
+                request,
+                on_text=self._chunks.append,
+                should_stop=self._cancel.is_set,
+            )
+            return metrics
+
+        metrics, retries = rate_limiter.call(
+            send,
+            input_tokens=input_tokens,
+            output_tokens=request["max_tokens"],
+            should_stop=self._cancel.is_set,
+            on_queue=self._set_queue_position,
+        )
+        metrics["retries"] = retries
+        return metrics, outcome["stopped"]
+
+    def _continue(self, client, rate_limiter, output_budget, request) -> bool:
+        """
+        応答が max_tokens で打ち切られていれば、それまでの応答をプレフィルにして
+        続きを生成する（最大 MAX_CONTINUATIONS 回）。会話の先頭部分はプロンプトキャッシュから
+        読まれるので、「続けて」と送り直す場合と違って履歴を処理し直さない。
+        続きを生成した回数と、その間にキャッシュから読んだ入力トークン数を metrics に記録する。
+        戻り値は停止されたか。
+        """
+        continuations, tokens_saved = 0, 0
+        max_tokens = request["max_tokens"]
+        stopped = False
+        while (
+            self.metrics.get("stop_reason") == "max_tokens"
+            and continuations < MAX_CONTINUATIONS
+        ):
+            # プレフィルは末尾に空白があると受け付けられない
+            prefix = self.text.rstrip()
+            if not prefix:
+                break
+            max_tokens = output_budget.continuation_max_tokens(self.model, max_tokens)
+            messages = request["messages"] + [{"role": "assistant", "content": prefix}]
+            try:
+                metrics, stopped = self._send(
+                    client,
+                    rate_limiter,
+                    {**request, "max_tokens": max_tokens, "messages": messages},
+                    estimate_input_tokens(messages),
+                    prefix=prefix,
+                )
+            except RateLimitCancelled:
+                self.queue_position = None
+                self._chunks[:] = [prefix]
+                stopped = True
+                break
+            except Exception:
+                # プレフィルに対応していないモデルなどでは、打ち切られた応答のままにする
+                self._chunks[:] = [prefix]
+                break
+            continuations += 1
+            tokens_saved += metrics.get("cache_read_input_tokens") or 0
+            self.metrics = merge_metrics(self.metrics, metrics)
+            if stopped:
+                break
+        if continuations:
+            self.metrics["continuations"] = continuations
+            self.metrics["continuation_tokens_saved"] = tokens_saved
+        return stopped
+
+    def _set_queue_position(self, position):
+        self.queue_position = position
+
+    def result_fields(self) -> dict:
+        """保存する assistant メッセージの本文とメタ情報。"""
+        fields = {"content": self.text, **self.metrics}
+        if self.metrics:
+            fields["cost_usd"] = estimate_cost(self.model, self.metrics)
+        if self.context is not None:
+            fields["context_policy"] = self.context.policy
+            fields["tokens_saved"] = self.context.tokens_saved
+        if self.cached:
+            fields["cached"] = True
+        if self.status == "stopped":
+            fields["stopped"] = True
+        if self.status == "error":
+            fields["error"] = str(self.error)
+        return fields
+
+
+class GenerationWorker:
+    """
+    生成ジョブを受け付けてスレッドプールで実行する。
+    スレッドプールの空きを待っているジョブも、送信待ちの位置を queue_position() で返す。
+    """
+
+    def __init__(self, client_factory, rate_limiter, output_budget, max_workers=MAX_WORKERS):
+        # クライアントは最初のジョブを受け付けるときに作る（起動直後の画面を待たせない）
+        self._client_factory = client_factory
+        self._rate_limiter = rate_limiter
+        self._output_budget = output_budget
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="claude-generation"
+        )
+        self._jobs = {}
+        # スレッドプールの空きを待っているジョブ（受け付けた順）
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    def submit(self, job: GenerationJob) -> GenerationJob:
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            self._pending.append(job)
+        self._executor.submit(self._run, job, self._client_factory())
+        return job
+
+    def _run(self, job: GenerationJob, client):
+        with self._lock:
+            self._pending.remove(job)
+        job.run(client, self._rate_limiter, self._output_budget)
+
+    def queue_position(self, job: GenerationJob) -> Optional[int]:
+        """
+        job の送信待ちの位置（1 始まり、待っていなければ None）。
+        スレッドプールの空きを待っているジョブは、レート制限の順番を待っている
+        ジョブの後ろに、受け付けた順で並べる。
+        """
+        if job.queue_position is not None:
+            return job.queue_position
+        with self._lock:
+            if job not in self._pending:
+                return None
+            index = self._pending.index(job)
+        return self._rate_limiter.queue_length() + index + 1
+
+    def get(self, job_id) -> Optional[GenerationJob]:
+        if job_id is None:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def discard(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _prune(self):
+        # ブラウザが閉じられるなどして取り出されなかったジョブを破棄する
+        expired = time.time() - JOB_RETENTION_SECONDS
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.created_at < expired:
+                del self._jobs[job_id]
+
+
+@st.cache_resource(show_spinner=False)
+def get_generation_worker() -> GenerationWorker:
+    """プロセス共有の生成ワーカーを返す。"""
+    return GenerationWorker(get_client, get_rate_limiter(), get_output_budget())
+
+
+def start_generation(
+    model,
+    messages,
+    policy_choice="自動",
+    max_tokens=None,
+    conversation_id=None,
+    compare_models=(),
+    parent_id=None,
+    use_response_cache=True,
+):
+    """
+    現在のセッションの応答生成を開始する。
+    messages は API に送る {"role", "content"} のリスト。
+    compare_models を指定すると、同じ履歴をそれらのモデルにも同時に送る（比較モード）。
+    応答キャッシュが有効なら、完全に一致する過去の応答があればそれを返す
+    （use_response_cache が False なら使わない。再生成では同じ応答を返さないようにする）。
+    parent_id は応答の親になるメッセージ（messages の最後）の連番。
+    max_tokens を省略すると、モデルごとに出力バジェットで決める。
+    """
+    worker = get_generation_worker()
+    response_cache = response_cache_for_turn() if use_response_cache else None
+
+    def submit(job_model):
+        return worker.submit(
+            GenerationJob(
+                model=job_model,
+                messages=messages,
+                policy_choice=policy_choice,
+                max_tokens=max_tokens,
+                state={"context_summary": st.session_state.get("context_summary")},
+                conversation_id=conversation_id,
+                response_cache=response_cache,
+                parent_id=parent_id,
+            )
+        )
+
+    job = submit(model)
+    comparisons = [submit(m) for m in compare_models if m != model]
+    st.session_state["generation_job_id"] = job.id
+    st.session_state["comparison_job_ids"] = [c.id for c in comparisons]
+    return job
+
+
+def active_generation() -> Optional[GenerationJob]:
+    """現在のセッションで生成中（または結果未回収）のジョブ。"""
+    return get_generation_worker().get(st.session_state.get("generation_job_id"))
+
+
+def active_comparisons() -> List[GenerationJob]:
+    """現在のセッションで比較のために実行中（または結果未回収）のジョブ。"""
+    worker = get_generation_worker()
+    job_ids = st.session_state.get("comparison_job_ids", [])
+    return [job for job in map(worker.get, job_ids) if job is not None]
+
+
+def generation_finished(job: GenerationJob) -> bool:
+    """メインのジョブと比較用のジョブがすべて終わったか。"""
+    return job.finished and all(c.finished for c in active_comparisons())
+
+
+def collect_generation(job: GenerationJob) -> dict:
+    """
+    終了したジョブをセッションから外し、保存する assistant メッセージの本文とメタ情報を返す。
+    比較用のジョブがあれば、その結果を "comparisons" に入れる。
+    コンテキストポリシーの状態を書き戻し（生成中に別の会話・分岐へ切り替えた場合は、
+    元の分岐で作った状態なので書き戻さない）、API 呼び出しの計測を記録する。
+    エラーの場合はエラーを表示する。
+    """
+    worker = get_generation_worker()
+    comparisons = active_comparisons()
+    for c in [job] + comparisons:
+        worker.discard(c.id)
+        record_generation(c)
+    st.session_state["generation_job_id"] = None
+    st.session_state["comparison_job_ids"] = []
+
+    same_branch = (
+        job.conversation_id == st.session_state.get("conversation_id")
+        and job.parent_id == st.session_state["messages"][-1].id
+    )
+    if same_branch and job.state.get("context_summary") is not None:
+        st.session_state["context_summary"] = job.state["context_summary"]
+    if job.status == "error":
+        st.error(f"❌ 応答の生成に失敗しました: {job.error}")
+
+    fields = job.result_fields()
+    fields.pop("error", None)
+    if comparisons:
+        fields["comparisons"] = [
+            {"model": c.model, **c.result_fields()} for c in comparisons
+        ]
+    return fields
+
+
+@st.fragment(run_every=POLL_INTERVAL_SECONDS)
+def render_generation_progress():
+    """
+    生成中の部分応答を assistant メッセージとして表示し、停止ボタンを置く。
+    比較モードではモデルごとに列を分けて表示する。
+    このフラグメントだけを定期的に再実行し、生成が終わったらアプリ全体を再実行する。
+    """
+    job = active_generation()
+    if job is None:
+        return
+    if generation_finished(job):
+        st.rerun()
+
+    jobs = [job] + active_comparisons()
+    worker = get_generation_worker()
+    with st.chat_message("assistant"):
+        columns = st.columns(len(jobs)) if len(jobs) > 1 else [st.container()]
+        for column, j in zip(columns, jobs):
+            with column:
+                if len(jobs) > 1:
+                    st.caption(f"モデル: {j.model}")
+                if j.text:
+                    st.markdown(j.text if j.finished else j.text + "▌")
+                elif position := worker.queue_position(j):
+                    st.caption(f"送信待ち（{position}番目、API のレート制限のため）")
+                elif not j.finished:
+                    st.caption("考え中...")
+        if st.button("■ 生成を停止", key=f"stop_{job.id}"):
+            for j in jobs:
+                j.cancel()
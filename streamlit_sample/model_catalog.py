@@ -0,0 +1,241 @@
+"""
+利用可能な Claude モデルのカタログ。
+モデル一覧はディスクに TTL 付きで保存し、期限切れの場合はバックグラウンドで更新する。
+初回表示ではネットワークを待たず、保存済みの一覧（無ければ固定の候補）を返す。
+クライアントも更新のときに初めて作るので、カタログの作成では anthropic を import しない。
+"""
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import List, Optional
+
+import streamlit as st
+
+from claude_client import get_client
+from storage_paths import env_int, get_data_dir
+from telemetry import span
+
+# モデル一覧の有効期限（秒）
+CATALOG_TTL_SECONDS = env_int("CLAUDE_MODEL_CATALOG_TTL", 24 * 60 * 60)
+# 取得に失敗した後、次に API を呼ぶまでの間隔（秒）
+RETRY_INTERVAL_SECONDS = 60
+
+# API から取得できない場合の候補
+FALLBACK_MODELS = [
+    "claude-sonnet-4-5-20250929",
+    "claude-sonnet-4-20250514",
+    "claude-opus-4-5-20251101",
+    "claude-opus-4-1-20250805",
+    "claude-haiku-4-5-20251001",
+]
+
+# モデル ID の接頭辞ごとの (コンテキストウィンドウ, 最大出力トークン)。
+# 先に一致したものを使うので、より具体的な接頭辞を上に書く。
+MODEL_LIMITS = [
+    ("claude-opus-4-5", (200_000, 64_000)),
+    ("claude-opus-4-1", (200_000, 32_000)),
+    ("claude-opus-4", (200_000, 32_000)),
+    ("claude-sonnet-4-5", (200_000, 64_000)),
+    ("claude-sonnet-4", (200_000, 64_000)),
+    ("claude-haiku-4-5", (200_000, 64_000)),
+    ("claude-3-7-sonnet", (200_000, 64_000)),
+    ("claude-3-5-haiku", (200_000, 8_192)),
+    ("claude-3-5-sonnet", (200_000, 8_192)),
+    ("claude-3-haiku", (200_000, 4_096)),
+    ("claude-", (200_000, 4_096)),
+]
+
+# モデル ID の接頭辞ごとの価格（USD / 100 万トークン）: (入力, 出力)。
+# キャッシュ書き込みは入力の 1.25 倍、キャッシュ読み込みは入力の 0.1 倍で計算する。
+MODEL_PRICES = [
+    ("claude-opus-4-5", (5.0, 25.0)),
+    ("claude-opus-4", (15.0, 75.0)),
+    ("claude-sonnet-4", (3.0, 15.0)),
+    ("claude-3-7-sonnet", (3.0, 15.0)),
+    ("claude-3-5-sonnet", (3.0, 15.0)),
+    ("claude-haiku-4-5", (1.0, 5.0)),
+    ("claude-3-5-haiku", (0.8, 4.0)),
+    ("claude-3-haiku", (0.25, 1.25)),
+]
+CACHE_WRITE_PRICE_RATIO = 1.25
+CACHE_READ_PRICE_RATIO = 0.1
+
+
+@dataclass
+class ModelInfo:
+    """モデル 1 件分のメタ情報。"""
+
+    id: str
+    display_name: str
+    created_at: Optional[str]
+    context_window: int
+    max_output_tokens: int
+
+
+def lookup_model_limits(model_id: str):
+    """モデル ID から (コンテキストウィンドウ, 最大出力トークン) を返す。"""
+    for prefix, limits in MODEL_LIMITS:
+        if model_id.startswith(prefix):
+            return limits
+    return MODEL_LIMITS[-1][1]
+
+
+def estimate_cost(model_id: str, metrics: dict) -> Optional[float]:
+    """
+    応答のトークン数（`run_stream()` の metrics）から概算の料金（USD）を返す。
+    価格が分からないモデルの場合は None。
+    """
+    for prefix, (input_price, output_price) in MODEL_PRICES:
+        if model_id.startswith(prefix):
+            break
+    else:
+        return None
+    cost = (
+        metrics.get("input_tokens", 0) * input_price
+        + metrics.get("cache_creation_input_tokens", 0)
+        * input_price
+        * CACHE_WRITE_PRICE_RATIO
+        + metrics.get("cache_read_input_tokens", 0) * input_price * CACHE_READ_PRICE_RATIO
+        + metrics.get("output_tokens", 0) * output_price
+    )
+    return round(cost / 1_000_000, 6)
+
+
+def _model_info(
+    model_id,
+    display_name=None,
+    created_at=None,
+    context_window=None,
+    max_output_tokens=None,
+):
+    default_window, default_output = lookup_model_limits(model_id)
+    return ModelInfo(
+        id=model_id,
+        display_name=display_name or model_id,
+        created_at=created_at,
+        context_window=context_window or default_window,
+        max_output_tokens=max_output_tokens or default_output,
+    )
+
+
+class ModelCatalog:
+    """
+    モデル一覧をメモリ・ディスク・API の順に参照するカタログ。
+    `models()` はブロックせず、期限切れならバックグラウンドスレッドで API から取り直す。
+    client_factory はクライアントを返す関数で、API から取得するときに呼ぶ。
+    """
+
+    def __init__(self, client_factory, path, ttl_seconds=CATALOG_TTL_SECONDS):
+        self._client_factory = client_factory
+        self._path = path
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._last_attempt = 0.0
+        self._models: List[ModelInfo] = []
+        self._fetched_at = 0.0
+        self._load_from_disk()
+
+    @property
+    def is_stale(self) -> bool:
+        return time.time() - self._fetched_at > self._ttl_seconds
+
+    @property
+    def is_refreshing(self) -> bool:
+        """バックグラウンドで API から取得中か。"""
+        return self._refreshing
+
+    def models(self) -> List[ModelInfo]:
+        """モデル一覧を新しい順に返す。期限切れならバックグラウンド更新を開始する。"""
+        if self.is_stale:
+            self.refresh_in_background()
+        return self._models or [_model_info(mid) for mid in FALLBACK_MODELS]
+
+    def model_ids(self) -> List[str]:
+        return [m.id for m in self.models()]
+
+    def get(self, model_id: str) -> ModelInfo:
+        """モデルのメタ情報を返す（一覧に無い場合は接頭辞から推定する）。"""
+        for model in self.models():
+            if model.id == model_id:
+                return model
+        return _model_info(model_id)
+
+    def refresh_in_background(self):
+        """更新中・直前に試行済みでなければ、API からの取得をデーモンスレッドで開始する。"""
+        with self._lock:
+            if self._refreshing or time.time() - self._last_attempt < RETRY_INTERVAL_SECONDS:
+                return
+            self._refreshing = True
+            self._last_attempt = time.time()
+        threading.Thread(target=self._refresh_safely, daemon=True).start()
+
+    def refresh(self):
+        """API からモデル一覧を取得してメモリとディスクを更新する（ブロックする）。"""
+        models = []
+        # list() のページはイテレートすると次のページも自動で取得する
+        for m in self._client_factory().models.list(limit=100):
+            if not m.id.startswith("claude-"):
+                continue
+            created_at = getattr(m, "created_at", None)
+            models.append(
+                _model_info(
+                    m.id,
+                    display_name=getattr(m, "display_name", None),
+                    created_at=created_at.isoformat() if created_at else None,
+                    # 新しい API バージョンで返される場合はそちらを優先する
+                    context_window=getattr(m, "max_input_tokens", None),
+                    max_output_tokens=getattr(m, "max_tokens", None),
+                )
+            )
+        if not models:
+            raise ValueError("No Claude models found")
+
+        # ID には日付が含まれているので、文字列降順にすると「新しいモデルが上」になる
+        models.sort(key=lambda m: m.id, reverse=True)
+        self._models = models
+        self._fetched_at = time.time()
+        self._save_to_disk()
+
+    def _refresh_safely(self):
+        try:
+            self.refresh()
+        except Exception:
+            # 取得に失敗しても現在の一覧（または固定の候補）を使い続ける
+            pass
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _load_from_disk(self):
+        try:
+            with open(self._path, encoding="utf-8") as f:
+                data = json.load(f)
+            self._models = [ModelInfo(**m) for m in data["models"]]
+            self._fetched_at = data["fetched_at"]
+        except (OSError, ValueError, KeyError, TypeError):
+            self._models, self._fetched_at = [], 0.0
+
+    def _save_to_disk(self):
+        data = {
+            "fetched_at": self._fetched_at,
+            "models": [asdict(m) for m in self._models],
+        }
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self._path)
+
+
+@st.cache_resource(show_spinner=False)
+def get_model_catalog() -> ModelCatalog:
+    """プロセス共有のモデルカタログを返す。"""
+    return ModelCatalog(get_client, get_data_dir() / "models.json")
+
+
+@span("model_list")
+def get_available_models() -> List[str]:
+    """利用可能なモデル ID の一覧（新しい順）。ネットワークを待たずに返す。"""
+    return get_model_catalog().model_ids()
@@ -0,0 +1,67 @@
+"""
+応答の max_tokens をモデルごとに決める「出力バジェット」。
+固定の max_tokens ではなく、そのモデルの最近の応答の長さ（出力トークン数）の p95 に
+余裕を持たせた値を使い、モデルの最大出力トークン数を上限にする。
+max_tokens の分はレート制限で出力トークンとして予約されるので、必要以上に大きくしない。
+上限で打ち切られた応答は generation_worker が続きを自動で生成してつなげる。
+"""
+import math
+import threading
+from collections import deque
+
+import streamlit as st
+
+from model_catalog import get_model_catalog
+from storage_paths import env_int
+from telemetry import percentile
+
+# 応答の長さが分かるまで（記録が MIN_SAMPLES 件未満の間）使う max_tokens
+DEFAULT_MAX_TOKENS = env_int("CHAT_MAX_TOKENS", 4096)
+# 自動で決める max_tokens の下限
+MIN_MAX_TOKENS = 1024
+# 上限で打ち切られた応答の続きを自動で生成する回数の上限（0 なら生成しない）
+MAX_CONTINUATIONS = env_int("CHAT_MAX_CONTINUATIONS", 3)
+# モデルごとに覚えておく応答の件数と、max_tokens を決めるのに必要な件数
+HISTORY_SIZE = 200
+MIN_SAMPLES = 5
+# p95 に掛ける余裕と、max_tokens の刻み
+HEADROOM = 1.5
+ROUND_TO = 256
+
+
+class OutputBudget:
+    """モデルごとの最近の応答の出力トークン数と、それに基づく max_tokens。"""
+
+    def __init__(self, default_max_tokens=DEFAULT_MAX_TOKENS, history_size=HISTORY_SIZE):
+        self._default = default_max_tokens
+        self._history_size = history_size
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, output_tokens: int):
+        """応答 1 件（続きの生成を含めた全体）の出力トークン数を記録する。"""
+        if not output_tokens:
+            return
+        with self._lock:
+            samples = self._samples.setdefault(model, deque(maxlen=self._history_size))
+            samples.append(output_tokens)
+
+    def max_tokens_for(self, model: str) -> int:
+        """model に送る max_tokens。最大出力トークン数を超えない。"""
+        limit = get_model_catalog().get(model).max_output_tokens
+        with self._lock:
+            samples = list(self._samples.get(model, ()))
+        if len(samples) < MIN_SAMPLES:
+            return min(self._default, limit)
+        budget = math.ceil(percentile(samples, 95) * HEADROOM / ROUND_TO) * ROUND_TO
+        return min(max(budget, MIN_MAX_TOKENS), limit)
+
+    def continuation_max_tokens(self, model: str, previous: int) -> int:
+        """続きを生成するときの max_tokens（前回の 2 倍、最大出力トークン数まで）。"""
+        return min(previous * 2, get_model_catalog().get(model).max_output_tokens)
+
+
+@st.cache_resource(show_spinner=False)
+def get_output_budget() -> OutputBudget:
+    """プロセス共有の出力バジェットを返す。"""
+    return OutputBudget()
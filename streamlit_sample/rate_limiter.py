@@ -0,0 +1,288 @@
+"""
+API 呼び出しのプロセス共通のレート制限。
+リクエスト数・入力トークン数・出力トークン数（いずれも 1 分あたり）のトークンバケットで
+送信を待たせ、上限は Messages API のレスポンスヘッダー（anthropic-ratelimit-*）に合わせて更新する
+（トークン数カウント API などは別のレート制限なので、ここでは数えない）。
+待っているリクエストは到着順（FIFO）に送り、429 / 529 を受けたらジッター付きの
+指数バックオフで送信を止め、同時実行数を半分に下げる（成功するたびに 1 ずつ戻す）。
+リトライはこのモジュールで行うので、SDK 側のリトライは無効にして呼び出す。
+"""
+import random
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional, Tuple
+
+import streamlit as st
+
+from request_builder import content_length
+from storage_paths import env_int
+
+# ヘッダーを受け取るまでの初期値（1 分あたり）
+DEFAULT_REQUESTS_PER_MINUTE = env_int("ANTHROPIC_RPM_LIMIT", 50)
+DEFAULT_INPUT_TOKENS_PER_MINUTE = env_int("ANTHROPIC_INPUT_TPM_LIMIT", 30000)
+DEFAULT_OUTPUT_TOKENS_PER_MINUTE = env_int("ANTHROPIC_OUTPUT_TPM_LIMIT", 8000)
+# 同時に送信するリクエスト数の上限
+MAX_CONCURRENCY = env_int("ANTHROPIC_MAX_CONCURRENCY", 8)
+# 429 / 529 のときのリトライ回数とバックオフ（秒）。SDK のリトライ回数とは別に設定する
+MAX_RETRIES = env_int("ANTHROPIC_RATE_LIMIT_RETRIES", 2)
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# 待機中に停止要求や順番を確認する間隔（秒）
+WAIT_POLL_SECONDS = 0.25
+
+RETRYABLE_STATUS_CODES = (429, 529)
+# ストリーミング中の error イベントは HTTP 200 の中で届くので、エラーの種類でも判定する
+RETRYABLE_ERROR_TYPES = ("rate_limit_error", "overloaded_error")
+# レート制限のヘッダーでバケットを更新するエンドポイント（Messages API）
+MESSAGES_PATH = "/v1/messages"
+
+# (バケット名, レスポンスヘッダーの接頭辞)
+_HEADER_BUCKETS = (
+    ("requests", "anthropic-ratelimit-requests-"),
+    ("input_tokens", "anthropic-ratelimit-input-tokens-"),
+    ("output_tokens", "anthropic-ratelimit-output-tokens-"),
+)
+
+
+class TokenBucket:
+    """1 分あたり per_minute の割合で補充されるトークンバケット。"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        rate = self.capacity / 60.0
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * rate)
+        self._updated = now
+
+    def wait_time(self, amount, now) -> float:
+        """amount を取り出せるまでの秒数。容量を超える量は、満タンになれば取り出せる。"""
+        self._refill(now)
+        needed = min(amount, self.capacity) - self.tokens
+        return max(needed, 0) * 60.0 / self.capacity
+
+    def consume(self, amount):
+        # 容量を超える量も取り出せるようにし、その分は負の残量として後で補充する
+        self.tokens -= amount
+
+    def refund(self, amount):
+        """amount を戻す（負なら、見積もりより多く使った分を取り出す）。"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def sync(self, limit, remaining, now):
+        """API が返した上限と残量に合わせる（残量はサーバー側の値を超えないようにする）。"""
+        self._refill(now)
+        self.capacity = limit
+        self.tokens = min(self.tokens, remaining)
+
+
+class RateLimitCancelled(Exception):
+    """順番待ちの間に停止が要求された。"""
+
+
+class RateLimiter:
+    """プロセス共通のレート制限と、429 / 529 のリトライ。"""
+
+    def __init__(
+        self,
+        requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+        input_tokens_per_minute=DEFAULT_INPUT_TOKENS_PER_MINUTE,
+        output_tokens_per_minute=DEFAULT_OUTPUT_TOKENS_PER_MINUTE,
+        max_concurrency=MAX_CONCURRENCY,
+        max_retries=MAX_RETRIES,
+    ):
+        self._buckets = {
+            "requests": TokenBucket(requests_per_minute),
+            "input_tokens": TokenBucket(input_tokens_per_minute),
+            "output_tokens": TokenBucket(output_tokens_per_minute),
+        }
+        self._max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self._max_retries = max_retries
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._blocked_until = 0.0
+        self._failures = 0
+
+    def queue_length(self) -> int:
+        return len(self._queue)
+
+    def observe_response(self, response):
+        """
+        httpx のレスポンスフックから呼び、Messages API のレスポンスのレート制限のヘッダーで
+        バケットを更新する（他のエンドポイントのヘッダーはそれぞれのレート制限の値なので使わない）。
+        """
+        if not response.request.url.path.endswith(MESSAGES_PATH):
+            return
+        headers = response.headers
+        now = time.monotonic()
+        with self._cond:
+            for name, prefix in _HEADER_BUCKETS:
+                limit = headers.get(prefix + "limit")
+                remaining = headers.get(prefix + "remaining")
+                if limit and remaining and limit.isdigit() and remaining.isdigit():
+                    self._buckets[name].sync(int(limit), int(remaining), now)
+            self._cond.notify_all()
+
+    def _acquire(self, input_tokens, output_tokens, should_stop, on_queue):
+        ticket = object()
+        costs = {"requests": 1, "input_tokens": input_tokens, "output_tokens": output_tokens}
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    if should_stop and should_stop():
+                        raise RateLimitCancelled()
+                    now = time.monotonic()
+                    position = self._queue.index(ticket)
+                    wait = None
+                    if position == 0 and self.in_flight < self.concurrency:
+                        wait = max(
+                            [self._blocked_until - now]
+                            + [b.wait_time(costs[n], now) for n, b in self._buckets.items()]
+                        )
+                        if wait <= 0:
+                            for name, bucket in self._buckets.items():
+                                bucket.consume(costs[name])
+                            self.in_flight += 1
+                            return
+                    if on_queue:
+                        on_queue(position + 1)
+                    self._cond.wait(
+                        WAIT_POLL_SECONDS if wait is None else min(wait, WAIT_POLL_SECONDS)
+                    )
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+
+    def _release(self, input_tokens, output_tokens, metrics=None, rate_limited=None):
+        """
+        送信の終了を記録し、予約したトークン数を metrics の実際の値で精算する
+        （出力は max_tokens を予約しているので、使わなかった分を戻す）。
+        rate_limited に 429 / 529 の例外を渡すとバックオフし、同時実行数を下げる。
+        同時実行数を 1 つ戻すのは成功した（metrics がある）場合だけで、
+        それ以外のエラーでは同時実行数もバックオフの状態も変えない。
+        """
+        with self._cond:
+            self.in_flight -= 1
+            used_input, used_output = 0, 0
+            if metrics is not None:
+                # キャッシュから読んだ入力トークンは入力トークンのレート制限に数えられない
+                used_input = (metrics.get("input_tokens") or 0) + (
+                    metrics.get("cache_creation_input_tokens") or 0
+                )
+                used_output = metrics.get("output_tokens") or 0
+            self._buckets["input_tokens"].refund(input_tokens - used_input)
+            self._buckets["output_tokens"].refund(output_tokens - used_output)
+            if rate_limited is None:
+                if metrics is not None:
+                    self._failures = 0
+                    self.concurrency = min(self.concurrency + 1, self._max_concurrency)
+            else:
+                self._failures += 1
+                self.concurrency = max(self.concurrency // 2, 1)
+                backoff = min(
+                    BACKOFF_BASE_SECONDS * 2 ** (self._failures - 1), BACKOFF_MAX_SECONDS
+                )
+                # ジッター: 同時に失敗したリクエストが一斉に再送しないよう散らす
+                delay = max(_retry_after(rate_limited), backoff * random.uniform(0.5, 1.0))
+                self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self._cond.notify_all()
+
+    def call(
+        self,
+        func: Callable[[], dict],
+        input_tokens: int,
+        output_tokens: int,
+        should_stop: Optional[Callable[[], bool]] = None,
+        on_queue: Optional[Callable[[int], None]] = None,
+    ) -> Tuple[dict, int]:
+        """
+        順番とレート制限を待ってから func() を呼び、429 / 529 ならバックオフしてリトライする。
+        input_tokens は入力トークン数の見積もり、output_tokens は max_tokens。
+        func は API を 1 回呼び、run_stream() の metrics を返す（トークン数の精算に使う）。
+        戻り値は (metrics, リトライ回数)。順番待ちの間に停止された場合は
+        RateLimitCancelled を送出する。
+        """
+        attempt = 0
+        while True:
+            self._acquire(input_tokens, output_tokens, should_stop, on_queue)
+            try:
+                metrics = func()
+            except Exception as e:
+                retryable = is_retryable(e)
+                self._release(
+                    input_tokens, output_tokens, rate_limited=e if retryable else None
+                )
+                if not retryable or attempt >= self._max_retries:
+                    raise
+                attempt += 1
+                continue
+            self._release(input_tokens, output_tokens, metrics)
+            return metrics, attempt
+
+    def run(
+        self,
+        func: Callable,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ):
+        """
+        API を 1 回呼ぶ func() を call() と同じ順番待ち・リトライで呼び、その戻り値を返す
+        （ストリーミングしない Messages API の呼び出し: 要約など）。
+        戻り値に usage があればそのトークン数で精算し、無ければ見積もりのまま精算する。
+        """
+        result = []
+
+        def send():
+            result.append(func())
+            usage = getattr(result[-1], "usage", None)
+            if usage is None:
+                return {"input_tokens": input_tokens, "output_tokens": output_tokens}
+            return {
+                "input_tokens": usage.input_tokens,
+                "cache_creation_input_tokens": usage.cache_creation_input_tokens,
+                "output_tokens": usage.output_tokens,
+            }
+
+        self.call(send, input_tokens, output_tokens, should_stop)
+        return result[-1]
+
+
+def estimate_input_tokens(messages) -> int:
+    """
+    送信前の入力トークン数の見積もり（送信後に実際の値で精算する）。
+    日本語は 1 文字が 1 トークン前後になるので、2 文字 = 1 トークンとして多めに見積もる
+    （添付は content_length() の換算による）。
+    """
+    return sum(content_length(m["content"]) for m in messages) // 2 + 1
+
+
+def is_retryable(error) -> bool:
+    """レート制限（429）または過負荷（529）によるエラーか。"""
+    if getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES:
+        return True
+    body = getattr(error, "body", None)
+    if isinstance(body, dict) and isinstance(body.get("error"), dict):
+        return body["error"].get("type") in RETRYABLE_ERROR_TYPES
+    return False
+
+
+def _retry_after(error) -> float:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else 0.0
+    except ValueError:
+        return 0.0
+
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter() -> RateLimiter:
+    """プロセス共有のレート制限を返す。"""
+    return RateLimiter()
@@ -0,0 +1,103 @@
+"""
+Messages API のリクエストを組み立てるヘルパー。
+会話の変化しない先頭部分（プレフィックス）に `cache_control` のブレークポイントを置き、
+長い会話や復元した会話の続きでプロンプトキャッシュが効くようにする。
+"""
+from typing import List, Optional
+
+CACHE_CONTROL = {"type": "ephemeral"}
+# 送信前の見積もりで、添付を何文字として数えるか（日本語の 2 文字 = 1 トークンに揃える）。
+# 画像は大きさによらず最大 1,600 トークン程度、PDF は元のバイト数から見積もる
+IMAGE_CHARS = 3200
+PDF_BYTES_PER_CHAR = 8
+
+
+def _to_blocks(content):
+    """メッセージの content をコンテンツブロックのリストに揃える（元の値は変更しない）。"""
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}]
+    return [dict(block) for block in content]
+
+
+def content_length(content) -> int:
+    """
+    content の文字数。添付のブロックは、トークン数の見積もり用に文字数へ換算する
+    （送信後に実際のトークン数で精算するので、多めの目安でよい）。
+    """
+    if isinstance(content, str):
+        return len(content)
+    total = 0
+    for block in content:
+        source = block.get("source") or {}
+        if block.get("type") == "text":
+            total += len(block["text"])
+        elif source.get("type") == "text":
+            total += len(source["data"])
+        elif block.get("type") == "image":
+            total += IMAGE_CHARS
+        elif source.get("type") == "base64":
+            total += len(source["data"]) * 3 // 4 // PDF_BYTES_PER_CHAR
+    return total
+
+
+def content_text(content) -> str:
+    """content のテキスト（添付は名前だけにする）。要約の入力など、テキストとして扱う場合に使う。"""
+    if isinstance(content, str):
+        return content
+    parts = []
+    for block in content:
+        if block.get("type") == "text":
+            parts.append(block["text"])
+        else:
+            parts.append(f"[添付: {block.get('title') or block.get('type')}]")
+    return "\n".join(parts)
+
+
+def _with_breakpoint(message: dict) -> dict:
+    """メッセージの最後のコンテンツブロックに cache_control を付けたコピーを返す。"""
+    blocks = _to_blocks(message["content"])
+    if not blocks:
+        return message
+    blocks[-1]["cache_control"] = CACHE_CONTROL
+    return {"role": message["role"], "content": blocks}
+
+
+def add_cache_breakpoints(messages: List[dict]) -> List[dict]:
+    """
+    会話にキャッシュのブレークポイントを 2 か所置く。
+
+    - 最後のメッセージ: 今回送る会話全体をキャッシュに書き込み、次のターンで読み込めるようにする
+    - 1 つ前の user メッセージ: 前のターンで書き込んだプレフィックスを確実に読み込む
+    """
+    if not messages:
+        return messages
+
+    cached = list(messages)
+    cached[-1] = _with_breakpoint(cached[-1])
+    for i in range(len(cached) - 2, -1, -1):
+        if cached[i]["role"] == "user":
+            cached[i] = _with_breakpoint(cached[i])
+            break
+    return cached
+
+
+def build_messages_request(
+    model: str,
+    max_tokens: int,
+    messages: List[dict],
+    system: Optional[str] = None,
+) -> dict:
+    """
+    `client.messages.create()` / `client.messages.stream()` に渡す引数 dict を返す。
+    system を指定した場合はシステムプロンプトにもブレークポイントを置く。
+    """
+    request = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "messages": add_cache_breakpoints(messages),
+    }
+    if system:
+        request["system"] = [
+            {"type": "text", "text": system, "cache_control": CACHE_CONTROL}
+        ]
+    return request
@@ -0,0 +1,212 @@
+"""
+同じ質問に対する応答のキャッシュ（完全一致）。
+キーは (モデル, max_tokens の設定, 正規化した履歴) のハッシュで、
+メモリ上の LRU とディスク（SQLite）の 2 段で保持する。
+ディスクのエントリは TTL とサイズ上限で削除する。
+"""
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Optional, Union
+
+import streamlit as st
+
+from storage_paths import env_float, env_int, get_data_dir
+
+# メモリに保持するエントリ数
+MEMORY_ENTRIES = 256
+# エントリの有効期限（秒）
+CACHE_TTL_SECONDS = env_int("RESPONSE_CACHE_TTL", 7 * 24 * 60 * 60)
+# ディスクキャッシュの上限（バイト）。超えたら最後に使われたのが古いものから削除する
+MAX_DISK_BYTES = int(env_float("RESPONSE_CACHE_MAX_MB", 100) * 1024 * 1024)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used);
+"""
+
+
+def _normalize_content(content):
+    if isinstance(content, str):
+        return content.strip()
+    return [
+        {k: v for k, v in block.items() if k != "cache_control"} for block in content
+    ]
+
+
+def make_cache_key(model: str, max_tokens: Union[int, str], messages: List[dict]) -> str:
+    """
+    キャッシュのキー。max_tokens は固定値か、出力バジェットで決める場合は "auto"。
+    前後の空白やキャッシュのブレークポイントなど、応答に影響しない違いは正規化してから
+    sha256 を取る。
+    """
+    normalized = [
+        {"role": m["role"], "content": _normalize_content(m["content"])}
+        for m in messages
+    ]
+    payload = json.dumps(
+        [model, max_tokens, normalized], ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """メモリ LRU + SQLite の 2 段の応答キャッシュ。ヒット・ミスの回数も数える。"""
+
+    def __init__(
+        self,
+        path,
+        memory_entries=MEMORY_ENTRIES,
+        ttl_seconds=CACHE_TTL_SECONDS,
+        max_disk_bytes=MAX_DISK_BYTES,
+    ):
+        self._memory = OrderedDict()
+        # メモリでヒットしたエントリの最終使用時刻（次の put() でディスクに書き戻す）
+        self._touched = {}
+        self._memory_entries = memory_entries
+        self._ttl_seconds = ttl_seconds
+        self._max_disk_bytes = max_disk_bytes
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._transaction() as conn:
+            conn.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock, self._conn:
+            yield self._conn
+
+    def get(self, key: str) -> Optional[dict]:
+        """キャッシュされた応答を返す。無いか期限切れなら None。"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] > now:
+                self._memory.move_to_end(key)
+                self._touched[key] = now
+                self.hits += 1
+                return entry[1]
+
+            with self._transaction() as conn:
+                row = conn.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None or row[1] <= now:
+                    if row is not None:
+                        conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._memory.pop(key, None)
+                    self.misses += 1
+                    return None
+                conn.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?", (now, key)
+                )
+
+            value = json.loads(row[0])
+            self._remember(key, row[1], value)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: dict):
+        """応答を保存し、ディスクの上限を超えていれば古いエントリを削除する。"""
+        now = time.time()
+        expires_at = now + self._ttl_seconds
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, expires_at, value)
+            with self._transaction() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, data, len(data.encode("utf-8")), expires_at, now),
+                )
+                conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+                # メモリでのヒットも LRU の順番に反映してから削除する
+                conn.executemany(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    [(used, k) for k, used in self._touched.items()],
+                )
+                self._touched.clear()
+                self._evict(conn)
+
+    def _remember(self, key, expires_at, value):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self._max_disk_bytes:
+            return
+        # 上限の 9 割まで、最後に使われたのが古い順に削除する
+        target = total - int(self._max_disk_bytes * 0.9)
+        freed = 0
+        evicted = []
+        for key, size in conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ):
+            if freed >= target:
+                break
+            evicted.append((key,))
+            freed += size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        for (key,) in evicted:
+            self._memory.pop(key, None)
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> ResponseCache:
+    """プロセス共有の応答キャッシュを返す。"""
+    return ResponseCache(get_data_dir() / "response_cache.sqlite3")
+
+
+def render_response_cache_controls():
+    """
+    サイドバーに応答キャッシュの設定（有効化・このターンだけ使わない）と
+    ヒット・ミスの回数を表示する。
+    """
+    cache = get_response_cache()
+    # 前のターンで使った「次のターンはキャッシュを使わない」を解除する
+    # （ウィジェットの作成後は値を変更できないため、作成前に行う）
+    if st.session_state.pop("response_cache_bypass_used", False):
+        st.session_state["response_cache_bypass"] = False
+    with st.sidebar:
+        st.subheader("応答キャッシュ")
+        enabled = st.toggle(
+            "同じ質問には保存済みの応答を返す",
+            key="response_cache_enabled",
+            help="モデル・max_tokens の設定・会話履歴が完全に一致する場合に、API を呼ばずに保存済みの応答を返します（最後まで生成された応答だけを保存します）。",
+        )
+        st.checkbox(
+            "次のターンはキャッシュを使わない",
+            key="response_cache_bypass",
+            disabled=not enabled,
+        )
+        total = cache.hits + cache.misses
+        hit_rate = f"{cache.hits / total:.0%}" if total else "-"
+        st.caption(f"ヒット {cache.hits} / ミス {cache.misses}（ヒット率 {hit_rate}）")
+
+
+def response_cache_for_turn() -> Optional[ResponseCache]:
+    """
+    このターンで使う応答キャッシュ（使わない場合は None）。
+    「次のターンはキャッシュを使わない」は 1 ターンだけ有効で、次の再実行で解除する。
+    """
+    if not st.session_state.get("response_cache_enabled", False):
+        return None
+    if st.session_state.get("response_cache_bypass"):
+        st.session_state["response_cache_bypass_used"] = True
+        return None
+    return get_response_cache()
@@ -0,0 +1,197 @@
+"""
+セッションごとのメモリ上限（複数ユーザーでの運用向け）。
+各セッションがメモリに持つメッセージを上限バイト数までに抑え、古いものは会話ストアに
+退避する（ストアには全メッセージが保存済みなので、セッションから外すだけでよい）。
+一定時間操作の無いセッションは履歴をすべて退避し、次に操作されたときに直近の分だけ読み戻す。
+これにより、プロセスのメモリは作成された履歴の総量ではなく、アクティブなセッション数に比例する。
+"""
+import json
+import sys
+import threading
+import time
+import weakref
+from typing import Tuple
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from chat_history_view import RECENT_MESSAGE_COUNT
+from conversation_store import get_conversation_store
+from storage_paths import env_float, env_int
+
+# 1 セッションがメモリに持つメッセージの上限（直近 RECENT_MESSAGE_COUNT 件は常に残す）
+SESSION_MEMORY_BUDGET_BYTES = int(env_float("CHAT_SESSION_MEMORY_KB", 512) * 1024)
+# この時間（秒）操作の無いセッションは履歴を会話ストアに退避する
+SESSION_IDLE_SECONDS = env_int("CHAT_SESSION_IDLE_SECONDS", 15 * 60)
+# アイドルなセッションを確認する間隔（秒）
+EVICTION_INTERVAL_SECONDS = 60
+
+
+def message_bytes(msg) -> int:
+    """メッセージがメモリ上で占めるおおよそのバイト数。"""
+    size = sys.getsizeof(msg) + sys.getsizeof(msg.content)
+    if msg.meta:
+        size += sys.getsizeof(msg.meta) + len(json.dumps(msg.meta, ensure_ascii=False))
+    return size
+
+
+class _SessionEntry:
+    __slots__ = ("last_seen", "state_ref", "resident_bytes")
+
+    def __init__(self, state_ref):
+        self.last_seen = time.time()
+        self.state_ref = state_ref
+        self.resident_bytes = 0
+
+
+class SessionRegistry:
+    """
+    プロセス内のセッションの一覧。セッション状態は弱参照で持つので、
+    ブラウザが閉じられて Streamlit がセッションを破棄すれば一覧からも消える。
+    アイドルなセッションの確認は、他のセッションの再実行のついでに行う
+    （誰も操作していなければメモリも増えないため、専用のスレッドは持たない）。
+    """
+
+    def __init__(self, idle_seconds=SESSION_IDLE_SECONDS):
+        self._idle_seconds = idle_seconds
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._last_eviction = time.time()
+
+    def touch(self, session_id, session_state):
+        """再実行の開始時に呼び、セッションの最終操作時刻を更新する。"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry.state_ref() is not session_state:
+                entry = _SessionEntry(weakref.ref(session_state))
+                self._sessions[session_id] = entry
+            entry.last_seen = time.time()
+
+    def set_resident_bytes(self, session_id, resident_bytes):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                entry.resident_bytes = resident_bytes
+
+    def maybe_evict_idle(self) -> int:
+        """前回の確認から一定時間経っていれば、アイドルなセッションの履歴を退避する。"""
+        now = time.time()
+        if now - self._last_eviction < EVICTION_INTERVAL_SECONDS:
+            return 0
+        self._last_eviction = now
+        return self.evict_idle(now)
+
+    def evict_idle(self, now=None) -> int:
+        """アイドルなセッションの履歴を会話ストアに退避し、退避したセッション数を返す。"""
+        now = time.time() if now is None else now
+        evicted = 0
+        with self._lock:
+            for session_id, entry in list(self._sessions.items()):
+                state = entry.state_ref()
+                if state is None:
+                    del self._sessions[session_id]
+                elif entry.resident_bytes and now - entry.last_seen > self._idle_seconds:
+                    if _spill_all(state):
+                        entry.resident_bytes = 0
+                        evicted += 1
+        return evicted
+
+    def stats(self) -> Tuple[int, int]:
+        """(セッション数, メモリ上のメッセージの合計バイト数)。"""
+        with self._lock:
+            for session_id, entry in list(self._sessions.items()):
+                if entry.state_ref() is None:
+                    del self._sessions[session_id]
+            return (
+                len(self._sessions),
+                sum(e.resident_bytes for e in self._sessions.values()),
+            )
+
+
+def _spill_all(state) -> bool:
+    """セッション状態のメッセージをすべて退避する（会話ストアに無い会話は退避しない）。"""
+    if "conversation_id" not in state or state["conversation_id"] is None:
+        return False
+    messages = state["messages"]
+    offset = state["history_offset"] if "history_offset" in state else 0
+    state["messages"] = []
+    state["history_offset"] = offset + len(messages)
+    # 作成済みの保存用データも、必要になったら作り直す
+    if "chat_export" in state:
+        del state["chat_export"]
+    return True
+
+
+@st.cache_resource(show_spinner=False)
+def get_session_registry() -> SessionRegistry:
+    """プロセス共有のセッション一覧を返す。"""
+    return SessionRegistry()
+
+
+def track_session():
+    """
+    再実行の最初（セッション状態を読む前）に呼ぶ。
+    このセッションを一覧に登録し、退避されていた履歴の直近の分を読み戻す。
+    ついでに、他のアイドルなセッションの履歴を退避する。
+    """
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    registry = get_session_registry()
+    registry.touch(ctx.session_id, ctx.session_state)
+    registry.maybe_evict_idle()
+
+    messages = st.session_state.get("messages")
+    offset = st.session_state.get("history_offset", 0)
+    if messages is None or not offset or len(messages) >= RECENT_MESSAGE_COUNT:
+        return
+    start = max(offset + len(messages) - RECENT_MESSAGE_COUNT, 0)
+    store = get_conversation_store()
+    messages[:0] = store.load_messages(st.session_state["conversation_id"], start, offset)
+    st.session_state["history_offset"] = start
+
+
+def enforce_memory_budget(budget_bytes=SESSION_MEMORY_BUDGET_BYTES):
+    """
+    メモリ上のメッセージが上限を超えていれば、古いものからセッションから外す
+    （会話ストアには保存済み）。直近 RECENT_MESSAGE_COUNT 件は常に残す。
+    作成済みの保存用データ（chat_export）も上限に数え、メッセージと合わせて超える場合は
+    破棄する（必要になったらボタンで作り直す）。
+    """
+    messages = st.session_state["messages"]
+    resident, keep = 0, 0
+    for msg in reversed(messages):
+        size = message_bytes(msg)
+        if keep >= RECENT_MESSAGE_COUNT and resident + size > budget_bytes:
+            break
+        resident += size
+        keep += 1
+
+    # ストアに保存されていない会話（最初の発言前）は退避できない
+    drop = len(messages) - keep
+    if drop and st.session_state.get("conversation_id") is not None:
+        del messages[:drop]
+        st.session_state["history_offset"] = st.session_state.get("history_offset", 0) + drop
+    elif drop:
+        resident = sum(map(message_bytes, messages))
+
+    export = st.session_state.get("chat_export")
+    if export is not None:
+        if resident + len(export["data"]) > budget_bytes:
+            del st.session_state["chat_export"]
+        else:
+            resident += len(export["data"])
+
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        get_session_registry().set_resident_bytes(ctx.session_id, resident)
+
+
+def render_session_memory_status():
+    """サイドバーに、プロセス全体のセッション数とメモリ上のメッセージ量を表示する。"""
+    sessions, resident = get_session_registry().stats()
+    offset = st.session_state.get("history_offset", 0)
+    caption = f"サーバー: セッション {sessions} / メモリ上の履歴 {resident / 1024:,.0f} KB"
+    if offset:
+        caption += f"（この会話の {offset}件は会話ストアに退避中）"
+    st.sidebar.caption(caption)
@@ -0,0 +1,36 @@
+"""
+アプリの設定（環境変数・`.env`）と、ローカルに保存するデータ（モデル一覧のキャッシュなど）の置き場所。
+`.env` はこのモジュールの import 時に 1 回だけ読み込むので、環境変数から定数を決めるモジュールは
+env_int() などをここから import して使う（`.env` の値が定数の決定より先に反映される）。
+データの置き場所は環境変数 CHAT_DATA_DIR で変更できる（既定はリポジトリ直下の `.chat_data`）。
+"""
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+# 既に設定されている環境変数は上書きしない
+load_dotenv()
+
+DEFAULT_DATA_DIR = Path(__file__).resolve().parent.parent / ".chat_data"
+
+
+def env_str(name: str, default: str) -> str:
+    return os.getenv(name) or default
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def get_data_dir() -> Path:
+    """データディレクトリを返す（無ければ作成する）。"""
+    data_dir = Path(os.getenv("CHAT_DATA_DIR") or DEFAULT_DATA_DIR)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    return data_dir
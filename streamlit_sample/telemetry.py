@@ -0,0 +1,241 @@
+"""
+レイテンシとトークン数の計測。
+API 呼び出しと、再実行中の各処理（モデル一覧の取得・履歴の描画・保存用ファイルの作成）を
+スパンとしてセッション状態に記録し、サイドバーに集計を表示する。
+記録は CSV または OpenMetrics のテキストとしてダウンロードできる。
+"""
+import csv
+import io
+import math
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import streamlit as st
+
+# セッションごとに保持するスパンの件数（古いものから捨てる）
+MAX_SPANS = 1000
+
+SPAN_LABELS = {
+    "api_call": "API 呼び出し",
+    "cache_hit": "応答キャッシュ",
+    "model_list": "モデル一覧の取得",
+    "history_render": "履歴の描画",
+    "export_build": "保存用ファイルの作成",
+}
+
+# API 呼び出しのスパンに付ける run_stream() の metrics のキー
+API_METRIC_FIELDS = [
+    "time_to_first_token",
+    "input_tokens",
+    "output_tokens",
+    "cache_read_input_tokens",
+    "cache_creation_input_tokens",
+    "stop_reason",
+    "retries",
+    "continuations",
+    "continuation_tokens_saved",
+]
+
+CSV_FIELDS = ["timestamp", "name", "duration", "model", "status"] + API_METRIC_FIELDS
+
+
+def _spans() -> deque:
+    if "telemetry_spans" not in st.session_state:
+        st.session_state["telemetry_spans"] = deque(maxlen=MAX_SPANS)
+    return st.session_state["telemetry_spans"]
+
+
+def record_span(name: str, duration: float, **fields):
+    """計測結果を 1 件記録する。duration は秒。"""
+    _spans().append(
+        {"timestamp": time.time(), "name": name, "duration": duration, **fields}
+    )
+
+
+@contextmanager
+def span(name: str, **fields):
+    """with ブロックの所要時間を記録する。"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started, **fields)
+
+
+def record_generation(job):
+    """終了した生成ジョブの API 呼び出しを記録する（応答キャッシュのヒットは別に数える）。"""
+    if job.cached:
+        record_span("cache_hit", job.metrics.get("latency", 0.0), model=job.model)
+        return
+    metrics = job.metrics
+    record_span(
+        "api_call",
+        metrics.get("latency", time.time() - job.created_at),
+        model=job.model,
+        status=job.status,
+        **{k: metrics.get(k) for k in API_METRIC_FIELDS},
+    )
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """最近傍法による q パーセンタイル（0〜100）。値が無ければ None。"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(q * len(ordered) / 100), 1)
+    return ordered[rank - 1]
+
+
+def summarize(spans) -> Dict[str, dict]:
+    """スパン名ごとの件数・合計・p50 / p95（秒）。"""
+    durations = {}
+    for s in spans:
+        durations.setdefault(s["name"], []).append(s["duration"])
+    return {
+        name: {
+            "count": len(values),
+            "sum": sum(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+        }
+        for name, values in durations.items()
+    }
+
+
+def _api_calls(spans) -> List[dict]:
+    return [s for s in spans if s["name"] == "api_call" and s.get("status") != "error"]
+
+
+def output_tokens_per_second(call: dict) -> Optional[float]:
+    """最初のトークンから最後までの出力速度（トークン/秒）。"""
+    ttft = call.get("time_to_first_token")
+    if ttft is None or not call.get("output_tokens"):
+        return None
+    generating = call["duration"] - ttft
+    return call["output_tokens"] / generating if generating > 0 else None
+
+
+def spans_to_csv(spans) -> str:
+    """スパンを CSV にする。"""
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for s in spans:
+        writer.writerow(s)
+    return out.getvalue()
+
+
+def spans_to_openmetrics(spans) -> str:
+    """スパンの集計を OpenMetrics のテキスト形式にする。"""
+    lines = [
+        "# TYPE chat_span_duration_seconds summary",
+        "# UNIT chat_span_duration_seconds seconds",
+        "# HELP chat_span_duration_seconds Duration of instrumented phases.",
+    ]
+    for name, stats in sorted(summarize(spans).items()):
+        for quantile, key in (("0.5", "p50"), ("0.95", "p95")):
+            lines.append(
+                f'chat_span_duration_seconds{{span="{name}",quantile="{quantile}"}}'
+                f" {stats[key]:.6f}"
+            )
+        lines.append(f'chat_span_duration_seconds_sum{{span="{name}"}} {stats["sum"]:.6f}')
+        lines.append(f'chat_span_duration_seconds_count{{span="{name}"}} {stats["count"]}')
+
+    calls = _api_calls(spans)
+    lines += [
+        "# TYPE chat_tokens counter",
+        "# HELP chat_tokens Tokens sent to and generated by the API.",
+    ]
+    for direction, key in (("input", "input_tokens"), ("output", "output_tokens")):
+        total = sum(c.get(key) or 0 for c in calls)
+        lines.append(f'chat_tokens_total{{direction="{direction}"}} {total}')
+    lines += [
+        "# TYPE chat_api_retries counter",
+        "# HELP chat_api_retries Retries performed by the rate limiter after 429 / 529 responses.",
+        f"chat_api_retries_total {sum(c.get('retries') or 0 for c in calls)}",
+        "# TYPE chat_api_continuations counter",
+        "# HELP chat_api_continuations Extra calls made to continue truncated replies.",
+        f"chat_api_continuations_total {sum(c.get('continuations') or 0 for c in calls)}",
+        "# EOF",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def _format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.3f}秒"
+
+
+def render_telemetry_panel():
+    """サイドバーに計測結果（p50 / p95、出力速度、トークン数の推移）を表示する。"""
+    spans = list(_spans())
+    with st.sidebar.expander("計測（レイテンシ・トークン）"):
+        if not spans:
+            st.caption("まだ計測結果がありません。")
+            return
+
+        calls = _api_calls(spans)
+        if calls:
+            latencies = [c["duration"] for c in calls]
+            ttfts = [
+                c["time_to_first_token"]
+                for c in calls
+                if c.get("time_to_first_token") is not None
+            ]
+            speeds = [v for v in map(output_tokens_per_second, calls) if v is not None]
+            col1, col2 = st.columns(2)
+            col1.metric("レイテンシ p50", _format_seconds(percentile(latencies, 50)))
+            col2.metric("レイテンシ p95", _format_seconds(percentile(latencies, 95)))
+            col1.metric("初回トークン p50", _format_seconds(percentile(ttfts, 50)))
+            col2.metric(
+                "出力速度",
+                f"{sum(speeds) / len(speeds):.1f} tok/s" if speeds else "-",
+            )
+            input_total = sum(c.get("input_tokens") or 0 for c in calls)
+            output_total = sum(c.get("output_tokens") or 0 for c in calls)
+            col1.metric("入力トークン計", f"{input_total:,}")
+            col2.metric("出力トークン計", f"{output_total:,}")
+            retries = sum(c.get("retries") or 0 for c in calls)
+            if retries:
+                st.caption(f"リトライ: {retries} 回")
+            continuations = sum(c.get("continuations") or 0 for c in calls)
+            if continuations:
+                saved = sum(c.get("continuation_tokens_saved") or 0 for c in calls)
+                st.caption(
+                    f"続きの自動生成: {continuations} 回"
+                    f"（履歴の {saved:,} トークンをキャッシュから読み込み）"
+                )
+            # 呼び出しごとのトークン数の推移
+            st.line_chart(
+                {
+                    "入力": [c.get("input_tokens") or 0 for c in calls],
+                    "出力": [c.get("output_tokens") or 0 for c in calls],
+                },
+                height=160,
+            )
+
+        rows = [
+            {
+                "処理": SPAN_LABELS.get(name, name),
+                "回数": stats["count"],
+                "p50 (ms)": round(stats["p50"] * 1000, 1),
+                "p95 (ms)": round(stats["p95"] * 1000, 1),
+            }
+            for name, stats in summarize(spans).items()
+        ]
+        st.dataframe(rows, hide_index=True)
+
+        col1, col2 = st.columns(2)
+        col1.download_button(
+            "CSV",
+            data=spans_to_csv(spans),
+            file_name="chat_telemetry.csv",
+            mime="text/csv",
+        )
+        col2.download_button(
+            "OpenMetrics",
+            data=spans_to_openmetrics(spans),
+            file_name="chat_telemetry.txt",
+            mime="application/openmetrics-text",
+        )
@@ -0,0 +1,14 @@
+"""
+テスト共通の設定。アプリのモジュールは streamlit_sample にフラットに置かれ、
+`streamlit run` のときと同じくディレクトリ直下から import するので、import パスに追加する。
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# storage_paths の import（.env の読み込み）より前に、データの置き場所を一時ディレクトリにする
+# （load_dotenv() は設定済みの環境変数を上書きしないので、リポジトリの .env にも影響されない）
+os.environ["CHAT_DATA_DIR"] = tempfile.mkdtemp(prefix="chat_data_test_")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "streamlit_sample"))
@@ -0,0 +1,33 @@
+"""ベンチマークのハーネスが最後まで動くか（API のスタブに対して 1 回ずつ実行する）。"""
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+BENCHMARK = Path(__file__).resolve().parent.parent / "benchmarks" / "run_benchmarks.py"
+
+
+def test_quick_benchmark_runs(tmp_path):
+    output = tmp_path / "bench.json"
+    subprocess.run(
+        [
+            sys.executable,
+            str(BENCHMARK),
+            "--quick",
+            "--repeat",
+            "1",
+            "--only",
+            "export",
+            "import",
+            "turn",
+            "--output",
+            str(output),
+        ],
+        check=True,
+        capture_output=True,
+        timeout=300,
+    )
+    results = json.loads(output.read_text(encoding="utf-8"))["results"]
+    assert {r["format"] for r in results["import"]} == {"json", "md", "chatarc"}
+    # 入力欄から送信した質問に、スタブの応答が返ってくる（全アプリ）
+    assert len(results["turn"]) == 3
@@ -0,0 +1,171 @@
+"""アーカイブ（.chatarc）の往復・位置を指定した読み出し・追記・破損の検出と CLI。"""
+import io
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import chat_archive
+from chat_archive import (
+    CODECS,
+    FRAME_MESSAGES,
+    ArchiveError,
+    ChatArchive,
+    append_to_archive,
+    encode_archive,
+    main,
+)
+from chat_export import encode_chunks, iter_chat_json_chunks, iter_chat_markdown_chunks
+from chat_import import import_chat
+from chat_message import Message
+
+
+def _messages(count=3, start=0):
+    messages = []
+    for i in range(start, start + count):
+        if i % 2 == 0:
+            timestamp = f"2024/01/02 {i // 3600:02d}:{i // 60 % 60:02d}:{i % 60:02d}"
+            messages.append(Message("user", f"質問 {i}\n", timestamp))
+        else:
+            messages.append(
+                Message(
+                    "assistant",
+                    f"回答 {i}",
+                    # 存在しない日時は文字列のまま残る
+                    "2024/02/30 00:00:00" if i == 1 else None,
+                    f"model-{i % 3}" if i % 5 else None,
+                    {"latency": i / 10, "tokens": {"in": i}},
+                )
+            )
+    return messages
+
+
+def _dicts(messages):
+    return [m.to_dict() for m in messages]
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_round_trip_keeps_every_field(codec):
+    original = _messages(FRAME_MESSAGES * 2 + 5)
+    archive = ChatArchive(io.BytesIO(encode_archive(original, codec)))
+    assert len(archive) == len(original)
+    assert _dicts(archive) == _dicts(original)
+
+
+def test_tree_ids_survive():
+    original = [
+        Message("user", "u0", id=0, parent=None),
+        Message("assistant", "a1", model="m", id=1, parent=0),
+        Message("assistant", "a2", model=None, id=2, parent=0),
+    ]
+    archive = ChatArchive(io.BytesIO(encode_archive(original)))
+    assert _dicts(archive) == _dicts(original)
+
+
+@pytest.mark.parametrize("chunks", [iter_chat_json_chunks, iter_chat_markdown_chunks])
+def test_text_export_from_archive_matches_original(chunks):
+    original = _messages(10)
+    archive = ChatArchive(io.BytesIO(encode_archive(original)))
+    assert encode_chunks(chunks(archive)) == encode_chunks(chunks(original))
+
+
+def test_read_position_across_frames():
+    original = _messages(FRAME_MESSAGES * 3)
+    archive = ChatArchive(io.BytesIO(encode_archive(original)))
+    for position in (0, FRAME_MESSAGES - 1, FRAME_MESSAGES, len(original) - 1, 5):
+        assert archive.read(position).to_dict() == original[position].to_dict()
+    with pytest.raises(IndexError):
+        archive.read(len(original))
+
+
+def test_import_chat_reads_archive_with_progress():
+    data = encode_archive(_messages(FRAME_MESSAGES + 1))
+    reported = []
+    imported = import_chat(io.BytesIO(data), "chat.chatarc", len(data), reported.append)
+    assert _dicts(imported) == _dicts(_messages(FRAME_MESSAGES + 1))
+    assert reported == sorted(reported) and reported[-1] == 1.0
+
+
+@pytest.mark.parametrize("first, second", [(3, 4), (FRAME_MESSAGES, 1), (70, 130)])
+def test_append_equals_one_shot_write(tmp_path, first, second):
+    path = tmp_path / "chat.chatarc"
+    append_to_archive(path, _messages(first), "gzip")
+    append_to_archive(path, _messages(second, start=first), "gzip")
+    expected = encode_archive(_messages(first + second), "gzip")
+    assert path.read_bytes() == expected
+
+
+def test_append_keeps_full_frames(tmp_path):
+    path = tmp_path / "chat.chatarc"
+    append_to_archive(path, _messages(FRAME_MESSAGES + 1), "gzip")
+    with open(path, "rb") as f:
+        before = ChatArchive(f).index["frames"][0]
+    append_to_archive(path, _messages(2, start=FRAME_MESSAGES + 1), "gzip")
+    with open(path, "rb") as f:
+        archive = ChatArchive(f)
+        assert archive.index["frames"][0] == before
+        assert len(archive) == FRAME_MESSAGES + 3
+
+
+@pytest.mark.parametrize(
+    "corrupt",
+    [
+        lambda data: b"",
+        lambda data: b"NOTARC" + data[6:],
+        lambda data: data[:-3],
+        lambda data: data[:40] + b"\x00" * 16 + data[56:],
+    ],
+)
+def test_corrupted_archives_raise(corrupt):
+    data = corrupt(encode_archive(_messages(5), "gzip"))
+    with pytest.raises(ArchiveError):
+        list(ChatArchive(io.BytesIO(data)))
+
+
+def test_cli_pack_unpack_show(tmp_path, capsys):
+    source = tmp_path / "chat.json"
+    source.write_bytes(encode_chunks(iter_chat_json_chunks(_messages(5))))
+    archive = tmp_path / "chat.chatarc"
+    assert main(["pack", str(source), "-o", str(archive)]) == 0
+    assert main(["pack", str(source), "-o", str(archive), "--append"]) == 0
+
+    output = tmp_path / "out.json"
+    assert main(["unpack", str(archive), "-o", str(output)]) == 0
+    assert json.loads(output.read_text(encoding="utf-8")) == _dicts(_messages(5)) * 2
+
+    capsys.readouterr()
+    assert main(["show", str(archive), "6"]) == 0
+    assert json.loads(capsys.readouterr().out) == _messages(5)[1].to_dict()
+    assert main(["show", str(archive), "10"]) == 1
+
+
+def test_interrupted_append_keeps_the_original(tmp_path, monkeypatch):
+    path = tmp_path / "chat.chatarc"
+    append_to_archive(path, _messages(FRAME_MESSAGES + 3), "gzip")
+    before = path.read_bytes()
+
+    def crash(fp, *args):
+        fp.write(b"partial frame")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(chat_archive, "_write_frames", crash)
+    with pytest.raises(OSError):
+        append_to_archive(path, _messages(2, start=FRAME_MESSAGES + 3), "gzip")
+    assert path.read_bytes() == before
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_unavailable_codec_falls_back_to_gzip():
+    app_dir = Path(__file__).resolve().parent.parent / "streamlit_sample"
+    output = subprocess.run(
+        [sys.executable, "-c", "import chat_archive; print(chat_archive.DEFAULT_CODEC)"],
+        cwd=app_dir,
+        env={**os.environ, "CHAT_ARCHIVE_CODEC": "no-such-codec"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert output.stdout.strip() == "gzip"
@@ -0,0 +1,46 @@
+"""保存用データの作成（選んだ形式だけ）と、セッションのメモリ上限での扱い。"""
+import io
+from types import SimpleNamespace
+
+import pytest
+
+import session_memory
+from chat_export import EXPORT_FORMATS, encode_export
+from chat_import import import_chat
+from chat_message import Message
+
+
+def _messages(count):
+    return [
+        Message("user" if i % 2 else "assistant", f"メッセージ {i}" * 20) for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("fmt", list(EXPORT_FORMATS))
+def test_each_format_round_trips(fmt):
+    messages = _messages(5)
+    data = encode_export(messages, fmt)
+    suffix = EXPORT_FORMATS[fmt][1]
+    imported = import_chat(io.BytesIO(data), f"chat{suffix}", len(data))
+    assert [m.to_dict() for m in imported] == [m.to_dict() for m in messages]
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = SimpleNamespace(session_state={"conversation_id": "c", "messages": _messages(3)})
+    monkeypatch.setattr(session_memory, "st", session)
+    return session
+
+
+def test_export_within_budget_is_kept(session):
+    session.session_state["chat_export"] = {"data": b"x" * 100}
+    session_memory.enforce_memory_budget(budget_bytes=1024 * 1024)
+    assert "chat_export" in session.session_state
+    assert len(session.session_state["messages"]) == 3
+
+
+def test_export_over_budget_is_dropped_before_messages(session):
+    session.session_state["chat_export"] = {"data": b"x" * 1024 * 1024}
+    session_memory.enforce_memory_budget(budget_bytes=64 * 1024)
+    assert "chat_export" not in session.session_state
+    assert len(session.session_state["messages"]) == 3
@@ -0,0 +1,142 @@
+"""チャット履歴のインポート（形式の判定・検証エラーの位置・進捗）とエクスポートとの往復。"""
+import io
+import json
+
+import pytest
+
+from chat_export import encode_chunks, iter_chat_json_chunks, iter_chat_markdown_chunks
+from chat_import import (
+    ChatImportError,
+    detect_format,
+    import_chat,
+    iter_json_messages,
+    iter_jsonl_messages,
+)
+from chat_message import Message
+
+
+def _messages():
+    return [
+        Message("user", "こんにちは\n2行目", "2024/01/02 03:04:05"),
+        Message(
+            "assistant",
+            "## 見出しのような行\n\n本文",
+            "2024/01/02 03:04:06",
+            "claude-test",
+            {"latency": 1.5},
+        ),
+        Message("user", "", "2024/01/02 03:04:07"),
+        Message("assistant", "モデルなし", None, None),
+    ]
+
+
+def _import_bytes(data: bytes, name: str, **kwargs):
+    return import_chat(io.BytesIO(data), name, len(data), **kwargs)
+
+
+@pytest.mark.parametrize(
+    "chunks, name",
+    [(iter_chat_json_chunks, "chat.json"), (iter_chat_markdown_chunks, "chat.md")],
+)
+def test_export_import_round_trip(chunks, name):
+    original = _messages()
+    imported = _import_bytes(encode_chunks(chunks(original)), name)
+    assert [m.to_dict() for m in imported] == [m.to_dict() for m in original]
+
+
+def test_json_chunks_match_json_dumps():
+    original = _messages()
+    expected = json.dumps([m.to_dict() for m in original], ensure_ascii=False, indent=2)
+    assert "".join(iter_chat_json_chunks(original)) == expected
+    assert "".join(iter_chat_json_chunks([])) == "[]"
+
+
+def test_import_jsonl_skips_blank_lines():
+    data = '{"role": "user", "content": "a"}\n\n{"role": "assistant", "content": "b"}\n'
+    imported = _import_bytes(data.encode(), "chat.jsonl")
+    assert [(m.role, m.content) for m in imported] == [("user", "a"), ("assistant", "b")]
+
+
+def test_import_legacy_markdown_without_meta():
+    data = (
+        "# Chat Transcript\n\n"
+        "## User (2024/01/02 03:04:05)\n\n質問\n\n"
+        "## Assistant - claude-test (2024/01/02 03:04:06)\n\n回答\n"
+    )
+    imported = _import_bytes(data.encode(), "chat.md")
+    assert [m.to_dict() for m in imported] == [
+        {"role": "user", "content": "質問", "timestamp": "2024/01/02 03:04:05"},
+        {
+            "role": "assistant",
+            "content": "回答",
+            "timestamp": "2024/01/02 03:04:06",
+            "model": "claude-test",
+        },
+    ]
+
+
+def test_import_large_json_across_read_chunks():
+    original = [Message("user", "あ" * 50000 + str(i)) for i in range(5)]
+    imported = _import_bytes(encode_chunks(iter_chat_json_chunks(original)), "chat.json")
+    assert [m.content for m in imported] == [m.content for m in original]
+
+
+@pytest.mark.parametrize(
+    "name, head, expected",
+    [
+        ("a.jsonl", b"[", "jsonl"),
+        ("a.MD", b"[", "md"),
+        ("a.json", b"{", "json"),
+        ("upload", b"\xef\xbb\xbf  [", "json"),
+        ("upload", b'{"role"', "jsonl"),
+        ("upload", b"# Chat", "md"),
+    ],
+)
+def test_detect_format(name, head, expected):
+    assert detect_format(name, head) == expected
+
+
+def test_invalid_role_reports_message_and_location():
+    stream = io.StringIO(
+        '[\n  {"role": "user", "content": "a"},\n  {"role": "bot", "content": "b"}\n]'
+    )
+    with pytest.raises(ChatImportError) as info:
+        list(iter_json_messages(stream))
+    assert (info.value.index, info.value.line, info.value.column) == (1, 3, 3)
+    assert "2番目のメッセージ" in str(info.value)
+
+
+def test_json_syntax_error_location():
+    stream = io.StringIO('[{"role": "user", "content": "a"}\n {"role": "user"}]')
+    with pytest.raises(ChatImportError) as info:
+        list(iter_json_messages(stream))
+    assert info.value.reason == "',' または ']' が必要です。"
+    assert (info.value.line, info.value.column) == (2, 2)
+
+
+def test_jsonl_syntax_error_location():
+    stream = io.StringIO('{"role": "user", "content": "a"}\n{"role": \n')
+    with pytest.raises(ChatImportError) as info:
+        list(iter_jsonl_messages(stream))
+    assert (info.value.index, info.value.line) == (1, 2)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [b"", b"[]", b"{", b'[{"role": "user", "content": 1}]', b"\xff\xfe[]"],
+)
+def test_invalid_files_raise(data):
+    with pytest.raises(ChatImportError):
+        _import_bytes(data, "chat.json")
+
+
+def test_progress_is_monotonic_and_finishes():
+    original = [Message("user", "x" * 100000) for _ in range(3)]
+    reported = []
+    _import_bytes(
+        encode_chunks(iter_chat_json_chunks(original)), "chat.json", progress=reported.append
+    )
+    assert reported == sorted(reported)
+    assert all(0.0 <= value <= 1.0 for value in reported)
+    assert reported[-1] == 1.0
+    assert len(reported) > 2
@@ -0,0 +1,39 @@
+"""コンテキストポリシーで絞り込んだ履歴に、要約にも送信にも入らないメッセージが無いか。"""
+from types import SimpleNamespace
+
+from context_policy import SUMMARY_PREFIX, SummarizingPolicy
+
+
+class EchoClient:
+    """要約の代わりに、要約を頼まれたプロンプトをそのまま返すクライアント。"""
+
+    def __init__(self):
+        self.messages = self
+
+    def create(self, model, max_tokens, messages):
+        return SimpleNamespace(content=[SimpleNamespace(text=messages[0]["content"])])
+
+
+def _history(turns):
+    messages = [{"role": "assistant", "content": "greeting"}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"u{i}"})
+        messages.append({"role": "assistant", "content": f"a{i}"})
+    return messages
+
+
+def test_summarized_history_keeps_every_message():
+    policy = SummarizingPolicy()
+    state = {}
+    for turns in range(1, 40):
+        messages = _history(turns) + [{"role": "user", "content": f"u{turns}"}]
+        result = policy.apply(EchoClient(), "claude-test", messages, state)
+        sent = result.messages
+        if sent[0]["content"].startswith(SUMMARY_PREFIX):
+            summary, sent = sent[0]["content"], sent[2:]
+            assert sent[0]["role"] == "user"
+        else:
+            summary = ""
+        sent_contents = {m["content"] for m in sent}
+        for msg in messages:
+            assert msg["content"] in sent_contents or f": {msg['content']}\n" in summary + "\n"
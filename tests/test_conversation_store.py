@@ -0,0 +1,173 @@
+"""会話ストアの分岐（編集・再生成・分岐の切り替え）と、木のままの保存・読み込み。"""
+import io
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from chat_export import encode_chunks, iter_chat_json_chunks
+from chat_import import ChatImportError, import_chat, validate_tree
+from chat_message import Message
+from conversation_store import ConversationStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ConversationStore(tmp_path / "conversations.sqlite3")
+
+
+def _contents(messages):
+    return [m.content for m in messages]
+
+
+def _branched(store):
+    """u0 → a1 → u2 → a3 と進んだ後、u2 を編集して u4 → a5 と進んだ会話。"""
+    cid = store.create_conversation(
+        [Message("user", "u0"), Message("assistant", "a1")], "model"
+    )
+    store.append_message(cid, Message("user", "u2"))
+    store.append_message(cid, Message("assistant", "a3"))
+    store.append_message(cid, Message("user", "u4"), parent=1)
+    store.append_message(cid, Message("assistant", "a5"))
+    return cid
+
+
+def test_linear_conversation_reads_by_position(store):
+    cid = store.create_conversation([Message("user", "u0")], "model")
+    msg = Message("assistant", "a1")
+    assert store.append_message(cid, msg) == 1
+    assert (msg.id, msg.parent) == (1, 0)
+    assert store.get_conversation(cid)["branched"] == 0
+    assert store.path_length(cid) == 2
+    assert _contents(store.load_messages(cid, 1)) == ["a1"]
+
+
+def test_edit_creates_a_sibling_branch(store):
+    cid = _branched(store)
+    assert _contents(store.load_messages(cid)) == ["u0", "a1", "u4", "a5"]
+    assert [m.id for m in store.load_messages(cid)] == [0, 1, 4, 5]
+    assert store.siblings(cid, 1) == [2, 4]
+    assert store.path_length(cid) == 4
+    assert store.path_position(cid, 5) == 3
+    # 経路の中の位置で範囲を指定する
+    assert _contents(store.load_messages(cid, 2, 4)) == ["u4", "a5"]
+
+
+def test_set_head_switches_branch(store):
+    cid = _branched(store)
+    store.set_head(cid, store.leaf_of(cid, 2))
+    assert _contents(store.load_messages(cid)) == ["u0", "a1", "u2", "a3"]
+    assert store.leaf_of(cid, 1) == 5
+
+
+def test_load_messages_with_head_keeps_stored_head(store):
+    cid = _branched(store)
+    assert _contents(store.load_messages(cid, head=3)) == ["u0", "a1", "u2", "a3"]
+    assert _contents(store.load_messages(cid)) == ["u0", "a1", "u4", "a5"]
+
+
+def test_append_without_moving_head(store):
+    cid = store.create_conversation(
+        [Message("user", "u0"), Message("assistant", "a1")], "model"
+    )
+    # 再生成した応答を、表示中の分岐を変えずに兄弟として保存する
+    store.append_message(cid, Message("assistant", "a2"), parent=0, move_head=False)
+    assert _contents(store.load_messages(cid)) == ["u0", "a1"]
+    assert store.siblings(cid, 0) == [1, 2]
+    assert store.get_conversation(cid)["branched"] == 1
+
+
+def test_load_tree_puts_active_branch_last_and_round_trips(store):
+    cid = _branched(store)
+    tree = store.load_tree(cid)
+    assert _contents(tree) == ["u0", "a1", "u2", "a3", "u4", "a5"]
+    assert [m.parent for m in tree] == [None, 0, 1, 2, 1, 4]
+
+    # 別の分岐を表示していれば、その分岐が最後になる
+    store.set_head(cid, 3)
+    tree = store.load_tree(cid)
+    assert _contents(tree) == ["u0", "a1", "u4", "a5", "u2", "a3"]
+    copy = store.create_conversation(tree, "model")
+    assert _contents(store.load_messages(copy)) == ["u0", "a1", "u2", "a3"]
+    assert store.siblings(copy, 1) == [2, 4]
+
+
+def test_tree_survives_export_and_import(store):
+    cid = _branched(store)
+    data = encode_chunks(iter_chat_json_chunks(store.load_tree(cid)))
+    imported = import_chat(io.BytesIO(data), "chat.json", len(data))
+    copy = store.create_conversation(imported, "model")
+    assert _contents(store.load_messages(copy)) == ["u0", "a1", "u4", "a5"]
+    assert _contents(store.load_tree(copy)) == _contents(store.load_tree(cid))
+
+
+def test_unbranched_tree_has_no_ids(store):
+    cid = store.create_conversation(
+        [Message("user", "u0"), Message("assistant", "a1")], "model"
+    )
+    assert [(m.id, m.parent) for m in store.load_tree(cid)] == [(None, None)] * 2
+
+
+@pytest.mark.parametrize(
+    "messages",
+    [
+        [Message("user", "a", id=1), Message("user", "b")],
+        [Message("user", "a", id=1), Message("user", "b", id=1, parent=1)],
+        [Message("user", "a", id=1), Message("user", "b", id=2, parent=3)],
+    ],
+)
+def test_validate_tree_rejects_broken_trees(messages):
+    with pytest.raises(ChatImportError):
+        validate_tree(messages)
+
+
+def test_migrates_store_without_branches(tmp_path):
+    path = tmp_path / "conversations.sqlite3"
+    conn = sqlite3.connect(str(path))
+    conn.executescript(
+        """
+        CREATE TABLE conversations (
+            id TEXT PRIMARY KEY, title TEXT NOT NULL DEFAULT '', model TEXT,
+            created_at REAL NOT NULL, updated_at REAL NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE messages (
+            conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL,
+            content TEXT NOT NULL, timestamp TEXT, model TEXT, extra TEXT,
+            PRIMARY KEY (conversation_id, seq)
+        );
+        INSERT INTO conversations VALUES ('c', 'u0', 'model', 0, 0, 3);
+        INSERT INTO messages VALUES ('c', 0, 'user', 'u0', NULL, NULL, NULL);
+        INSERT INTO messages VALUES ('c', 1, 'assistant', 'a1', NULL, 'model', NULL);
+        INSERT INTO messages VALUES ('c', 2, 'user', 'u2', NULL, NULL, NULL);
+        """
+    )
+    conn.commit()
+    conn.close()
+
+    store = ConversationStore(path)
+    assert [(m.id, m.parent) for m in store.load_messages("c")] == [
+        (0, None),
+        (1, 0),
+        (2, 1),
+    ]
+    store.append_message("c", Message("assistant", "a3"))
+    assert _contents(store.load_messages("c")) == ["u0", "a1", "u2", "a3"]
+
+
+def test_session_append_uses_its_own_branch_tail(store, monkeypatch):
+    import conversation_store
+
+    cid = _branched(store)
+    store.set_head(cid, 3)
+    session = SimpleNamespace(
+        session_state={"conversation_id": cid, "messages": store.load_messages(cid)}
+    )
+    monkeypatch.setattr(conversation_store, "st", session)
+    monkeypatch.setattr(conversation_store, "get_conversation_store", lambda: store)
+
+    # 別のタブが分岐を切り替えても、このセッションが表示している分岐に追記する
+    store.set_head(cid, 5)
+    conversation_store.append_message(Message("user", "u6"))
+    assert session.session_state["messages"][-1].parent == 3
+    assert _contents(store.load_messages(cid)) == ["u0", "a1", "u2", "a3", "u6"]
@@ -0,0 +1,218 @@
+"""出力バジェットの max_tokens と、上限で打ち切られた応答の続きの生成。"""
+from types import SimpleNamespace
+
+import pytest
+
+import context_policy
+import generation_worker
+import output_budget
+from context_policy import FullHistoryPolicy
+from generation_worker import BUDGET_AUTO, GenerationJob, merge_metrics
+from model_catalog import _model_info
+from output_budget import MIN_MAX_TOKENS, MIN_SAMPLES, OutputBudget
+from rate_limiter import RateLimiter
+from response_cache import ResponseCache, make_cache_key
+
+MODEL = "claude-test"
+MODEL_MAX_OUTPUT = 8192
+MESSAGES = [{"role": "user", "content": "長い説明をしてください"}]
+
+
+class FakeCatalog:
+    def get(self, model_id):
+        return _model_info(model_id, max_output_tokens=MODEL_MAX_OUTPUT)
+
+
+@pytest.fixture(autouse=True)
+def catalog(monkeypatch):
+    # モデル一覧を API から取得しない
+    monkeypatch.setattr(output_budget, "get_model_catalog", FakeCatalog)
+    monkeypatch.setattr(context_policy, "get_model_catalog", FakeCatalog)
+
+
+class FakeStream:
+    def __init__(self, chunks, stop_reason, output_tokens, cache_read):
+        self.text_stream = iter(chunks)
+        self._chunks = chunks
+        self._message = SimpleNamespace(
+            stop_reason=stop_reason,
+            usage=SimpleNamespace(
+                input_tokens=10,
+                output_tokens=output_tokens,
+                cache_read_input_tokens=cache_read,
+                cache_creation_input_tokens=0,
+            ),
+        )
+        self.current_message_snapshot = self._message
+        self.response = SimpleNamespace(request=SimpleNamespace(headers={}))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def get_final_message(self):
+        return self._message
+
+    def get_final_text(self):
+        return "".join(self._chunks)
+
+
+class FakeClient:
+    """
+    messages.stream() の応答を順に返すクライアント。応答は
+    (チャンクのリスト, stop_reason, 出力トークン数) か、送出する例外。
+    """
+
+    def __init__(self, *responses):
+        self._responses = list(responses)
+        self.requests = []
+        self.messages = self
+
+    def with_options(self, **kwargs):
+        return self
+
+    def stream(self, **request):
+        self.requests.append(request)
+        response = self._responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        chunks, stop_reason, output_tokens = response
+        return FakeStream(chunks, stop_reason, output_tokens, 100 * (len(self.requests) - 1))
+
+
+def _run(client, budget=None, max_tokens=1024, response_cache=None):
+    job = GenerationJob(
+        MODEL, MESSAGES, FullHistoryPolicy.name, max_tokens, {}, response_cache=response_cache
+    )
+    job.run(client, RateLimiter(max_retries=0), budget or OutputBudget())
+    assert job.error is None
+    return job
+
+
+def test_default_until_enough_samples():
+    budget = OutputBudget(default_max_tokens=4096)
+    for _ in range(MIN_SAMPLES - 1):
+        budget.record(MODEL, 100)
+    budget.record(MODEL, 0)
+    assert budget.max_tokens_for(MODEL) == 4096
+    assert OutputBudget(default_max_tokens=10 ** 6).max_tokens_for(MODEL) == MODEL_MAX_OUTPUT
+
+
+@pytest.mark.parametrize(
+    "samples, expected",
+    [
+        # p95 は 1000 付近、1.5 倍して 256 の倍数に切り上げる
+        ([1000] * 20, 1536),
+        # 短い応答ばかりでも下限を下回らない
+        ([10] * 20, MIN_MAX_TOKENS),
+        # モデルの最大出力トークン数を超えない
+        ([20000] * 20, MODEL_MAX_OUTPUT),
+    ],
+)
+def test_budget_from_recent_output_lengths(samples, expected):
+    budget = OutputBudget()
+    for tokens in samples:
+        budget.record(MODEL, tokens)
+    assert budget.max_tokens_for(MODEL) == expected
+    assert budget.max_tokens_for("claude-other") == min(
+        output_budget.DEFAULT_MAX_TOKENS, MODEL_MAX_OUTPUT
+    )
+
+
+def test_continuation_max_tokens_doubles_up_to_model_limit():
+    budget = OutputBudget()
+    assert budget.continuation_max_tokens(MODEL, 1024) == 2048
+    assert budget.continuation_max_tokens(MODEL, 6000) == MODEL_MAX_OUTPUT
+
+
+def test_merge_metrics():
+    first = {
+        "time_to_first_token": 0.5,
+        "latency": 1.0,
+        "input_tokens": 10,
+        "output_tokens": 1024,
+        "stop_reason": "max_tokens",
+        "retries": 1,
+    }
+    continuation = {
+        "time_to_first_token": 0.2,
+        "latency": 0.4444,
+        "input_tokens": 5,
+        "output_tokens": 300,
+        "cache_read_input_tokens": 100,
+        "stop_reason": "end_turn",
+    }
+    merged = merge_metrics(first, continuation)
+    assert merged["time_to_first_token"] == 0.5
+    assert merged["latency"] == 1.444
+    assert (merged["input_tokens"], merged["output_tokens"]) == (15, 1324)
+    assert (merged["cache_read_input_tokens"], merged["retries"]) == (100, 1)
+    assert merged["stop_reason"] == "end_turn"
+
+
+def test_truncated_response_is_continued_with_prefill():
+    client = FakeClient(
+        (["前半の", "説明 \n"], "max_tokens", 1024),
+        (["。後半"], "end_turn", 300),
+    )
+    budget = OutputBudget()
+    job = _run(client, budget)
+    assert job.status == "done"
+    assert job.text == "前半の説明。後半"
+
+    continuation = client.requests[1]
+    # プレフィルは末尾の空白を除いた応答で、max_tokens は 2 倍にする
+    assert continuation["messages"][-1] == {"role": "assistant", "content": "前半の説明"}
+    assert continuation["max_tokens"] == 2048
+    assert job.metrics["continuations"] == 1
+    assert job.metrics["continuation_tokens_saved"] == 100
+    assert job.metrics["output_tokens"] == 1324
+    assert job.metrics["stop_reason"] == "end_turn"
+    # 続きを含めた応答全体の長さを記録する
+    assert list(budget._samples[MODEL]) == [1324]
+
+
+def test_continuations_are_limited(monkeypatch):
+    monkeypatch.setattr(generation_worker, "MAX_CONTINUATIONS", 2)
+    client = FakeClient(*[([f"{i}"], "max_tokens", 1024) for i in range(3)])
+    job = _run(client)
+    assert job.text == "012"
+    assert job.metrics["continuations"] == 2
+    assert [r["max_tokens"] for r in client.requests] == [1024, 2048, 4096]
+
+
+def test_failed_continuation_keeps_truncated_response():
+    client = FakeClient((["途中まで "], "max_tokens", 1024), ValueError("prefill unsupported"))
+    job = _run(client)
+    assert job.status == "done"
+    assert job.text == "途中まで"
+    assert "continuations" not in job.metrics
+
+
+def test_cache_key_uses_budget_mode_not_per_turn_max_tokens(tmp_path):
+    cache = ResponseCache(tmp_path / "cache.sqlite3")
+    budget = OutputBudget(default_max_tokens=2048)
+    client = FakeClient((["応答"], "end_turn", 10))
+    _run(client, budget, max_tokens=None, response_cache=cache)
+    assert client.requests[0]["max_tokens"] == 2048
+    assert cache.get(make_cache_key(MODEL, BUDGET_AUTO, MESSAGES)) == {"content": "応答"}
+
+    # 応答の記録で出力バジェットの max_tokens が変わっても、同じ質問はキャッシュから返す
+    for _ in range(MIN_SAMPLES):
+        budget.record(MODEL, 5000)
+    assert budget.max_tokens_for(MODEL) != 2048
+    job = _run(FakeClient(), budget, max_tokens=None, response_cache=cache)
+    assert job.cached and job.text == "応答"
+
+    # max_tokens を固定した場合は、その値ごとに別のキーになる
+    assert cache.get(make_cache_key(MODEL, 2048, MESSAGES)) is None
+
+
+def test_truncated_reply_is_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(generation_worker, "MAX_CONTINUATIONS", 0)
+    cache = ResponseCache(tmp_path / "cache.sqlite3")
+    job = _run(FakeClient((["途中まで"], "max_tokens", 1024)), response_cache=cache)
+    assert job.status == "done"
+    assert cache.get(make_cache_key(MODEL, 1024, MESSAGES)) is None
@@ -0,0 +1,232 @@
+"""レート制限のトークンバケット・リトライとバックオフ・精算と、送信待ちの位置。"""
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import rate_limiter
+from generation_worker import GenerationJob, GenerationWorker
+from rate_limiter import (
+    RateLimitCancelled,
+    RateLimiter,
+    TokenBucket,
+    estimate_input_tokens,
+    is_retryable,
+)
+
+
+class ApiError(Exception):
+    def __init__(self, status_code=None, body=None):
+        super().__init__(status_code)
+        self.status_code = status_code
+        self.body = body
+        self.response = None
+
+
+@pytest.fixture(autouse=True)
+def short_backoff(monkeypatch):
+    # バックオフの待ち時間をテストでは短くする
+    monkeypatch.setattr(rate_limiter, "BACKOFF_BASE_SECONDS", 0.001)
+
+
+def _limiter(**kwargs):
+    # トークン数の上限は精算を確かめやすいよう、補充がほぼ無視できる大きさにする
+    params = dict(
+        requests_per_minute=1000,
+        input_tokens_per_minute=60000,
+        output_tokens_per_minute=60000,
+        max_concurrency=4,
+        max_retries=2,
+    )
+    params.update(kwargs)
+    return RateLimiter(**params)
+
+
+def test_bucket_wait_time_and_refill():
+    bucket = TokenBucket(60)
+    start = bucket._updated
+    bucket.consume(60)
+    # 1 分あたり 60 なので 1 秒に 1 ずつ補充される
+    assert bucket.wait_time(10, start) == pytest.approx(10)
+    assert bucket.wait_time(10, start + 4) == pytest.approx(6)
+    assert bucket.wait_time(10, start + 60) == 0
+
+
+def test_bucket_oversized_request_waits_for_full_bucket_then_goes_negative():
+    bucket = TokenBucket(60)
+    start = bucket._updated
+    assert bucket.wait_time(100, start) == 0
+    bucket.consume(100)
+    assert bucket.tokens == -40
+    assert bucket.wait_time(1, start) == pytest.approx(41)
+
+
+def test_bucket_refund_is_capped_and_sync_lowers_remaining():
+    bucket = TokenBucket(60)
+    start = bucket._updated
+    bucket.refund(100)
+    assert bucket.tokens == 60
+    bucket.sync(120, 30, start)
+    assert (bucket.capacity, bucket.tokens) == (120, 30)
+    # サーバー側の残量の方が多くても、手元の残量は増やさない
+    bucket.sync(120, 100, start)
+    assert bucket.tokens == 30
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (ApiError(429), True),
+        (ApiError(529), True),
+        (ApiError(500), False),
+        (ApiError(body={"error": {"type": "overloaded_error"}}), True),
+        (ApiError(body={"error": {"type": "invalid_request_error"}}), False),
+        (ValueError("x"), False),
+    ],
+)
+def test_is_retryable(error, expected):
+    assert is_retryable(error) is expected
+
+
+def test_estimate_input_tokens():
+    assert estimate_input_tokens([{"role": "user", "content": "あいうえ"}]) == 3
+
+
+def test_call_retries_rate_limited_errors_and_halves_concurrency():
+    limiter = _limiter()
+    errors = [ApiError(429), ApiError(529)]
+
+    def func():
+        if errors:
+            raise errors.pop(0)
+        return {"input_tokens": 10, "output_tokens": 5}
+
+    metrics, attempt = limiter.call(func, 10, 100)
+    assert attempt == 2
+    assert metrics == {"input_tokens": 10, "output_tokens": 5}
+    # 4 → 2 → 1 と下がり、成功で 1 戻る
+    assert limiter.concurrency == 2
+    assert limiter._failures == 0
+    assert limiter.in_flight == 0
+
+
+def test_call_gives_up_after_max_retries():
+    limiter = _limiter(max_retries=1)
+    calls = []
+
+    def func():
+        calls.append(1)
+        raise ApiError(429)
+
+    with pytest.raises(ApiError):
+        limiter.call(func, 10, 100)
+    assert len(calls) == 2
+    assert limiter.in_flight == 0
+
+
+def test_non_retryable_error_keeps_concurrency_and_backoff_state():
+    limiter = _limiter()
+    limiter.concurrency = 2
+    limiter._failures = 1
+
+    def func():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        limiter.call(func, 10, 100)
+    assert (limiter.concurrency, limiter._failures) == (2, 1)
+
+
+def test_release_settles_reserved_tokens_with_actual_usage():
+    limiter = _limiter()
+    limiter.call(
+        lambda: {"input_tokens": 40, "cache_creation_input_tokens": 10, "output_tokens": 20},
+        100,
+        1000,
+    )
+    assert limiter._buckets["input_tokens"].tokens == pytest.approx(60000 - 50, abs=5)
+    assert limiter._buckets["output_tokens"].tokens == pytest.approx(60000 - 20, abs=5)
+
+
+def test_run_returns_result_and_settles_with_usage():
+    limiter = _limiter()
+    usage = SimpleNamespace(
+        input_tokens=30, cache_creation_input_tokens=None, output_tokens=7
+    )
+    response = SimpleNamespace(usage=usage)
+    assert limiter.run(lambda: response, 100, 500) is response
+    assert limiter._buckets["input_tokens"].tokens == pytest.approx(60000 - 30, abs=5)
+    assert limiter._buckets["output_tokens"].tokens == pytest.approx(60000 - 7, abs=5)
+    # usage の無い戻り値（トークン数カウント API など）は見積もりのまま
+    assert limiter.run(lambda: 42) == 42
+
+
+def test_queued_call_reports_position_and_can_be_cancelled():
+    limiter = _limiter(max_concurrency=1)
+    limiter.in_flight = 1
+    positions = []
+    with pytest.raises(RateLimitCancelled):
+        limiter.call(
+            lambda: {},
+            1,
+            1,
+            should_stop=lambda: bool(positions),
+            on_queue=positions.append,
+        )
+    assert positions == [1]
+    assert limiter.queue_length() == 0
+
+
+class BlockingJob(GenerationJob):
+    """API を呼ばずに、release されるまでスレッドプールのスレッドを占有するジョブ。"""
+
+    def __init__(self):
+        super().__init__("model", [], None, None, {})
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def run(self, client, rate_limiter, output_budget):
+        self.started.set()
+        self.release.wait(5)
+
+
+def test_worker_reports_positions_of_jobs_waiting_for_the_pool():
+    limiter = _limiter()
+    worker = GenerationWorker(lambda: None, limiter, None, max_workers=1)
+    jobs = [BlockingJob() for _ in range(3)]
+    for job in jobs:
+        worker.submit(job)
+    assert jobs[0].started.wait(5)
+    assert [worker.queue_position(job) for job in jobs] == [None, 1, 2]
+
+    # レート制限の順番を待っているジョブがあれば、その後ろに並ぶ
+    limiter._queue.append(object())
+    assert worker.queue_position(jobs[1]) == 2
+    limiter._queue.clear()
+
+    for job in jobs:
+        job.release.set()
+    worker._executor.shutdown(wait=True)
+    assert [worker.queue_position(job) for job in jobs] == [None, None, None]
+
+
+def _response(path, limit, remaining):
+    import httpx
+
+    prefix = "anthropic-ratelimit-requests-"
+    return httpx.Response(
+        200,
+        headers={prefix + "limit": str(limit), prefix + "remaining": str(remaining)},
+        request=httpx.Request("POST", "https://api.anthropic.com" + path),
+    )
+
+
+def test_only_messages_responses_update_the_buckets():
+    limiter = _limiter()
+    # トークン数カウント API のヘッダーはそちらのレート制限の値なので使わない
+    limiter.observe_response(_response("/v1/messages/count_tokens", 100, 5))
+    assert limiter._buckets["requests"].capacity == 1000
+    limiter.observe_response(_response("/v1/messages", 200, 150))
+    bucket = limiter._buckets["requests"]
+    assert bucket.capacity == 200
+    assert bucket.tokens == pytest.approx(150)
@@ -0,0 +1,105 @@
+"""応答キャッシュのキーの正規化と、メモリ / ディスクの 2 段の保持・期限切れ・削除。"""
+import pytest
+
+import response_cache
+from response_cache import ResponseCache, make_cache_key
+
+MESSAGES = [
+    {"role": "user", "content": "質問"},
+    {"role": "assistant", "content": "回答"},
+    {"role": "user", "content": [{"type": "text", "text": "続き"}]},
+]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(response_cache.time, "time", clock.time)
+    return clock
+
+
+def test_key_ignores_whitespace_and_cache_control():
+    variant = [
+        {"role": "user", "content": "  質問\n"},
+        {"role": "assistant", "content": "回答 "},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "続き", "cache_control": {"type": "ephemeral"}}
+            ],
+        },
+    ]
+    assert make_cache_key("m", 1024, variant) == make_cache_key("m", 1024, MESSAGES)
+
+
+@pytest.mark.parametrize(
+    "model, max_tokens, messages",
+    [
+        ("other", 1024, MESSAGES),
+        ("m", 2048, MESSAGES),
+        ("m", 1024, MESSAGES[:1]),
+        ("m", 1024, [{"role": "assistant", "content": "質問"}]),
+    ],
+)
+def test_key_depends_on_model_max_tokens_and_history(model, max_tokens, messages):
+    assert make_cache_key(model, max_tokens, messages) != make_cache_key(
+        "m", 1024, MESSAGES
+    )
+
+
+def test_get_put_and_hit_counts(tmp_path, clock):
+    cache = ResponseCache(tmp_path / "cache.sqlite3")
+    assert cache.get("k") is None
+    cache.put("k", {"text": "応答"})
+    assert cache.get("k") == {"text": "応答"}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_disk_entries_survive_a_new_instance(tmp_path, clock):
+    path = tmp_path / "cache.sqlite3"
+    ResponseCache(path).put("k", {"text": "応答"})
+    assert ResponseCache(path).get("k") == {"text": "応答"}
+
+
+def test_expired_entries_miss(tmp_path, clock):
+    path = tmp_path / "cache.sqlite3"
+    cache = ResponseCache(path, ttl_seconds=60)
+    cache.put("k", {"text": "応答"})
+    clock.now += 61
+    assert cache.get("k") is None
+    # ディスクからも削除されている
+    clock.now -= 61
+    assert ResponseCache(path).get("k") is None
+
+
+def test_memory_lru_falls_back_to_disk(tmp_path, clock):
+    cache = ResponseCache(tmp_path / "cache.sqlite3", memory_entries=1)
+    cache.put("a", {"text": "a"})
+    cache.put("b", {"text": "b"})
+    assert list(cache._memory) == ["b"]
+    assert cache.get("a") == {"text": "a"}
+    assert list(cache._memory) == ["a"]
+
+
+def test_eviction_removes_least_recently_used(tmp_path, clock):
+    # 1 エントリは約 110 バイト。上限 300 バイトなら 3 件目で削除が起きる
+    cache = ResponseCache(tmp_path / "cache.sqlite3", max_disk_bytes=300)
+    for key in ("a", "b"):
+        cache.put(key, {"text": key * 100})
+        clock.now += 1
+    cache.get("a")
+    clock.now += 1
+    cache.put("c", {"text": "c" * 100})
+
+    reopened = ResponseCache(tmp_path / "cache.sqlite3", max_disk_bytes=300)
+    assert reopened.get("b") is None
+    assert reopened.get("a") == {"text": "a" * 100}
+    assert reopened.get("c") == {"text": "c" * 100}